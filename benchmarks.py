@@ -0,0 +1,881 @@
+import argparse
+import datetime
+import json
+import multiprocessing
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+import helper
+
+
+def make_synthetic_corpus(directory, num_lines=100000, vocab_size=10000, max_length=20, seed=0):
+    """
+    Write a random parallel corpus with Zipf distributed words
+    :param directory: Directory to write small_vocab_en and small_vocab_fr style files to
+    :param num_lines: Number of sentence pairs
+    :param vocab_size: Number of distinct words per side
+    :param max_length: Longest sentence in words
+    :param seed: Random seed
+    :return: Tuple (source path, target path)
+    """
+    random_state = np.random.RandomState(seed)
+    paths = []
+    for prefix in ('en', 'fr'):
+        words = np.array(['{}{}'.format(prefix, word_i) for word_i in range(vocab_size)])
+        lengths = random_state.randint(1, max_length + 1, size=num_lines)
+        word_ids = (random_state.zipf(1.3, size=int(lengths.sum())) - 1) % vocab_size
+        offsets = np.concatenate([[0], np.cumsum(lengths)])
+
+        path = os.path.join(directory, 'synthetic_vocab_' + prefix)
+        with open(path, 'w', encoding='utf-8') as out_file:
+            for line_i in range(num_lines):
+                out_file.write(' '.join(words[word_ids[offsets[line_i]:offsets[line_i + 1]]]) + '\n')
+        paths.append(path)
+
+    return tuple(paths)
+
+
+def time_call(function, repeat=3):
+    """
+    :return: Best wall time in seconds of repeat calls to function
+    """
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def worker_counts(max_workers):
+    """
+    :return: 1, 2, 4, ... up to and including max_workers
+    """
+    counts = []
+    workers = 1
+    while workers < max_workers:
+        counts.append(workers)
+        workers *= 2
+    return counts + [max_workers]
+
+
+def bench_parallel_preprocess(num_lines=200000, vocab_size=20000, max_workers=None, repeat=1):
+    """
+    Time parallel_preprocess on a synthetic corpus from 1 up to max_workers processes
+    :return: List of result dictionaries, one per worker count
+    """
+    import parallel_preprocess
+
+    max_workers = max_workers or os.cpu_count() or 1
+    directory = tempfile.mkdtemp()
+    try:
+        source_path, target_path = make_synthetic_corpus(directory, num_lines, vocab_size)
+        out_path = os.path.join(directory, 'preprocess')
+
+        results = []
+        for workers in worker_counts(max_workers):
+            seconds = time_call(lambda: parallel_preprocess.preprocess_and_save_data_parallel(
+                source_path, target_path, out_path, workers), repeat)
+            results.append({'workers': workers, 'seconds': seconds, 'lines_per_sec': num_lines / seconds,
+                            'speedup': results[0]['seconds'] / seconds if results else 1.0})
+
+        streaming_seconds = time_call(lambda: helper.preprocess_and_save_data_streaming(
+            source_path, target_path, out_path), repeat)
+    finally:
+        shutil.rmtree(directory)
+
+    print('Preprocessing {} lines, vocabulary of {} words'.format(num_lines, vocab_size))
+    print('  streaming:  {:>8.3f}s'.format(streaming_seconds))
+    for result in results:
+        print('  workers {:>2}: {:>8.3f}s {:>12.0f} lines/sec {:>6.2f}x'.format(
+            result['workers'], result['seconds'], result['lines_per_sec'], result['speedup']))
+    return results
+
+
+def _list_get_batch(sources, targets, start_i, batch_size, source_pad_int, target_pad_int):
+    # get_batches before padding was vectorized: padded lists, np.array and a length loop over padded rows
+    import language_translation
+
+    sources_batch = sources[start_i:start_i + batch_size]
+    targets_batch = targets[start_i:start_i + batch_size]
+    pad_sources_batch = np.array(language_translation.pad_sentence_batch(sources_batch, source_pad_int))
+    pad_targets_batch = np.array(language_translation.pad_sentence_batch(targets_batch, target_pad_int))
+    pad_source_lengths = [len(source) for source in pad_sources_batch]
+    pad_targets_lengths = [len(target) for target in pad_targets_batch]
+    return pad_sources_batch, pad_targets_batch, pad_source_lengths, pad_targets_lengths
+
+
+def bench_padding(batch_sizes=(32, 128, 512, 2048), num_lines=20000, max_length=30, repeat=5):
+    """
+    Time padding a pass over a corpus with padded lists against the vectorized get_batches
+    :return: List of result dictionaries, one per batch size
+    """
+    import language_translation
+
+    random_state = np.random.RandomState(0)
+    lengths = random_state.randint(1, max_length + 1, size=num_lines)
+    tokens = random_state.randint(len(helper.CODES), 10000, size=int(lengths.sum())).astype(np.int32)
+    offsets = np.concatenate([[0], np.cumsum(lengths)]).astype(np.int64)
+    corpus = helper.IdCorpus(tokens, offsets)
+    sentences = list(corpus)
+
+    results = []
+    for batch_size in batch_sizes:
+        batch_count = num_lines // batch_size
+        list_seconds = time_call(lambda: [_list_get_batch(sentences, sentences, batch_i * batch_size, batch_size, 0, 0)
+                                          for batch_i in range(batch_count)], repeat)
+        vector_seconds = time_call(lambda: list(language_translation.get_batches(sentences, sentences,
+                                                                                 batch_size, 0, 0)), repeat)
+        corpus_seconds = time_call(lambda: list(language_translation.get_batches(corpus, corpus,
+                                                                                 batch_size, 0, 0)), repeat)
+        results.append({'batch_size': batch_size, 'batches': batch_count,
+                        'list_us_per_batch': list_seconds / batch_count * 1e6,
+                        'vectorized_us_per_batch': vector_seconds / batch_count * 1e6,
+                        'id_corpus_us_per_batch': corpus_seconds / batch_count * 1e6})
+
+    print('Padding {} sentences of up to {} words, microseconds per batch'.format(num_lines, max_length))
+    print('  {:>10} {:>12} {:>12} {:>12} {:>8}'.format('batch size', 'lists', 'vectorized', 'IdCorpus', 'speedup'))
+    for result in results:
+        print('  {:>10} {:>12.1f} {:>12.1f} {:>12.1f} {:>7.2f}x'.format(
+            result['batch_size'], result['list_us_per_batch'], result['vectorized_us_per_batch'],
+            result['id_corpus_us_per_batch'], result['list_us_per_batch'] / result['id_corpus_us_per_batch']))
+    return results
+
+
+def bench_codec(batch_sizes=(1, 32, 256, 1024), vocab_size=10000, max_length=20, sentences=20000, repeat=3):
+    """
+    Time encoding and decoding sentences with the batch SentenceEncoder and SentenceDecoder against
+    sentence_to_seq, pad_sentence_batch and a per sentence join
+    :return: List of result dictionaries, one per batch size
+    """
+    import language_translation
+
+    random_state = np.random.RandomState(0)
+    words = ['w{}'.format(word_i) for word_i in range(vocab_size)]
+    vocab_to_int = dict(helper.CODES)
+    vocab_to_int.update({word: word_i for word_i, word in enumerate(words, len(helper.CODES))})
+    int_to_vocab = {word_id: word for word, word_id in vocab_to_int.items()}
+    end_ids = (vocab_to_int['<EOS>'], vocab_to_int['<PAD>'])
+
+    lengths = random_state.randint(1, max_length + 1, size=sentences)
+    # a few unknown words per sentence
+    text = [' '.join(random_state.choice(words + ['unknown'], size=length)) for length in lengths]
+    predictions = random_state.randint(len(helper.CODES), len(vocab_to_int), size=(sentences, max_length))
+    predictions[np.arange(max_length) >= lengths[:, None]] = vocab_to_int['<EOS>']
+
+    encoder = language_translation.SentenceEncoder(vocab_to_int)
+    decoder = language_translation.SentenceDecoder(int_to_vocab)
+
+    def per_sentence_encode(batch_text):
+        ids = [language_translation.sentence_to_seq(sentence, vocab_to_int) for sentence in batch_text]
+        return np.array(language_translation.pad_sentence_batch(ids, vocab_to_int['<PAD>'])), [len(i) for i in ids]
+
+    def per_sentence_decode(batch_predictions):
+        translations = []
+        for row in batch_predictions:
+            row = list(row)
+            for end_i, word_id in enumerate(row):
+                if word_id in end_ids:
+                    row = row[:end_i]
+                    break
+            translations.append(' '.join([int_to_vocab[i] for i in row]))
+        return translations
+
+    def run_batches(function, data, batch_size):
+        return lambda: [function(data[start_i:start_i + batch_size]) for start_i in range(0, sentences, batch_size)]
+
+    results = []
+    for batch_size in batch_sizes:
+        results.append({
+            'batch_size': batch_size,
+            'encode_sentences_per_sec': sentences / time_call(run_batches(per_sentence_encode, text, batch_size), repeat),
+            'batch_encode_sentences_per_sec': sentences / time_call(run_batches(encoder.encode_batch, text, batch_size),
+                                                                    repeat),
+            'decode_sentences_per_sec': sentences / time_call(run_batches(per_sentence_decode, predictions, batch_size),
+                                                              repeat),
+            'batch_decode_sentences_per_sec': sentences / time_call(run_batches(decoder.decode_batch, predictions,
+                                                                                batch_size), repeat)})
+
+    print('Encoding and decoding {} sentences of up to {} words, sentences/sec'.format(sentences, max_length))
+    print('  {:>10} {:>14} {:>14} {:>14} {:>14}'.format('batch size', 'encode', 'batch encode', 'decode',
+                                                         'batch decode'))
+    for result in results:
+        print('  {:>10} {:>14.0f} {:>14.0f} {:>14.0f} {:>14.0f}'.format(
+            result['batch_size'], result['encode_sentences_per_sec'], result['batch_encode_sentences_per_sec'],
+            result['decode_sentences_per_sec'], result['batch_decode_sentences_per_sec']))
+    return results
+
+
+_IMPORT_TIME_SCRIPT = """
+import sys, time
+start = time.perf_counter()
+import {module}
+print(time.perf_counter() - start, 'tensorflow' in sys.modules)
+"""
+
+
+def bench_import_time(modules=('helper', 'problem_unittests', 'language_translation'), repeat=5, max_seconds=None):
+    """
+    Time importing each module in a fresh interpreter, which must not import TensorFlow or read the corpus
+    :param max_seconds: Exit with an error when an import takes longer than this
+    :return: List of result dictionaries, one per module
+    """
+    here = os.path.dirname(os.path.abspath(__file__))
+    results = []
+    for module in modules:
+        best = float('inf')
+        for _ in range(repeat):
+            output = subprocess.check_output([sys.executable, '-c', _IMPORT_TIME_SCRIPT.format(module=module)],
+                                             cwd=here, universal_newlines=True)
+            seconds, imported_tensorflow = output.split()[-2:]
+            best = min(best, float(seconds))
+        results.append({'module': module, 'seconds': best, 'imports_tensorflow': imported_tensorflow == 'True'})
+
+    print('Import time, best of {}'.format(repeat))
+    for result in results:
+        print('  {:<22} {:>8.1f} ms{}'.format(result['module'], result['seconds'] * 1000,
+                                            '  imports tensorflow' if result['imports_tensorflow'] else ''))
+
+    failures = [result['module'] for result in results
+                if result['imports_tensorflow'] or (max_seconds and result['seconds'] > max_seconds)]
+    if failures:
+        sys.exit('Slow or eager imports: {}'.format(', '.join(failures)))
+    return results
+
+
+def build_inference_graph(batch_size, source_vocab_size, target_vocab_size, rnn_size, num_layers,
+                          embedding_size, beam_width=0):
+    """
+    Build the script's model with random weights
+    :return: Tuple (graph, dictionary of the input placeholders)
+    """
+    import tensorflow as tf
+    import language_translation
+
+    target_vocab_to_int = dict(helper.CODES)
+    graph = tf.Graph()
+    with graph.as_default():
+        input_data, targets, lr, keep_prob, target_sequence_length, max_target_sequence_length, \
+            source_sequence_length = language_translation.model_inputs()
+        reversed_input = tf.reverse_sequence(input_data, source_sequence_length, seq_axis=1, batch_axis=0)
+        _, inference_logits = language_translation.seq2seq_model(
+            reversed_input, targets, keep_prob, batch_size, source_sequence_length, target_sequence_length,
+            max_target_sequence_length, source_vocab_size, target_vocab_size, embedding_size, embedding_size,
+            rnn_size, num_layers, target_vocab_to_int, beam_width)
+        tf.identity(inference_logits.sample_id, name='predictions')
+
+    return graph, {'input': input_data, 'targets': targets, 'lr': lr, 'keep_prob': keep_prob,
+                   'source_sequence_length': source_sequence_length,
+                   'target_sequence_length': target_sequence_length}
+
+
+def bench_towers(tower_counts=(1, 2, 4, 8), batch_size=256, steps=20, source_path='data/small_vocab_en',
+                 target_path='data/small_vocab_fr'):
+    """
+    Time training steps with the batch split across 1, 2, 4 and 8 towers
+    :param source_path: Corpus to train on, a synthetic one of the same vocabulary size is used when it is missing
+    :return: List of result dictionaries, one per tower count
+    """
+    import tensorflow as tf
+    import language_translation
+
+    directory = tempfile.mkdtemp()
+    try:
+        if not (os.path.exists(source_path) and os.path.exists(target_path)):
+            print('{} not found, using a synthetic corpus'.format(source_path))
+            source_path, target_path = make_synthetic_corpus(directory, 20000, vocab_size=300, max_length=17)
+        source_text = helper.load_data(source_path).lower()
+        target_text = helper.load_data(target_path).lower()
+    finally:
+        shutil.rmtree(directory)
+
+    source_vocab_to_int, _ = helper.create_lookup_tables(source_text)
+    target_vocab_to_int, _ = helper.create_lookup_tables(target_text)
+    source_int_text, target_int_text = language_translation.text_to_ids(source_text, target_text,
+                                                                        source_vocab_to_int, target_vocab_to_int)
+
+    results = []
+    for num_towers in tower_counts:
+        params = language_translation.default_params(batch_size=batch_size, num_towers=num_towers)
+        model = language_translation.build_train_graph(params, len(source_vocab_to_int), len(target_vocab_to_int),
+                                                       target_vocab_to_int)
+        batches = language_translation.get_bucketed_batches(source_int_text, target_int_text, batch_size,
+                                                            source_vocab_to_int['<PAD>'], target_vocab_to_int['<PAD>'],
+                                                            num_buckets=params.num_buckets, seed=0)
+        feed_dicts = [{model.input_data: source_batch, model.targets: target_batch, model.lr: params.learning_rate,
+                       model.source_sequence_length: source_lengths, model.target_sequence_length: target_lengths,
+                       model.keep_prob: params.keep_probability}
+                      for source_batch, target_batch, source_lengths, target_lengths in
+                      (next(batches) for _ in range(steps + 2))]
+
+        with tf.Session(graph=model.graph) as sess:
+            sess.run(tf.global_variables_initializer())
+            for feed_dict in feed_dicts[:2]:
+                sess.run(model.train_op, feed_dict)
+
+            start = time.perf_counter()
+            for feed_dict in feed_dicts[2:]:
+                sess.run(model.train_op, feed_dict)
+            seconds = time.perf_counter() - start
+
+        results.append({'towers': num_towers, 'step_ms': seconds / steps * 1000,
+                        'samples_per_sec': steps * batch_size / seconds})
+
+    print('Training {} steps of {} sentences on {} CPUs'.format(steps, batch_size, os.cpu_count()))
+    for result in results:
+        print('  towers {:>2}: {:>10.1f} ms/step {:>10.1f} samples/sec {:>6.2f}x'.format(
+            result['towers'], result['step_ms'], result['samples_per_sec'],
+            result['samples_per_sec'] / results[0]['samples_per_sec']))
+    return results
+
+
+def bench_beam_search(beam_widths=(1, 2, 4, 8), batch_size=256, vocab_size=300, rnn_size=256, num_layers=2,
+                      embedding_size=128, sentence_length=15, repeat=5):
+    """
+    Time greedy decoding against beam search at several beam widths
+    :return: List of result dictionaries, the first one for greedy decoding
+    """
+    import tensorflow as tf
+
+    random_state = np.random.RandomState(0)
+    source_batch = random_state.randint(len(helper.CODES), vocab_size, size=(batch_size, sentence_length))
+
+    results = []
+    for beam_width in (0,) + tuple(beam_widths):
+        graph, inputs = build_inference_graph(batch_size, vocab_size, vocab_size, rnn_size, num_layers,
+                                              embedding_size, beam_width)
+        with tf.Session(graph=graph) as sess:
+            sess.run(tf.global_variables_initializer())
+            predictions = graph.get_tensor_by_name('beam_predictions:0' if beam_width else 'predictions:0')
+            feed_dict = {inputs['input']: source_batch,
+                         inputs['source_sequence_length']: [sentence_length] * batch_size,
+                         inputs['target_sequence_length']: [sentence_length * 2] * batch_size,
+                         inputs['keep_prob']: 1.0}
+
+            sess.run(predictions, feed_dict)
+            seconds = time_call(lambda: sess.run(predictions, feed_dict), repeat)
+
+        results.append({'mode': 'beam' if beam_width else 'greedy', 'beam_width': beam_width or 1,
+                        'batch_latency_ms': seconds * 1000, 'sentences_per_sec': batch_size / seconds})
+
+    print('Decoding batches of {} sentences of {} words, rnn_size {}, {} layers'.format(
+        batch_size, sentence_length, rnn_size, num_layers))
+    for result in results:
+        print('  {:>6} width {:>2}: {:>10.1f} ms/batch {:>10.1f} sentences/sec {:>6.2f}x greedy latency'.format(
+            result['mode'], result['beam_width'], result['batch_latency_ms'], result['sentences_per_sec'],
+            result['batch_latency_ms'] / results[0]['batch_latency_ms']))
+    return results
+
+
+def bench_cell_backends(backends=('lstm', 'block', 'fused'), batch_size=256, rnn_size=None, num_layers=None,
+                        embedding_size=None, sentence_length=20, repeat=5):
+    """
+    Time the forward and backward pass of each LSTM layer with each cell backend, the sizes default to the
+    script's params
+    :return: List of result dictionaries, one per backend and layer
+    """
+    import tensorflow as tf
+    import language_translation
+
+    params = language_translation.default_params()
+    rnn_size = rnn_size or params.rnn_size
+    num_layers = num_layers or params.num_layers
+    embedding_size = embedding_size or params.encoding_embedding_size
+
+    random_state = np.random.RandomState(0)
+    embedded = random_state.uniform(-1.0, 1.0, size=(batch_size, sentence_length, embedding_size))
+    lengths = random_state.randint(sentence_length // 2, sentence_length + 1, size=batch_size)
+
+    results = []
+    for cell_backend in backends:
+        graph = tf.Graph()
+        with graph.as_default():
+            inputs = tf.placeholder(tf.float32, [batch_size, sentence_length, embedding_size])
+            sequence_length = tf.placeholder(tf.int32, [batch_size])
+            layers = []
+            layer_input = inputs
+            for layer_i in range(num_layers):
+                scope = 'layer_{}'.format(layer_i)
+                with tf.variable_scope(scope):
+                    if cell_backend == 'fused':
+                        outputs, _ = tf.contrib.rnn.LSTMBlockFusedCell(rnn_size)(
+                            tf.transpose(layer_input, [1, 0, 2]), dtype=tf.float32, sequence_length=sequence_length)
+                        outputs = tf.transpose(outputs, [1, 0, 2])
+                    else:
+                        outputs, _ = tf.nn.dynamic_rnn(language_translation.make_lstm_cell(rnn_size, cell_backend),
+                                                       layer_input, sequence_length, dtype=tf.float32)
+                variables = tf.get_collection(tf.GraphKeys.TRAINABLE_VARIABLES, scope=scope + '/')
+                layers.append((layer_input, outputs, tf.gradients(outputs, [layer_input] + variables)))
+                layer_input = outputs
+
+        with tf.Session(graph=graph) as sess:
+            sess.run(tf.global_variables_initializer())
+            # each layer runs on its own, fed the output the layer below it computed
+            layer_value = embedded
+            for layer_i, (layer_input, outputs, gradients) in enumerate(layers):
+                feed_dict = {layer_input: layer_value, sequence_length: lengths}
+                sess.run(gradients, feed_dict)
+                forward_seconds = time_call(lambda: sess.run(outputs, feed_dict), repeat)
+                total_seconds = time_call(lambda: sess.run(gradients, feed_dict), repeat)
+                layer_value = sess.run(outputs, feed_dict)
+                results.append({'backend': cell_backend, 'layer': layer_i, 'forward_ms': forward_seconds * 1000,
+                                'backward_ms': max(total_seconds - forward_seconds, 0.0) * 1000})
+
+    print('LSTM layers of {} units on batches of {} sentences of up to {} words'.format(
+        rnn_size, batch_size, sentence_length))
+    print('  {:>8} {:>6} {:>12} {:>12} {:>10}'.format('backend', 'layer', 'forward ms', 'backward ms', 'vs lstm'))
+    baseline = {result['layer']: result for result in results if result['backend'] == backends[0]}
+    for result in results:
+        base = baseline[result['layer']]
+        print('  {:>8} {:>6} {:>12.1f} {:>12.1f} {:>9.2f}x'.format(
+            result['backend'], result['layer'], result['forward_ms'], result['backward_ms'],
+            (base['forward_ms'] + base['backward_ms']) / (result['forward_ms'] + result['backward_ms'])))
+    return results
+
+
+def _sampled_softmax_steps(vocab_size, num_sampled, batch_size, sentence_length, steps):
+    # runs in its own process so the peak memory of one configuration doesn't hide the next one's
+    import resource
+    import tensorflow as tf
+    import language_translation
+
+    target_vocab_to_int = dict(helper.CODES)
+    params = language_translation.default_params(batch_size=batch_size, num_sampled=num_sampled)
+    model = language_translation.build_train_graph(params, vocab_size, vocab_size, target_vocab_to_int)
+
+    random_state = np.random.RandomState(0)
+    lengths = [sentence_length] * batch_size
+    shape = (batch_size, sentence_length)
+    feed_dicts = [{model.input_data: random_state.randint(len(helper.CODES), vocab_size, size=shape),
+                   model.targets: random_state.randint(len(helper.CODES), vocab_size, size=shape),
+                   model.lr: params.learning_rate, model.keep_prob: params.keep_probability,
+                   model.source_sequence_length: lengths, model.target_sequence_length: lengths}
+                  for _ in range(steps + 1)]
+
+    with tf.Session(graph=model.graph) as sess:
+        sess.run(tf.global_variables_initializer())
+        baseline_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        sess.run(model.train_op, feed_dicts[0])
+
+        start = time.perf_counter()
+        for feed_dict in feed_dicts[1:]:
+            sess.run(model.train_op, feed_dict)
+        seconds = time.perf_counter() - start
+        peak_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    return {'vocab_size': vocab_size, 'num_sampled': num_sampled, 'step_ms': seconds / steps * 1000,
+            'peak_mb': peak_kb / 1024, 'step_peak_mb': (peak_kb - baseline_kb) / 1024}
+
+
+def bench_sampled_softmax(vocab_sizes=(1000, 10000, 50000), num_sampled=512, batch_size=128, sentence_length=20,
+                          steps=10):
+    """
+    Time training steps and measure peak memory with the full softmax against the sampled softmax loss
+    :param vocab_sizes: Target vocabulary sizes, the source vocabulary is the same size
+    :param num_sampled: Words sampled per target word
+    :return: List of result dictionaries, the full softmax and the sampled one for each vocabulary size
+    """
+    # a fresh interpreter per configuration, peak resident memory only ever grows within a process
+    context = multiprocessing.get_context('spawn')
+    results = []
+    for vocab_size in vocab_sizes:
+        for sampled in (0, num_sampled):
+            pool = context.Pool(1)
+            try:
+                results.append(pool.apply(_sampled_softmax_steps,
+                                          (vocab_size, sampled, batch_size, sentence_length, steps)))
+            finally:
+                pool.close()
+                pool.join()
+
+    print('Training {} steps of {} sentences of {} words, peak memory is the growth over the initialized model'.format(
+        steps, batch_size, sentence_length))
+    print('  {:>10} {:>10} {:>10} {:>14} {:>12}'.format('vocab', 'sampled', 'ms/step', 'step peak MB', 'peak MB'))
+    for result in results:
+        print('  {:>10} {:>10} {:>10.1f} {:>14.1f} {:>12.1f}'.format(
+            result['vocab_size'], result['num_sampled'] or 'full', result['step_ms'], result['step_peak_mb'],
+            result['peak_mb']))
+    return results
+
+
+def _random_numpy_weights(path, vocab_size, embedding_size, rnn_size, num_layers, random_state):
+    # the arrays export_weights writes, for a model of the given size
+    weights = {'reverse_within_lengths': np.array(True)}
+    for prefix in ('encoder', 'decoder'):
+        weights[prefix + '_embeddings'] = random_state.uniform(-1.0, 1.0, (vocab_size, embedding_size))
+        for layer_i in range(num_layers):
+            input_size = embedding_size if layer_i == 0 else rnn_size
+            weights['{}_kernel_{}'.format(prefix, layer_i)] = random_state.uniform(
+                -0.1, 0.1, (input_size + rnn_size, 4 * rnn_size))
+            weights['{}_bias_{}'.format(prefix, layer_i)] = np.zeros(4 * rnn_size)
+    weights['output_kernel'] = random_state.uniform(-0.1, 0.1, (rnn_size, vocab_size))
+    # random weights would end sentences at random steps
+    weights['output_bias'] = np.zeros(vocab_size)
+    weights['output_bias'][helper.CODES['<EOS>']] = -1e9
+    np.savez(path, **{name: array.astype(np.float32) if array.dtype == np.float64 else array
+                      for name, array in weights.items()})
+
+
+def bench_quantized_step(batch_sizes=(1, 32, 256), rnn_size=256, num_layers=2, vocab_size=10000, embedding_size=256,
+                         sentence_length=20, repeat=3):
+    """
+    Time greedy decoding with numpy_inference.NumpySeq2Seq loaded from float32 and from int8 weights
+    :param batch_sizes: Sentences decoded at once
+    :param vocab_size: Source and target vocabulary size, the width of the output projection
+    :param sentence_length: Words in each source sentence and decoded steps per translation
+    :return: List of result dictionaries, the float32 and the int8 weights for each batch size
+    """
+    import numpy_inference
+
+    random_state = np.random.RandomState(0)
+    directory = tempfile.mkdtemp()
+    try:
+        paths = {'float32': os.path.join(directory, 'model.npz'), 'int8': os.path.join(directory, 'model-int8.npz')}
+        _random_numpy_weights(paths['float32'], vocab_size, embedding_size, rnn_size, num_layers, random_state)
+        numpy_inference.quantize_weights(paths['int8'], paths['float32'])
+
+        results = []
+        for weights, path in sorted(paths.items()):
+            load_seconds = time_call(lambda: numpy_inference.NumpySeq2Seq(path), repeat)
+            model = numpy_inference.NumpySeq2Seq(path)
+            for batch_size in batch_sizes:
+                source_batch = random_state.randint(len(helper.CODES), vocab_size, size=(batch_size, sentence_length))
+                lengths = [sentence_length] * batch_size
+                seconds = time_call(lambda: model.predict(source_batch, lengths, lengths), repeat)
+                results.append({'batch_size': batch_size, 'weights': weights, 'file_bytes': os.path.getsize(path),
+                                'weight_bytes': model.weight_bytes(), 'load_ms': load_seconds * 1000,
+                                'step_ms': seconds / sentence_length * 1000})
+    finally:
+        shutil.rmtree(directory)
+
+    print('Greedy decoding of {} word sentences, {} LSTM layers of {} units and a {} word vocabulary'.format(
+        sentence_length, num_layers, rnn_size, vocab_size))
+    print('  {:>6} {:>8} {:>12} {:>14} {:>9} {:>10} {:>11}'.format(
+        'batch', 'weights', 'file bytes', 'weight bytes', 'load ms', 'ms/step', 'vs float32'))
+    baseline = {result['batch_size']: result for result in results if result['weights'] == 'float32'}
+    for result in sorted(results, key=lambda result: (result['batch_size'], result['weights'])):
+        print('  {:>6} {:>8} {:>12} {:>14} {:>9.1f} {:>10.3f} {:>10.2f}x'.format(
+            result['batch_size'], result['weights'], result['file_bytes'], result['weight_bytes'],
+            result['load_ms'], result['step_ms'], baseline[result['batch_size']]['step_ms'] / result['step_ms']))
+    return results
+
+
+def machine_metadata():
+    """
+    :return: Dictionary describing the machine, interpreter, library versions and commit the suite ran on
+    """
+    here = os.path.dirname(os.path.abspath(__file__))
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=here, stderr=subprocess.DEVNULL,
+                                         universal_newlines=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    metadata = {'time': datetime.datetime.utcnow().isoformat() + 'Z',
+                'platform': platform.platform(),
+                'machine': platform.machine(),
+                'processor': platform.processor(),
+                'cpu_count': os.cpu_count(),
+                'python': platform.python_version(),
+                'numpy': np.__version__,
+                'commit': commit}
+    if 'tensorflow' in sys.modules:
+        metadata['tensorflow'] = sys.modules['tensorflow'].__version__
+    return metadata
+
+
+def _latency_percentiles(seconds, prefix):
+    milliseconds = np.array(seconds) * 1000
+    return {prefix + '_ms_p50': float(np.percentile(milliseconds, 50)),
+            prefix + '_ms_p90': float(np.percentile(milliseconds, 90))}
+
+
+def run_suite(output_path, num_lines=20000, vocab_size=1000, max_length=20, batch_size=128, train_steps=10,
+              translate_repeat=20, repeat=3, tensorflow=True):
+    """
+    Measure the hot paths on a synthetic corpus and write the results with the machine and config as JSON
+    :param output_path: JSON file to write
+    :param num_lines: Sentence pairs of the synthetic corpus
+    :param vocab_size: Distinct words per side of the synthetic corpus
+    :param max_length: Longest sentence of the synthetic corpus
+    :param batch_size: Batch size of get_batches, the training steps and the translations
+    :param train_steps: Training steps timed after two warm up steps
+    :param translate_repeat: Translations timed per batch size
+    :param repeat: Calls of the preprocessing and batching functions, the best one counts
+    :param tensorflow: False to leave out the training step and translation sections
+    :return: Dictionary written to output_path
+    """
+    import language_translation
+
+    config = {'lines': num_lines, 'vocab_size': vocab_size, 'max_length': max_length, 'batch_size': batch_size,
+              'train_steps': train_steps, 'translate_repeat': translate_repeat, 'repeat': repeat,
+              'tensorflow': tensorflow}
+    results = {}
+    directory = tempfile.mkdtemp()
+    working_directory = os.getcwd()
+    try:
+        source_path, target_path = make_synthetic_corpus(directory, num_lines, vocab_size, max_length)
+        corpus_bytes = os.path.getsize(source_path) + os.path.getsize(target_path)
+
+        seconds = time_call(lambda: (helper.load_data(source_path), helper.load_data(target_path)), repeat)
+        results['load_data_mb_per_sec'] = corpus_bytes / seconds / 1e6
+        source_text = helper.load_data(source_path)
+        target_text = helper.load_data(target_path)
+
+        words = len(source_text.split()) + len(target_text.split())
+        seconds = time_call(lambda: (helper.create_lookup_tables(source_text),
+                                     helper.create_lookup_tables(target_text)), repeat)
+        results['create_lookup_tables_words_per_sec'] = words / seconds
+        source_vocab_to_int, _ = helper.create_lookup_tables(source_text)
+        target_vocab_to_int, _ = helper.create_lookup_tables(target_text)
+
+        seconds = time_call(lambda: language_translation.text_to_ids(source_text, target_text, source_vocab_to_int,
+                                                                      target_vocab_to_int), repeat)
+        results['text_to_ids_lines_per_sec'] = num_lines / seconds
+        source_int_text, target_int_text = language_translation.text_to_ids(source_text, target_text,
+                                                                            source_vocab_to_int, target_vocab_to_int)
+
+        def all_batches():
+            return list(language_translation.get_batches(source_int_text, target_int_text, batch_size,
+                                                         source_vocab_to_int['<PAD>'], target_vocab_to_int['<PAD>']))
+        batches = all_batches()
+        results['get_batches_batches_per_sec'] = len(batches) / time_call(all_batches, repeat)
+
+        if tensorflow:
+            import tensorflow as tf
+
+            # Translator reads the vocabularies from the working directory's preprocess folder
+            os.chdir(directory)
+            os.makedirs(helper.PREPROCESS_DIR)
+            helper.save_vocab(source_vocab_to_int, target_vocab_to_int)
+
+            params = language_translation.default_params(batch_size=batch_size)
+            model = language_translation.build_train_graph(params, len(source_vocab_to_int),
+                                                           len(target_vocab_to_int), target_vocab_to_int)
+            feed_dicts = [{model.input_data: source_batch, model.targets: target_batch,
+                           model.lr: params.learning_rate, model.keep_prob: params.keep_probability,
+                           model.source_sequence_length: source_lengths,
+                           model.target_sequence_length: target_lengths}
+                          for source_batch, target_batch, source_lengths, target_lengths in
+                          (batches[step % len(batches)] for step in range(train_steps + 2))]
+            checkpoint_path = os.path.join(directory, 'checkpoint', 'dev')
+            with tf.Session(graph=model.graph) as sess:
+                sess.run(tf.global_variables_initializer())
+                for feed_dict in feed_dicts[:2]:
+                    sess.run(model.train_op, feed_dict)
+                start = time.perf_counter()
+                for feed_dict in feed_dicts[2:]:
+                    sess.run(model.train_op, feed_dict)
+                seconds = time.perf_counter() - start
+                with model.graph.as_default():
+                    tf.train.Saver().save(sess, checkpoint_path)
+            results['train_steps_per_sec'] = train_steps / seconds
+
+            start = time.perf_counter()
+            translator = language_translation.Translator(checkpoint_path, batch_size)
+            results['translate_load_seconds'] = time.perf_counter() - start
+            try:
+                sentences = [source_int_text[i] for i in range(batch_size)]
+                translator.translate_batch(sentences)
+                for name, batch in (('translate_sentence', sentences[:1]), ('translate_batch', sentences)):
+                    latencies = []
+                    for _ in range(translate_repeat):
+                        start = time.perf_counter()
+                        translator.translate_batch(batch)
+                        latencies.append(time.perf_counter() - start)
+                    results.update(_latency_percentiles(latencies, name))
+            finally:
+                translator.close()
+    finally:
+        os.chdir(working_directory)
+        shutil.rmtree(directory)
+
+    report = {'metadata': machine_metadata(), 'config': config, 'results': results}
+    with open(output_path, 'w', encoding='utf-8') as out_file:
+        json.dump(report, out_file, indent=2, sort_keys=True)
+
+    print('Benchmark suite on {} lines, vocabulary of {} words, batches of {}'.format(num_lines, vocab_size,
+                                                                                       batch_size))
+    for name, value in sorted(results.items()):
+        print('  {:<36} {:>14.3f}'.format(name, value))
+    print('Wrote {}'.format(output_path))
+    return report
+
+
+def higher_is_better(metric):
+    """
+    :return: True for throughputs, named ..._per_sec, False for times and latencies
+    """
+    return metric.endswith('_per_sec')
+
+
+def compare_results(base_path, new_path, threshold=0.1):
+    """
+    Compare two run_suite result files metric by metric
+    :param base_path: Results to compare against
+    :param new_path: Results of the change
+    :param threshold: Relative change past which a slower metric is a regression
+    :return: List of the regressed metric names
+    """
+    with open(base_path, 'r', encoding='utf-8') as in_file:
+        base = json.load(in_file)
+    with open(new_path, 'r', encoding='utf-8') as in_file:
+        new = json.load(in_file)
+
+    for section in ('config', 'metadata'):
+        differences = sorted(key for key in ('lines', 'vocab_size', 'max_length', 'batch_size', 'train_steps',
+                                             'platform', 'processor', 'cpu_count', 'python', 'numpy', 'tensorflow')
+                             if key in base[section] or key in new[section]
+                             if base[section].get(key) != new[section].get(key))
+        for key in differences:
+            print('Warning: {} {} differs, {} against {}'.format(section, key, base[section].get(key),
+                                                                 new[section].get(key)))
+
+    regressions = []
+    print('  {:<36} {:>14} {:>14} {:>9}'.format('metric', 'base', 'new', 'change'))
+    for metric in sorted(set(base['results']) & set(new['results'])):
+        base_value = base['results'][metric]
+        new_value = new['results'][metric]
+        change = new_value / base_value - 1.0 if base_value else 0.0
+        # a positive slowdown is worse whichever way the metric points
+        slowdown = -change if higher_is_better(metric) else change
+        regressed = slowdown > threshold
+        if regressed:
+            regressions.append(metric)
+        print('  {:<36} {:>14.3f} {:>14.3f} {:>+8.1%}{}'.format(metric, base_value, new_value, change,
+                                                                 '  REGRESSION' if regressed else ''))
+    for metric in sorted(set(base['results']) ^ set(new['results'])):
+        print('  {:<36} only in {}'.format(metric, base_path if metric in base['results'] else new_path))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks for the translator')
+    subparsers = parser.add_subparsers(dest='benchmark')
+
+    preprocess_parser = subparsers.add_parser('parallel-preprocess',
+                                              help='Scaling of parallel preprocessing over worker processes')
+    preprocess_parser.add_argument('--lines', type=int, default=200000)
+    preprocess_parser.add_argument('--vocab', type=int, default=20000)
+    preprocess_parser.add_argument('--max-workers', type=int, default=None)
+    preprocess_parser.add_argument('--repeat', type=int, default=1)
+
+    beam_parser = subparsers.add_parser('beam-search', help='Latency and throughput of each beam width')
+    beam_parser.add_argument('--beam-widths', type=int, nargs='+', default=[1, 2, 4, 8])
+    beam_parser.add_argument('--batch-size', type=int, default=256)
+    beam_parser.add_argument('--vocab', type=int, default=300)
+    beam_parser.add_argument('--rnn-size', type=int, default=256)
+    beam_parser.add_argument('--num-layers', type=int, default=2)
+    beam_parser.add_argument('--sentence-length', type=int, default=15)
+    beam_parser.add_argument('--repeat', type=int, default=5)
+
+    towers_parser = subparsers.add_parser('towers', help='Training throughput with the batch split across towers')
+    towers_parser.add_argument('--towers', type=int, nargs='+', default=[1, 2, 4, 8])
+    towers_parser.add_argument('--batch-size', type=int, default=256)
+    towers_parser.add_argument('--steps', type=int, default=20)
+
+    padding_parser = subparsers.add_parser('padding', help='Padded lists against vectorized batch padding')
+    padding_parser.add_argument('--batch-sizes', type=int, nargs='+', default=[32, 128, 512, 2048])
+    padding_parser.add_argument('--lines', type=int, default=20000)
+    padding_parser.add_argument('--max-length', type=int, default=30)
+    padding_parser.add_argument('--repeat', type=int, default=5)
+
+    codec_parser = subparsers.add_parser('codec', help='Batch sentence encoding and decoding against per sentence')
+    codec_parser.add_argument('--batch-sizes', type=int, nargs='+', default=[1, 32, 256, 1024])
+    codec_parser.add_argument('--vocab', type=int, default=10000)
+    codec_parser.add_argument('--sentences', type=int, default=20000)
+    codec_parser.add_argument('--repeat', type=int, default=3)
+
+    cells_parser = subparsers.add_parser('cell-backends',
+                                         help='Forward and backward time per LSTM layer of each cell backend')
+    cells_parser.add_argument('--backends', nargs='+', default=['lstm', 'block', 'fused'])
+    cells_parser.add_argument('--batch-size', type=int, default=256)
+    cells_parser.add_argument('--rnn-size', type=int, default=None)
+    cells_parser.add_argument('--num-layers', type=int, default=None)
+    cells_parser.add_argument('--sentence-length', type=int, default=20)
+    cells_parser.add_argument('--repeat', type=int, default=5)
+
+    sampled_parser = subparsers.add_parser('sampled-softmax',
+                                           help='Step time and peak memory of the full against the sampled softmax')
+    sampled_parser.add_argument('--vocab-sizes', type=int, nargs='+', default=[1000, 10000, 50000])
+    sampled_parser.add_argument('--num-sampled', type=int, default=512)
+    sampled_parser.add_argument('--batch-size', type=int, default=128)
+    sampled_parser.add_argument('--sentence-length', type=int, default=20)
+    sampled_parser.add_argument('--steps', type=int, default=10)
+
+    quantized_parser = subparsers.add_parser('quantized-step',
+                                             help='NumPy decoder step time with float32 against int8 weights')
+    quantized_parser.add_argument('--batch-sizes', type=int, nargs='+', default=[1, 32, 256])
+    quantized_parser.add_argument('--rnn-size', type=int, default=256)
+    quantized_parser.add_argument('--num-layers', type=int, default=2)
+    quantized_parser.add_argument('--vocab', type=int, default=10000)
+    quantized_parser.add_argument('--embedding-size', type=int, default=256)
+    quantized_parser.add_argument('--sentence-length', type=int, default=20)
+    quantized_parser.add_argument('--repeat', type=int, default=3)
+
+    suite_parser = subparsers.add_parser('suite', help='Preprocessing, batching, training step and translation '
+                                                       'throughput, written as JSON')
+    suite_parser.add_argument('--output', default='benchmark_results.json', help='JSON file to write')
+    suite_parser.add_argument('--lines', type=int, default=20000)
+    suite_parser.add_argument('--vocab', type=int, default=1000)
+    suite_parser.add_argument('--max-length', type=int, default=20)
+    suite_parser.add_argument('--batch-size', type=int, default=128)
+    suite_parser.add_argument('--train-steps', type=int, default=10)
+    suite_parser.add_argument('--translate-repeat', type=int, default=20)
+    suite_parser.add_argument('--repeat', type=int, default=3)
+    suite_parser.add_argument('--no-tensorflow', dest='tensorflow', action='store_false',
+                              help='Leave out the training step and translation sections')
+
+    compare_parser = subparsers.add_parser('compare', help='Flag regressions between two suite result files')
+    compare_parser.add_argument('base', help='Results to compare against')
+    compare_parser.add_argument('new', help='Results of the change')
+    compare_parser.add_argument('--threshold', type=float, default=0.1,
+                                help='Relative slowdown that counts as a regression')
+
+    import_parser = subparsers.add_parser('import-time',
+                                          help='Startup cost of importing the modules, fails if TensorFlow is imported')
+    import_parser.add_argument('--repeat', type=int, default=5)
+    import_parser.add_argument('--max-seconds', type=float, default=None,
+                               help='Fail when an import takes longer than this')
+
+    args = parser.parse_args()
+    if args.benchmark == 'parallel-preprocess':
+        bench_parallel_preprocess(args.lines, args.vocab, args.max_workers, args.repeat)
+    elif args.benchmark == 'beam-search':
+        bench_beam_search(args.beam_widths, args.batch_size, args.vocab, args.rnn_size, args.num_layers,
+                          sentence_length=args.sentence_length, repeat=args.repeat)
+    elif args.benchmark == 'towers':
+        bench_towers(args.towers, args.batch_size, args.steps)
+    elif args.benchmark == 'padding':
+        bench_padding(args.batch_sizes, args.lines, args.max_length, args.repeat)
+    elif args.benchmark == 'codec':
+        bench_codec(args.batch_sizes, args.vocab, sentences=args.sentences, repeat=args.repeat)
+    elif args.benchmark == 'cell-backends':
+        bench_cell_backends(args.backends, args.batch_size, args.rnn_size, args.num_layers,
+                            sentence_length=args.sentence_length, repeat=args.repeat)
+    elif args.benchmark == 'sampled-softmax':
+        bench_sampled_softmax(args.vocab_sizes, args.num_sampled, args.batch_size, args.sentence_length, args.steps)
+    elif args.benchmark == 'quantized-step':
+        bench_quantized_step(args.batch_sizes, args.rnn_size, args.num_layers, args.vocab, args.embedding_size,
+                             args.sentence_length, args.repeat)
+    elif args.benchmark == 'suite':
+        run_suite(args.output, args.lines, args.vocab, args.max_length, args.batch_size, args.train_steps,
+                  args.translate_repeat, args.repeat, args.tensorflow)
+    elif args.benchmark == 'compare':
+        regressions = compare_results(args.base, args.new, args.threshold)
+        if regressions:
+            sys.exit('Regressions: {}'.format(', '.join(regressions)))
+    elif args.benchmark == 'import-time':
+        bench_import_time(repeat=args.repeat, max_seconds=args.max_seconds)
+    else:
+        parser.print_help()
+
+
+if __name__ == '__main__':
+    main()
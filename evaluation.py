@@ -0,0 +1,168 @@
+import argparse
+import collections
+import math
+import multiprocessing
+import os
+import time
+
+import numpy as np
+
+import helper
+
+
+def ngram_statistics(reference, hypothesis, max_order=4):
+    """
+    Count the clipped n-gram matches of one translation against its reference
+    :param reference: List of reference word ids
+    :param hypothesis: List of translated word ids
+    :param max_order: Longest n-gram counted
+    :return: int64 array of max_order matches, max_order hypothesis n-gram counts, hypothesis length
+             and reference length, which add up over a corpus
+    """
+    statistics = np.zeros(2 * max_order + 2, dtype=np.int64)
+    for order in range(1, max_order + 1):
+        reference_ngrams = collections.Counter(tuple(reference[i:i + order])
+                                               for i in range(len(reference) - order + 1))
+        hypothesis_ngrams = collections.Counter(tuple(hypothesis[i:i + order])
+                                                for i in range(len(hypothesis) - order + 1))
+        statistics[order - 1] = sum((hypothesis_ngrams & reference_ngrams).values())
+        statistics[max_order + order - 1] = max(len(hypothesis) - order + 1, 0)
+    statistics[-2] = len(hypothesis)
+    statistics[-1] = len(reference)
+    return statistics
+
+
+def _chunk_statistics(chunk):
+    references, hypotheses, max_order = chunk
+    statistics = np.zeros(2 * max_order + 2, dtype=np.int64)
+    for reference, hypothesis in zip(references, hypotheses):
+        statistics += ngram_statistics(reference, hypothesis, max_order)
+    return statistics
+
+
+def corpus_bleu(references, hypotheses, max_order=4, workers=1, chunk_size=10000):
+    """
+    Calculate corpus level BLEU, the n-gram statistics of all sentences are added up before taking precisions
+    :param references: List of reference sentences, each a list of word ids or words
+    :param hypotheses: List of translated sentences, each a list of word ids or words
+    :param max_order: Longest n-gram counted
+    :param workers: Number of processes counting n-grams
+    :param chunk_size: Number of sentences per process task
+    :return: BLEU between 0 and 1
+    """
+    if len(references) != len(hypotheses):
+        raise ValueError('Got {} references for {} translations'.format(len(references), len(hypotheses)))
+
+    chunks = [(references[start_i:start_i + chunk_size], hypotheses[start_i:start_i + chunk_size], max_order)
+              for start_i in range(0, len(references), chunk_size)]
+    if workers > 1 and len(chunks) > 1:
+        pool = multiprocessing.Pool(min(workers, len(chunks)))
+        try:
+            chunk_statistics = pool.map(_chunk_statistics, chunks)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        chunk_statistics = [_chunk_statistics(chunk) for chunk in chunks]
+    statistics = np.sum(chunk_statistics, axis=0) if chunk_statistics else np.zeros(2 * max_order + 2)
+
+    matches = statistics[:max_order]
+    totals = statistics[max_order:2 * max_order]
+    hypothesis_length, reference_length = statistics[-2], statistics[-1]
+    if not hypothesis_length or np.any(matches == 0):
+        return 0.0
+
+    log_precision = np.mean(np.log(matches / totals))
+    brevity_penalty = min(1.0 - reference_length / hypothesis_length, 0.0)
+    return float(math.exp(log_precision + brevity_penalty))
+
+
+def token_accuracy(references, hypotheses):
+    """
+    Fraction of reference words that the translation has at the same position
+    """
+    matches = 0
+    tokens = 0
+    for reference, hypothesis in zip(references, hypotheses):
+        matches += sum(1 for reference_id, hypothesis_id in zip(reference, hypothesis) if reference_id == hypothesis_id)
+        tokens += len(reference)
+    return matches / tokens if tokens else 0.0
+
+
+def decode_corpus(translator, sentences):
+    """
+    Translate sentence ids in full batches, sentences of similar length batched together
+    :param translator: language_translation.Translator
+    :param sentences: List or IdCorpus of source word id lists
+    :return: List of translated word id lists in input order, cut at <EOS>
+    """
+    lengths = helper.sentence_lengths(sentences)
+    order = np.argsort(lengths, kind='mergesort')
+    translations = [None] * len(order)
+    for start_i in range(0, len(order), translator.batch_size):
+        batch_order = order[start_i:start_i + translator.batch_size]
+        for i, sentence_ids in zip(batch_order, translator.translate_batch([sentences[i] for i in batch_order])):
+            translations[i] = sentence_ids
+    return translations
+
+
+def evaluate_translator(translator, sources, targets, workers=1):
+    """
+    Translate a held-out set and score it
+    :param translator: language_translation.Translator
+    :param sources: Source sentence ids
+    :param targets: Target sentence ids, ending with <EOS>
+    :param workers: Number of processes scoring BLEU
+    :return: Dictionary of BLEU, token accuracy and decoding speed
+    """
+    eos = translator.target_vocab_to_int['<EOS>']
+    references = [[word_id for word_id in target if word_id != eos] for target in targets]
+
+    start = time.perf_counter()
+    hypotheses = decode_corpus(translator, sources)
+    decode_seconds = time.perf_counter() - start
+
+    return {'sentences': len(references),
+            'bleu': corpus_bleu(references, hypotheses, workers=workers),
+            'token_accuracy': token_accuracy(references, hypotheses),
+            'decode_seconds': decode_seconds,
+            'sentences_per_sec': len(references) / decode_seconds if decode_seconds else 0.0}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Score checkpoints on the held-out validation sentences')
+    parser.add_argument('load_paths', nargs='*',
+                        help='Checkpoints or frozen .pb graphs to compare, defaults to the one in params.p')
+    parser.add_argument('--batch-size', type=int, default=256, help='Batch size the models were built with')
+    parser.add_argument('--valid-batches', type=int, default=1,
+                        help='Batches of sentences held out for validation, as given to training')
+    parser.add_argument('--mode', choices=['greedy', 'beam'], default='greedy', help='Decoding mode')
+    parser.add_argument('--length-penalty', type=float, default=0.0, help='Length penalty weight for beam search')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1, help='Processes scoring BLEU')
+    args = parser.parse_args()
+
+    import language_translation
+
+    (source_int_text, target_int_text), _, _ = helper.load_preprocess_binary()
+    params = language_translation.default_params(batch_size=args.batch_size, valid_batches=args.valid_batches)
+    _, _, valid_source, valid_target = language_translation.split_validation(source_int_text, target_int_text,
+                                                                              params)
+
+    results = []
+    for load_path in args.load_paths or [helper.load_params()]:
+        translator = language_translation.open_translator(load_path, args.batch_size, args.mode, args.length_penalty)
+        try:
+            results.append((load_path, evaluate_translator(translator, valid_source, valid_target, args.workers)))
+        finally:
+            translator.close()
+
+    print('{} held-out sentences, {} decoding'.format(len(valid_source), args.mode))
+    print('  {:<40} {:>8} {:>9} {:>10} {:>14}'.format('model', 'BLEU', 'accuracy', 'decode s', 'sentences/sec'))
+    for load_path, result in results:
+        print('  {:<40} {:>8.2f} {:>9.4f} {:>10.2f} {:>14.1f}'.format(
+            load_path, result['bleu'] * 100, result['token_accuracy'], result['decode_seconds'],
+            result['sentences_per_sec']))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,25 @@
+import argparse
+import glob
+import os
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Export a checkpoint to a frozen, inference only graph')
+    parser.add_argument('export_path', help='Path of the .pb file to write')
+    parser.add_argument('--load-path', default=None, help='Checkpoint path, defaults to the one in params.p')
+    args = parser.parse_args()
+
+    import helper
+    import language_translation
+
+    load_path = args.load_path or helper.load_params()
+    output_names = language_translation.export_inference_graph(args.export_path, load_path)
+
+    checkpoint_size = sum(os.path.getsize(path) for path in glob.glob(load_path + '.*'))
+    print('Exported {} to {}'.format(', '.join(output_names), args.export_path))
+    print('  checkpoint:   {:>12} bytes'.format(checkpoint_size))
+    print('  frozen graph: {:>12} bytes'.format(os.path.getsize(args.export_path)))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,10 +1,30 @@
 import os
+import json
 import pickle
 import copy
+import itertools
+import collections
+import importlib
 import numpy as np
 
 
 CODES = {'<PAD>': 0, '<EOS>': 1, '<UNK>': 2, '<GO>': 3 }
+PREPROCESS_DIR = 'preprocess'
+
+
+class LazyModule(object):
+    """
+    Stand-in for a module that is imported the first time one of its attributes is used
+    """
+
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+
+    def __getattr__(self, attribute):
+        if self._module is None:
+            self._module = importlib.import_module(self._name)
+        return getattr(self._module, attribute)
 
 
 def load_data(path):
@@ -16,9 +36,11 @@ def load_data(path):
         return f.read()
 
 
-def preprocess_and_save_data(source_path, target_path, text_to_ids):
+def preprocess_and_save_data(source_path, target_path, text_to_ids, binary=False, max_size=None, min_count=1):
     """
     Preprocess Text Data.  Save to to file.
+    With binary set, save to the PREPROCESS_DIR format read by load_preprocess_binary instead of preprocess.p
+    max_size and min_count prune the vocabularies as in create_lookup_tables
     """
     # Preprocess
     source_text = load_data(source_path)
@@ -27,12 +49,16 @@ def preprocess_and_save_data(source_path, target_path, text_to_ids):
     source_text = source_text.lower()
     target_text = target_text.lower()
 
-    source_vocab_to_int, source_int_to_vocab = create_lookup_tables(source_text)
-    target_vocab_to_int, target_int_to_vocab = create_lookup_tables(target_text)
+    source_vocab_to_int, source_int_to_vocab = create_lookup_tables(source_text, max_size, min_count)
+    target_vocab_to_int, target_int_to_vocab = create_lookup_tables(target_text, max_size, min_count)
 
     source_text, target_text = text_to_ids(source_text, target_text, source_vocab_to_int, target_vocab_to_int)
 
     # Save Data
+    if binary:
+        save_preprocess_binary(source_text, target_text, source_vocab_to_int, target_vocab_to_int)
+        return
+
     with open('preprocess.p', 'wb') as out_file:
         pickle.dump((
             (source_text, target_text),
@@ -40,6 +66,118 @@ def preprocess_and_save_data(source_path, target_path, text_to_ids):
             (source_int_to_vocab, target_int_to_vocab)), out_file)
 
 
+def iter_parallel_lines(source_path, target_path):
+    """
+    Read the source and target files line by line together, without loading either into memory
+    :return: Generator of lowercased (source line, target line) pairs
+    """
+    with open(source_path, 'r', encoding='utf-8') as source_file, \
+            open(target_path, 'r', encoding='utf-8') as target_file:
+        for source_line, target_line in itertools.zip_longest(source_file, target_file):
+            if source_line is None or target_line is None:
+                raise ValueError('{} and {} have a different number of lines'.format(source_path, target_path))
+            yield source_line.rstrip('\n').lower(), target_line.rstrip('\n').lower()
+
+
+def count_words(source_path, target_path):
+    """
+    Count the words of both sides in one pass over the files
+    :return: Tuple (source word Counter, target word Counter, number of lines)
+    """
+    source_counts = collections.Counter()
+    target_counts = collections.Counter()
+    line_count = 0
+    for source_line, target_line in iter_parallel_lines(source_path, target_path):
+        source_counts.update(source_line.split())
+        target_counts.update(target_line.split())
+        line_count += 1
+
+    return source_counts, target_counts, line_count
+
+
+class IdArrayWriter(object):
+    """
+    Write sentences of ids into preallocated .npy token and offset arrays, a chunk at a time
+    """
+
+    def __init__(self, path, side, line_count, token_count, chunk_lines):
+        self.tokens = np.lib.format.open_memmap(os.path.join(path, side + '_tokens.npy'), mode='w+',
+                                                dtype=np.int32, shape=(token_count,))
+        self.offsets = np.lib.format.open_memmap(os.path.join(path, side + '_offsets.npy'), mode='w+',
+                                                 dtype=np.int64, shape=(line_count + 1,))
+        self.offsets[0] = 0
+        self.chunk_lines = chunk_lines
+        self._token_i = 0
+        self._line_i = 0
+        self._ids = []
+        self._lengths = []
+
+    def append(self, sentence_ids):
+        self._ids.extend(sentence_ids)
+        self._lengths.append(len(sentence_ids))
+        if len(self._lengths) >= self.chunk_lines:
+            self.flush()
+
+    def append_chunk(self, tokens, lengths):
+        """
+        Write already encoded sentences
+        :param tokens: int32 array of the sentences' ids one after another
+        :param lengths: int64 array of the sentence lengths
+        """
+        self.flush()
+        token_end = self._token_i + len(tokens)
+        line_end = self._line_i + len(lengths)
+        self.tokens[self._token_i:token_end] = tokens
+        self.offsets[self._line_i + 1:line_end + 1] = self._token_i + np.cumsum(lengths)
+        self._token_i, self._line_i = token_end, line_end
+
+    def flush(self):
+        token_end = self._token_i + len(self._ids)
+        line_end = self._line_i + len(self._lengths)
+        self.tokens[self._token_i:token_end] = self._ids
+        self.offsets[self._line_i + 1:line_end + 1] = self._token_i + np.cumsum(self._lengths)
+        self._token_i, self._line_i = token_end, line_end
+        self._ids = []
+        self._lengths = []
+
+    def close(self):
+        self.flush()
+        self.tokens.flush()
+        self.offsets.flush()
+        del self.tokens, self.offsets
+
+
+def preprocess_and_save_data_streaming(source_path, target_path, path=PREPROCESS_DIR, chunk_lines=10000,
+                                        max_size=None, min_count=1):
+    """
+    Preprocess Text Data line by line with bounded memory.  Save to the binary format read by load_preprocess_binary.
+    The first pass counts the words to build the vocabularies, the second writes the ids straight to disk.
+    max_size and min_count prune the vocabularies as in create_lookup_tables
+    """
+    source_counts, target_counts, line_count = count_words(source_path, target_path)
+    source_vocab_to_int, _ = create_lookup_tables_from_counts(source_counts, max_size, min_count)
+    target_vocab_to_int, _ = create_lookup_tables_from_counts(target_counts, max_size, min_count)
+
+    if not os.path.exists(path):
+        os.makedirs(path)
+
+    # every target sentence gets an <EOS>
+    source_writer = IdArrayWriter(path, 'source', line_count, sum(source_counts.values()), chunk_lines)
+    target_writer = IdArrayWriter(path, 'target', line_count, sum(target_counts.values()) + line_count, chunk_lines)
+
+    source_unk = source_vocab_to_int['<UNK>']
+    target_unk = target_vocab_to_int['<UNK>']
+    end_of_sequence_id = target_vocab_to_int['<EOS>']
+    for source_line, target_line in iter_parallel_lines(source_path, target_path):
+        source_writer.append([source_vocab_to_int.get(word, source_unk) for word in source_line.split()])
+        target_writer.append([target_vocab_to_int.get(word, target_unk) for word in target_line.split()] +
+                             [end_of_sequence_id])
+
+    source_writer.close()
+    target_writer.close()
+    save_vocab(source_vocab_to_int, target_vocab_to_int, path)
+
+
 def load_preprocess():
     """
     Load the Preprocessed Training data and return them in batches of <batch_size> or less
@@ -48,14 +186,171 @@ def load_preprocess():
         return pickle.load(in_file)
 
 
-def create_lookup_tables(text):
+class IdCorpus(object):
+    """
+    Sentences of word ids kept as one flat token array and an array of sentence offsets into it
+    """
+
+    def __init__(self, tokens, offsets):
+        """
+        :param tokens: int32 array of all word ids, sentence after sentence
+        :param offsets: int64 array where sentence i is tokens[offsets[i]:offsets[i + 1]]
+        """
+        self.tokens = tokens
+        self.offsets = offsets
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            start, stop, step = index.indices(len(self))
+            if step != 1:
+                return [self[i] for i in range(start, stop, step)]
+            # offsets are absolute, so a slice shares the token array
+            return IdCorpus(self.tokens, self.offsets[start:max(stop, start) + 1])
+
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError('IdCorpus index out of range')
+        return self.tokens[self.offsets[index]:self.offsets[index + 1]].tolist()
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self[index]
+
+    def lengths(self):
+        """
+        :return: int64 array of the sentence lengths
+        """
+        return np.diff(self.offsets)
+
+
+def sentence_lengths(sentences):
+    """
+    Get the length of every sentence without building the sentences when they are an IdCorpus
+    """
+    if isinstance(sentences, IdCorpus):
+        return sentences.lengths()
+    return np.array([len(sentence) for sentence in sentences], dtype=np.int64)
+
+
+def flatten_sentences(sentences, indices=None):
+    """
+    Get the word ids of some sentences as one flat array
+    :param sentences: IdCorpus or list of sentence id lists
+    :param indices: Sentences to take, defaults to all of them
+    :return: Tuple (int32 array of the sentences' ids one after another, int64 array of their lengths)
+    """
+    if isinstance(sentences, IdCorpus):
+        offsets = sentences.offsets
+        if indices is None:
+            starts = offsets[:-1]
+            lengths = np.diff(offsets)
+        else:
+            indices = np.asarray(indices, dtype=np.int64)
+            starts = offsets[indices]
+            lengths = offsets[indices + 1] - starts
+        # gather all the sentences' tokens with one fancy index
+        row_starts = np.cumsum(lengths) - lengths
+        positions = np.arange(int(lengths.sum()), dtype=np.int64) + np.repeat(starts - row_starts, lengths)
+        return np.asarray(sentences.tokens[positions], dtype=np.int32), lengths
+
+    if indices is not None:
+        sentences = [sentences[i] for i in indices]
+    lengths = sentence_lengths(sentences)
+    tokens = np.fromiter(itertools.chain.from_iterable(sentences), dtype=np.int32, count=int(lengths.sum()))
+    return tokens, lengths
+
+
+def save_preprocess_binary(source_id_text, target_id_text, source_vocab_to_int, target_vocab_to_int,
+                           path=PREPROCESS_DIR):
+    """
+    Save preprocessed data as flat token and offset arrays per side plus a vocab file
+    """
+    if not os.path.exists(path):
+        os.makedirs(path)
+
+    for side, id_text in (('source', source_id_text), ('target', target_id_text)):
+        offsets = np.zeros(len(id_text) + 1, dtype=np.int64)
+        np.cumsum(sentence_lengths(id_text), out=offsets[1:])
+        tokens = np.fromiter(itertools.chain.from_iterable(id_text), dtype=np.int32, count=int(offsets[-1]))
+
+        np.save(os.path.join(path, side + '_tokens.npy'), tokens)
+        np.save(os.path.join(path, side + '_offsets.npy'), offsets)
+
+    save_vocab(source_vocab_to_int, target_vocab_to_int, path)
+
+
+def save_vocab(source_vocab_to_int, target_vocab_to_int, path=PREPROCESS_DIR):
+    """
+    Save the vocabularies of the binary format
+    """
+    with open(os.path.join(path, 'vocab.json'), 'w', encoding='utf-8') as out_file:
+        json.dump({'source': source_vocab_to_int, 'target': target_vocab_to_int}, out_file,
+                  ensure_ascii=False, sort_keys=True)
+
+
+def load_vocab(path=PREPROCESS_DIR):
+    """
+    Load only the vocabularies, falling back to preprocess.p when there is no binary format
+    :return: Tuple ((source_vocab_to_int, target_vocab_to_int), (source_int_to_vocab, target_int_to_vocab))
+    """
+    vocab_file = os.path.join(path, 'vocab.json')
+    if not os.path.exists(vocab_file):
+        _, vocab_to_int, int_to_vocab = load_preprocess()
+        return vocab_to_int, int_to_vocab
+
+    with open(vocab_file, 'r', encoding='utf-8') as in_file:
+        vocab = json.load(in_file)
+
+    source_vocab_to_int, target_vocab_to_int = vocab['source'], vocab['target']
+    return (source_vocab_to_int, target_vocab_to_int), \
+        ({v_i: v for v, v_i in source_vocab_to_int.items()}, {v_i: v for v, v_i in target_vocab_to_int.items()})
+
+
+def load_preprocess_binary(path=PREPROCESS_DIR, mmap_mode='r'):
+    """
+    Load the binary preprocessed data, memory mapping the token arrays
+    :return: Same structure as load_preprocess, with IdCorpus in place of the lists of sentences
+    """
+    corpora = []
+    for side in ('source', 'target'):
+        tokens = np.load(os.path.join(path, side + '_tokens.npy'), mmap_mode=mmap_mode)
+        offsets = np.load(os.path.join(path, side + '_offsets.npy'), mmap_mode=mmap_mode)
+        corpora.append(IdCorpus(tokens, offsets))
+
+    vocab_to_int, int_to_vocab = load_vocab(path)
+    return tuple(corpora), vocab_to_int, int_to_vocab
+
+
+def create_lookup_tables(text, max_size=None, min_count=1):
     """
     Create lookup tables for vocabulary
+    :param text: Text to take the words from
+    :param max_size: Largest vocabulary size including the special codes, None keeps every word
+    :param min_count: Words seen fewer times are left out and map to <UNK>
+    """
+    return create_lookup_tables_from_counts(collections.Counter(text.split()), max_size, min_count)
+
+
+def create_lookup_tables_from_counts(word_counts, max_size=None, min_count=1):
+    """
+    Create lookup tables for vocabulary from word counts, most frequent words first.
+    Ties are broken alphabetically so the ids are the same on every run.
+    :param word_counts: Dictionary of word to number of occurrences
+    :param max_size: Largest vocabulary size including the special codes, None keeps every word
+    :param min_count: Words seen fewer times are left out and map to <UNK>
     """
-    vocab = set(text.split())
     vocab_to_int = copy.copy(CODES)
 
-    for v_i, v in enumerate(vocab, len(CODES)):
+    words = sorted((word for word, count in word_counts.items() if count >= min_count and word not in CODES),
+                   key=lambda word: (-word_counts[word], word))
+    if max_size is not None:
+        words = words[:max(max_size - len(CODES), 0)]
+
+    for v_i, v in enumerate(words, len(CODES)):
         vocab_to_int[v] = v_i
 
     int_to_vocab = {v_i: v for v, v_i in vocab_to_int.items()}
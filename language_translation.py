@@ -1,22 +1,45 @@
+import argparse
+import collections
 import helper
+import itertools
+import os
 import numpy as np
-import problem_unittests as tests
+import queue
+import subprocess
+import sys
+import threading
+import time
+import training_metrics
+import translation_cache
 import warnings
-import tensorflow as tf
 import math as m
-from distutils.version import LooseVersion
-from tensorflow.python.layers.core import Dense
+
+# TensorFlow is only imported once a function needs it
+tf = helper.LazyModule('tensorflow')
 
 # load data from subset of larger dataset
 source_path = 'data/small_vocab_en'
 target_path = 'data/small_vocab_fr'
 save_path = 'checkpoints/dev'
-source_text = helper.load_data(source_path)
-target_text = helper.load_data(target_path)
+
+_corpus = {}
+
+
+def load_corpus():
+    """
+    Load the source and target text on first use
+    :return: Tuple (source_text, target_text)
+    """
+    if not _corpus:
+        _corpus['source_text'] = helper.load_data(source_path)
+        _corpus['target_text'] = helper.load_data(target_path)
+    return _corpus['source_text'], _corpus['target_text']
 
 
 def print_data(view_sentence_range=(0, 10)):
 
+    source_text, target_text = load_corpus()
+
     print('Dataset Stats')
     print('Roughly the number of unique words: {}'.format(len({word: None for word in source_text.split()})))
 
@@ -47,15 +70,19 @@ def text_to_ids(source_text, target_text, source_vocab_to_int, target_vocab_to_i
     source_sentences = [sentence for sentence in source_text.split('\n')]
     target_sentences = [sentence + ' <EOS>' for sentence in target_text.split('\n')]
 
-    # convert sentences to ids by word
-    source_id_text= [[source_vocab_to_int[word] for word in sentence.split()] for sentence in source_sentences]
-    target_id_text = [[target_vocab_to_int[word] for word in sentence.split()] for sentence in target_sentences]
+    # convert sentences to ids by word, words pruned from the vocabulary become <UNK>
+    source_unk = source_vocab_to_int['<UNK>']
+    target_unk = target_vocab_to_int['<UNK>']
+    source_id_text= [[source_vocab_to_int.get(word, source_unk) for word in sentence.split()] for sentence in source_sentences]
+    target_id_text = [[target_vocab_to_int.get(word, target_unk) for word in sentence.split()] for sentence in target_sentences]
 
     # return tuple of source_id_text and target_id_text
     return source_id_text, target_id_text
 
 
 def check_tf_gpu():
+    from distutils.version import LooseVersion
+
     assert LooseVersion(tf.__version__) >= LooseVersion('1.1'), 'Please use TensorFlow version 1.1 or newer'
     print('TensorFlow Version: {}'.format(tf.__version__))
 
@@ -105,9 +132,60 @@ def process_decoder_input(target_data, target_vocab_to_int, batch_size):
     return p_target_data
 
 
+# LSTM kernels, all of them keep LSTMCell's kernel and bias layout so a checkpoint loads with any of them
+CELL_BACKENDS = ('lstm', 'block', 'fused')
+
+
+def make_lstm_cell(rnn_size, cell_backend='lstm'):
+    """
+    Create one LSTM layer's cell
+    :param rnn_size: RNN Size
+    :param cell_backend: 'lstm' for LSTMCell's per step ops, 'block' or 'fused' for the single op LSTMBlockCell
+    :return: RNNCell whose variables are named lstm_cell/kernel and lstm_cell/bias
+    """
+    if cell_backend == 'lstm':
+        return tf.contrib.rnn.LSTMCell(rnn_size, state_is_tuple=True)
+    if cell_backend in ('block', 'fused'):
+        return tf.contrib.rnn.LSTMBlockCell(rnn_size)
+    raise ValueError('cell_backend should be one of {}, got {}'.format(', '.join(CELL_BACKENDS), cell_backend))
+
+
+def register_cell_ops():
+    """
+    Register the contrib ops a saved graph may use, contrib only registers its ops once its modules are imported.
+    Translator and export_inference_graph call this before importing a meta graph or frozen .pb graph, which
+    fails on the block LSTM ops of the block and fused cell backends or on the GatherTree op of a beam search
+    decoder otherwise
+    """
+    from tensorflow.contrib.rnn.python.ops import lstm_ops  # noqa: F401
+    import tensorflow.contrib.seq2seq  # noqa: F401
+
+
+def fused_encoding_rnn(embedding, rnn_size, num_layers, keep_prob, source_sequence_length):
+    """
+    Run the encoder's stacked LSTM with one LSTMBlockFusedCell op per layer over the whole sequence, under the
+    variable scopes dynamic_rnn and MultiRNNCell give the per step cells
+    :return: tuple (RNN output, RNN state)
+    """
+    with tf.variable_scope('rnn'):
+        # the fused kernel runs time major
+        layer_input = tf.transpose(embedding, [1, 0, 2])
+        rnn_state = []
+        for layer_i in range(num_layers):
+            with tf.variable_scope('multi_rnn_cell/cell_{}'.format(layer_i)):
+                cell = tf.contrib.rnn.LSTMBlockFusedCell(rnn_size)
+                # dropout where DropoutWrapper puts it, on each layer's inputs and outputs but not its state
+                layer_output, layer_state = cell(tf.nn.dropout(layer_input, keep_prob), dtype=tf.float32,
+                                                 sequence_length=source_sequence_length, scope='lstm_cell')
+                layer_input = tf.nn.dropout(layer_output, keep_prob)
+                rnn_state.append(layer_state)
+
+    return tf.transpose(layer_input, [1, 0, 2]), tuple(rnn_state)
+
+
 def encoding_layer(rnn_inputs, rnn_size, num_layers, keep_prob,
                    source_sequence_length, source_vocab_size,
-                   encoding_embedding_size):
+                   encoding_embedding_size, cell_backend='lstm'):
     """
     Create encoding layer
     :param rnn_inputs: Inputs for the RNN
@@ -117,16 +195,21 @@ def encoding_layer(rnn_inputs, rnn_size, num_layers, keep_prob,
     :param source_sequence_length: a list of the lengths of each sequence in the batch
     :param source_vocab_size: vocabulary size of source data
     :param encoding_embedding_size: embedding size of source data
+    :param cell_backend: LSTM kernels, one of CELL_BACKENDS
     :return: tuple (RNN output, RNN state)
     """
 
     # create embedding of inputs for dynamic rnn
-    embedding = tf.contrib.layers.embed_sequence(ids=rnn_inputs, vocab_size=source_vocab_size, embed_dim=encoding_embedding_size)
+    embedding = tf.contrib.layers.embed_sequence(ids=rnn_inputs, vocab_size=source_vocab_size, embed_dim=encoding_embedding_size,
+                                                 scope='EmbedSequence')
+
+    if cell_backend == 'fused':
+        return fused_encoding_rnn(embedding, rnn_size, num_layers, keep_prob, source_sequence_length)
 
     # construct a stacked RNN with cells wrapped in dropout
     stacked_rnn = []
     for _ in range(num_layers):
-        cell = tf.contrib.rnn.LSTMCell(rnn_size, state_is_tuple=True)
+        cell = make_lstm_cell(rnn_size, cell_backend)
         stacked_rnn.append(tf.contrib.rnn.DropoutWrapper(cell, input_keep_prob=keep_prob, output_keep_prob=keep_prob))
     multi_layer = tf.contrib.rnn.MultiRNNCell(stacked_rnn, state_is_tuple=True)
 
@@ -170,7 +253,7 @@ def decoding_layer_train(encoder_state, dec_cell, dec_embed_input,
 
 def decoding_layer_infer(encoder_state, dec_cell, dec_embeddings, start_of_sequence_id,
                          end_of_sequence_id, max_target_sequence_length,
-                         vocab_size, output_layer, batch_size, keep_prob):
+                         vocab_size, output_layer, batch_size, keep_prob, sequence_length=None):
     """
     Create a decoding layer for inference
     :param encoder_state: Encoder state
@@ -184,17 +267,74 @@ def decoding_layer_infer(encoder_state, dec_cell, dec_embeddings, start_of_seque
     :param output_layer: Function to apply the output layer
     :param batch_size: Batch size
     :param keep_prob: Dropout keep probability
+    :param sequence_length: Optional per sentence maximum length, each sentence stops at <EOS> or this length
     :return: BasicDecoderOutput containing inference logits and sample_id
     """
 
     # create greedy embedding helper
     helper = tf.contrib.seq2seq.GreedyEmbeddingHelper(dec_embeddings, tf.tile([start_of_sequence_id], [batch_size]), end_of_sequence_id)
 
+    if sequence_length is None:
+        # create basic encoder
+        decoder = tf.contrib.seq2seq.BasicDecoder(dec_cell, helper, encoder_state, output_layer)
+
+        # get outputs
+        outputs, _ = tf.contrib.seq2seq.dynamic_decode(decoder=decoder, maximum_iterations=max_target_sequence_length)
+
+        # return outputs
+        return outputs
+
+    # also finish each sentence once it reaches its own length, decoding stops when every sentence finished
+    def initialize_fn():
+        finished, first_inputs = helper.initialize()
+        return tf.logical_or(finished, sequence_length <= 0), first_inputs
+
+    def next_inputs_fn(time, outputs, state, sample_ids):
+        finished, next_inputs, next_state = helper.next_inputs(time, outputs, state, sample_ids)
+        return tf.logical_or(finished, time + 1 >= sequence_length), next_inputs, next_state
+
+    length_helper = tf.contrib.seq2seq.CustomHelper(initialize_fn, helper.sample, next_inputs_fn)
+
     # create basic encoder
-    decoder = tf.contrib.seq2seq.BasicDecoder(dec_cell, helper, encoder_state, output_layer)
+    decoder = tf.contrib.seq2seq.BasicDecoder(dec_cell, length_helper, encoder_state, output_layer)
+
+    # get outputs, finished sentences keep their state and emit <PAD>
+    outputs = tf.contrib.seq2seq.dynamic_decode(decoder=decoder, impute_finished=True,
+                                                maximum_iterations=max_target_sequence_length)[0]
+
+    # return outputs
+    return outputs
+
+
+def decoding_layer_infer_beam(encoder_state, dec_cell, dec_embeddings, start_of_sequence_id,
+                              end_of_sequence_id, max_target_sequence_length,
+                              output_layer, batch_size, beam_width, length_penalty_weight):
+    """
+    Create a beam search decoding layer for inference
+    :param encoder_state: Encoder state
+    :param dec_cell: Decoder RNN Cell
+    :param dec_embeddings: Decoder embeddings
+    :param start_of_sequence_id: GO ID
+    :param end_of_sequence_id: EOS Id
+    :param max_target_sequence_length: Maximum length of target sequences
+    :param output_layer: Function to apply the output layer
+    :param batch_size: Batch size
+    :param beam_width: Number of beams kept per sentence
+    :param length_penalty_weight: Length penalty weight, 0 turns the penalty off
+    :return: FinalBeamSearchDecoderOutput containing predicted_ids of shape (batch, time, beam)
+    """
+
+    # tile the encoder state, computed once per sentence, across the beams
+    tiled_encoder_state = tf.contrib.seq2seq.tile_batch(encoder_state, multiplier=beam_width)
+
+    # create beam search decoder
+    decoder = tf.contrib.seq2seq.BeamSearchDecoder(dec_cell, dec_embeddings,
+                                                   tf.fill([batch_size], start_of_sequence_id), end_of_sequence_id,
+                                                   tiled_encoder_state, beam_width, output_layer,
+                                                   length_penalty_weight)
 
     # get outputs
-    outputs, _ = tf.contrib.seq2seq.dynamic_decode(decoder=decoder, maximum_iterations=max_target_sequence_length)
+    outputs = tf.contrib.seq2seq.dynamic_decode(decoder=decoder, maximum_iterations=max_target_sequence_length)[0]
 
     # return outputs
     return outputs
@@ -204,7 +344,8 @@ def decoding_layer(dec_input, encoder_state,
                    target_sequence_length, max_target_sequence_length,
                    rnn_size,
                    num_layers, target_vocab_to_int, target_vocab_size,
-                   batch_size, keep_prob, decoding_embedding_size):
+                   batch_size, keep_prob, decoding_embedding_size, beam_width=0, output_layer=None,
+                   project_train_output=True, cell_backend='lstm'):
     """
     Create decoding layer
     :param dec_input: Decoder input
@@ -218,28 +359,35 @@ def decoding_layer(dec_input, encoder_state,
     :param batch_size: The size of the batch
     :param keep_prob: Dropout keep probability
     :param decoding_embedding_size: Decoding embedding size
+    :param beam_width: With a beam width, also add a beam search decoder whose best beam is
+                       named 'beam_predictions' and whose length penalty is fed through 'length_penalty_weight'
+    :param output_layer: Layer mapping the decoder outputs to the vocabulary, a new Dense layer by default
+    :param project_train_output: False to leave the training decoder's outputs unprojected, for a sampled loss
+    :param cell_backend: LSTM kernels, one of CELL_BACKENDS, the fused backend decodes with LSTMBlockCell
     :return: Tuple of (Training BasicDecoderOutput, Inference BasicDecoderOutput)
     """
 
     # embed the target sequences
-    embeddings = tf.Variable(tf.random_uniform([target_vocab_size, decoding_embedding_size]))
+    embeddings = tf.get_variable('dec_embeddings', [target_vocab_size, decoding_embedding_size],
+                                 initializer=tf.random_uniform_initializer(0.0, 1.0))
     embed_input = tf.nn.embedding_lookup(embeddings, dec_input)
 
     # construct a stacked LSTM
     stacked_lstm = []
     for _ in range(num_layers):
-        stacked_lstm.append(tf.contrib.rnn.LSTMCell(rnn_size, state_is_tuple=True))
+        stacked_lstm.append(make_lstm_cell(rnn_size, cell_backend))
     multi_layer = tf.contrib.rnn.MultiRNNCell(stacked_lstm, state_is_tuple=True)
 
     # create an output layer to map the outputs of the decoder to the elements of our vocabulary
-    output_layer = Dense(target_vocab_size, kernel_initializer=tf.truncated_normal_initializer(mean=0.0, stddev=0.1))
+    if output_layer is None:
+        output_layer = tf.layers.Dense(target_vocab_size, kernel_initializer=tf.truncated_normal_initializer(mean=0.0, stddev=0.1))
 
     # training decoder using scope to share variables
     with tf.variable_scope("decoder") as decoding_scope:
 
         train_output = decoding_layer_train(encoder_state, multi_layer, embed_input,
                                             target_sequence_length, max_target_sequence_length,
-                                            output_layer, keep_prob)
+                                            output_layer if project_train_output else None, keep_prob)
 
         # re-use the same variables for the inference decoder
         decoding_scope.reuse_variables()
@@ -250,7 +398,16 @@ def decoding_layer(dec_input, encoder_state,
 
         infer_output = decoding_layer_infer(encoder_state, multi_layer, embeddings,
                                             start_of_sequence_id, end_of_sequence_id, max_target_sequence_length,
-                                            target_vocab_size, output_layer, batch_size, keep_prob)
+                                            target_vocab_size, output_layer, batch_size, keep_prob,
+                                            target_sequence_length)
+
+        if beam_width:
+            length_penalty_weight = tf.placeholder_with_default(0.0, [], name='length_penalty_weight')
+            beam_output = decoding_layer_infer_beam(encoder_state, multi_layer, embeddings,
+                                                    start_of_sequence_id, end_of_sequence_id,
+                                                    max_target_sequence_length, output_layer, batch_size,
+                                                    beam_width, length_penalty_weight)
+            tf.identity(beam_output.predicted_ids[:, :, 0], name='beam_predictions')
 
 
     # return tuple of train & infer output
@@ -262,7 +419,8 @@ def seq2seq_model(input_data, target_data, keep_prob, batch_size,
                   max_target_sentence_length,
                   source_vocab_size, target_vocab_size,
                   enc_embedding_size, dec_embedding_size,
-                  rnn_size, num_layers, target_vocab_to_int):
+                  rnn_size, num_layers, target_vocab_to_int, beam_width=0, output_layer=None,
+                  project_train_output=True, cell_backend='lstm'):
     """
     Build the Sequence-to-Sequence part of the neural network
     :param input_data: Input placeholder
@@ -278,12 +436,16 @@ def seq2seq_model(input_data, target_data, keep_prob, batch_size,
     :param rnn_size: RNN Size
     :param num_layers: Number of layers
     :param target_vocab_to_int: Dictionary to go from the target words to an id
+    :param beam_width: Beam width of an additional beam search decoder, 0 for greedy decoding only
+    :param output_layer: Layer mapping the decoder outputs to the vocabulary, a new Dense layer by default
+    :param project_train_output: False to leave the training decoder's outputs unprojected, for a sampled loss
+    :param cell_backend: LSTM kernels, one of CELL_BACKENDS
     :return: Tuple of (Training BasicDecoderOutput, Inference BasicDecoderOutput)
     """
 
     # get encoding state by passing parameters through to the encoding_layer
     _, encoding_state = encoding_layer(input_data, rnn_size, num_layers, keep_prob,
-                                       source_sequence_length, source_vocab_size, enc_embedding_size)
+                                       source_sequence_length, source_vocab_size, enc_embedding_size, cell_backend)
 
 
     # process target data to get the decoding input
@@ -293,7 +455,8 @@ def seq2seq_model(input_data, target_data, keep_prob, batch_size,
     train_output, infer_output = decoding_layer(decoding_input, encoding_state,
                                                 target_sequence_length, max_target_sentence_length,
                                                 rnn_size, num_layers, target_vocab_to_int, target_vocab_size,
-                                                batch_size, keep_prob, dec_embedding_size)
+                                                batch_size, keep_prob, dec_embedding_size, beam_width,
+                                                output_layer, project_train_output, cell_backend)
 
     # return tuple of train & infer output
     return train_output, infer_output
@@ -305,29 +468,207 @@ def pad_sentence_batch(sentence_batch, pad_int):
     return [sentence + [pad_int] * (max_sentence - len(sentence)) for sentence in sentence_batch]
 
 
-def get_batches(sources, targets, batch_size, source_pad_int, target_pad_int):
-    """Batch targets, sources, and the lengths of their sentences together"""
-    for batch_i in range(0, len(sources)//batch_size):
+def pad_batch(sentences, pad_int, indices=None):
+    """
+    Pad a batch of sentences straight into an int32 array without building padded lists
+    :param sentences: IdCorpus or list of sentence id lists
+    :param pad_int: <PAD> id
+    :param indices: Sentences of the batch, defaults to all of them
+    :return: Tuple (int32 array of shape (batch, longest sentence), int32 array of the real sentence lengths)
+    """
+    tokens, lengths = helper.flatten_sentences(sentences, indices)
+    return pad_flat(tokens, lengths, pad_int)
+
+
+def pad_flat(tokens, lengths, pad_int):
+    """
+    Pad sentences given as one flat array of ids
+    :param tokens: Word ids of all the sentences one after another
+    :param lengths: Length of each sentence
+    :param pad_int: <PAD> id
+    :return: Tuple (int32 array of shape (batch, longest sentence), int32 array of the sentence lengths)
+    """
+    lengths = np.asarray(lengths)
+    max_length = int(lengths.max()) if len(lengths) else 0
+
+    padded = np.full((len(lengths), max_length), pad_int, dtype=np.int32)
+    # row major order of the mask matches the order of the flat tokens
+    padded[np.arange(max_length) < lengths[:, None]] = tokens
+    return padded, lengths.astype(np.int32)
+
+
+def get_batches(sources, targets, batch_size, source_pad_int, target_pad_int, counter=None, start_batch=0):
+    """
+    Batch targets, sources, and the lengths of their sentences together
+    :param start_batch: Number of batches to skip without padding them, to resume an epoch
+    :return: Generator of (padded sources, padded targets, source lengths, target lengths), the lengths being
+    each sentence's real length so the model can skip the padding
+    """
+    for batch_i in range(start_batch, len(sources)//batch_size):
         start_i = batch_i * batch_size
+        batch = np.arange(start_i, start_i + batch_size)
+
+        pad_sources_batch, source_lengths = pad_batch(sources, source_pad_int, batch)
+        pad_targets_batch, target_lengths = pad_batch(targets, target_pad_int, batch)
+
+        if counter is not None:
+            counter.update(pad_sources_batch, source_lengths, pad_targets_batch, target_lengths)
+
+        yield pad_sources_batch, pad_targets_batch, source_lengths, target_lengths
+
+
+class PaddingCounter(object):
+    """
+    Count the real and padded tokens of the batches fed to the model
+    """
+
+    def __init__(self):
+        self.real_tokens = 0
+        self.padded_tokens = 0
+
+    def update(self, pad_sources_batch, source_lengths, pad_targets_batch, target_lengths):
+        self.real_tokens += int(np.sum(source_lengths)) + int(np.sum(target_lengths))
+        self.padded_tokens += pad_sources_batch.size + pad_targets_batch.size
+
+    @property
+    def padding_ratio(self):
+        """Fraction of the processed tokens that are <PAD>"""
+        if not self.padded_tokens:
+            return 0.0
+        return 1.0 - self.real_tokens / self.padded_tokens
+
 
-        # Slice the right amount for the batch
-        sources_batch = sources[start_i:start_i + batch_size]
-        targets_batch = targets[start_i:start_i + batch_size]
+def get_bucketed_batches(sources, targets, batch_size, source_pad_int, target_pad_int,
+                         num_buckets=10, shuffle=True, seed=None, counter=None, start_batch=0):
+    """
+    Batch sentences of similar source and target length together to cut down on padding
+    :param sources: List of source sentence ids
+    :param targets: List of target sentence ids
+    :param batch_size: Batch Size
+    :param source_pad_int: Source <PAD> id
+    :param target_pad_int: Target <PAD> id
+    :param num_buckets: Number of length buckets the sentences are split into
+    :param shuffle: Shuffle sentences within their bucket and batches across buckets
+    :param seed: Seed for the shuffling
+    :param counter: Optional PaddingCounter to add the batches' tokens to
+    :param start_batch: Number of batches to skip without padding them, to resume an epoch
+    :return: Generator of (padded sources, padded targets, source lengths, target lengths) like get_batches
+    """
+    random_state = np.random.RandomState(seed)
+
+    # sort by source then target length, shuffling first so equal lengths end up in random order
+    source_lengths = helper.sentence_lengths(sources)
+    target_lengths = helper.sentence_lengths(targets)
+    order = random_state.permutation(len(sources)) if shuffle else np.arange(len(sources))
+    order = order[np.lexsort((target_lengths[order], source_lengths[order]))]
+
+    # split the sorted sentences into buckets, carrying what doesn't fill a batch to the next bucket
+    batches = []
+    leftover = []
+    for bucket in np.array_split(order, max(min(num_buckets, len(order)), 1)):
+        bucket = leftover + list(bucket)
+        if shuffle:
+            bucket = [bucket[i] for i in random_state.permutation(len(bucket))]
+        full_size = len(bucket) // batch_size * batch_size
+        batches.extend(bucket[start_i:start_i + batch_size] for start_i in range(0, full_size, batch_size))
+        leftover = bucket[full_size:]
+
+    if shuffle:
+        batches = [batches[i] for i in random_state.permutation(len(batches))]
 
-        # Pad
-        pad_sources_batch = np.array(pad_sentence_batch(sources_batch, source_pad_int))
-        pad_targets_batch = np.array(pad_sentence_batch(targets_batch, target_pad_int))
+    for batch in batches[start_batch:]:
+        pad_sources_batch, source_lengths = pad_batch(sources, source_pad_int, batch)
+        pad_targets_batch, target_lengths = pad_batch(targets, target_pad_int, batch)
 
-        # Need the lengths for the _lengths parameters
-        pad_targets_lengths = []
-        for target in pad_targets_batch:
-            pad_targets_lengths.append(len(target))
+        if counter is not None:
+            counter.update(pad_sources_batch, source_lengths, pad_targets_batch, target_lengths)
 
-        pad_source_lengths = []
-        for source in pad_sources_batch:
-            pad_source_lengths.append(len(source))
+        yield pad_sources_batch, pad_targets_batch, source_lengths, target_lengths
 
-        yield pad_sources_batch, pad_targets_batch, pad_source_lengths, pad_targets_lengths
+
+class Prefetcher(object):
+    """
+    Run a batch generator on a background thread, keeping up to depth batches ready for the trainer
+    """
+
+    _DONE = object()
+
+    def __init__(self, batches, depth=2):
+        """
+        :param batches: Iterable of batches, e.g. from get_batches or get_bucketed_batches
+        :param depth: Number of batches prepared ahead of the one being trained on
+        """
+        self.wait_seconds = 0.0
+        self.batches = 0
+        self._queue = queue.Queue(maxsize=max(depth, 1))
+        self._stop = threading.Event()
+        self._worker = threading.Thread(target=self._work, args=(iter(batches),), name='prefetcher')
+        self._worker.daemon = True
+        self._worker.start()
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        start = time.perf_counter()
+        item = self._queue.get()
+        self.wait_seconds += time.perf_counter() - start
+
+        if item is self._DONE:
+            self._queue.put(item)
+            raise StopIteration
+        if isinstance(item, BaseException):
+            self._queue.put(self._DONE)
+            raise item
+        self.batches += 1
+        return item
+
+    def close(self):
+        """
+        Stop preparing batches, for when the trainer stops before the generator is exhausted
+        """
+        self._stop.set()
+        while self._worker.is_alive():
+            try:
+                self._queue.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        self._worker.join()
+
+    def _put(self, item):
+        while not self._stop.is_set():
+            try:
+                self._queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _work(self, batches):
+        try:
+            for batch in batches:
+                if not self._put(batch):
+                    return
+        except Exception as error:
+            self._put(error)
+            return
+        self._put(self._DONE)
+
+
+def timed_batches(batches):
+    """
+    Time how long each batch takes to arrive
+    :param batches: Iterable of batches
+    :return: Generator of (seconds waited, batch)
+    """
+    batches = iter(batches)
+    while True:
+        start = time.perf_counter()
+        try:
+            batch = next(batches)
+        except StopIteration:
+            return
+        yield time.perf_counter() - start, batch
 
 
 def get_accuracy(target, logits):
@@ -349,70 +690,549 @@ def get_accuracy(target, logits):
     return np.mean(np.equal(target, logits))
 
 
-def train_model():
+def masked_accuracy(target, predictions, target_lengths):
+    """
+    Calculate token accuracy over the real words of each target sentence, ignoring the padding
+    :param target: Padded target batch
+    :param predictions: Predicted ids, cut or padded to the width of target
+    :param target_lengths: Real length of each target sentence
+    :return: Tuple (accuracy, number of real target words)
+    """
+    width = target.shape[1]
+    if predictions.shape[1] < width:
+        # missing predictions never match
+        predictions = np.pad(predictions, [(0, 0), (0, width - predictions.shape[1])], 'constant',
+                             constant_values=-1)
+    mask = np.arange(width) < np.asarray(target_lengths)[:, None]
+    tokens = int(mask.sum())
+    if not tokens:
+        return 0.0, 0
+    return float(np.sum((predictions[:, :width] == target) & mask)) / tokens, tokens
+
+
+def split_validation(source_int_text, target_int_text, params):
+    """
+    Hold out the first params.valid_batches batches of sentences for validation
+    :return: Tuple (train sources, train targets, validation sources, validation targets)
+    """
+    valid_size = params.batch_size * params.valid_batches
+    return (source_int_text[valid_size:], target_int_text[valid_size:],
+            source_int_text[:valid_size], target_int_text[:valid_size])
 
-    # Split data to training and validation sets
-    train_source = source_int_text[batch_size:]
-    train_target = target_int_text[batch_size:]
-    valid_source = source_int_text[:batch_size]
-    valid_target = target_int_text[:batch_size]
-    (valid_sources_batch, valid_targets_batch, valid_sources_lengths, valid_targets_lengths ) = next(get_batches(valid_source,
-                                                                                                                 valid_target,
-                                                                                                                 batch_size,
-                                                                                                                 source_vocab_to_int['<PAD>'],
-                                                                                                                 target_vocab_to_int['<PAD>']))
-
-    with tf.Session(graph=train_graph) as sess:
-        sess.run(tf.global_variables_initializer())
-
-        for epoch_i in range(epochs):
-            for batch_i, (source_batch, target_batch, sources_lengths, targets_lengths) in enumerate(
-                    get_batches(train_source, train_target, batch_size,
-                                source_vocab_to_int['<PAD>'],
-                                target_vocab_to_int['<PAD>'])):
 
-                _, loss = sess.run(
-                    [train_op, cost],
-                    {input_data: source_batch,
-                     targets: target_batch,
-                     lr: learning_rate,
-                     target_sequence_length: targets_lengths,
-                     source_sequence_length: sources_lengths,
-                     keep_prob: keep_probability})
+class EvalScheduler(object):
+    """
+    Decide when to evaluate during training and keep the padded validation batches it evaluates on
+    """
+
+    def __init__(self, valid_source, valid_target, batch_size, source_pad_int, target_pad_int,
+                 every_steps=25, every_seconds=0, sample_batches=0):
+        """
+        :param valid_source: Validation source sentence ids
+        :param valid_target: Validation target sentence ids
+        :param batch_size: Batch size of the inference graph
+        :param source_pad_int: Source <PAD> id
+        :param target_pad_int: Target <PAD> id
+        :param every_steps: Evaluate after this many steps since the last evaluation, 0 to not evaluate by steps
+        :param every_seconds: Evaluate after this many seconds since the last evaluation, 0 to not evaluate by time
+        :param sample_batches: Validation batches per evaluation, taken in turn, 0 for all of them
+        """
+        # padded once, sorted by length so each batch pads little
+        self.valid_batches = list(get_bucketed_batches(valid_source, valid_target, batch_size, source_pad_int,
+                                                       target_pad_int, num_buckets=1, shuffle=False))
+        self.every_steps = every_steps
+        self.every_seconds = every_seconds
+        self.sample_batches = sample_batches
+        self._next_batch = 0
+        self._last_step = 0
+        self._last_time = time.perf_counter()
+
+    def due(self, step):
+        """
+        :return: True if step should be evaluated
+        """
+        return bool((self.every_steps and step - self._last_step >= self.every_steps) or
+                    (self.every_seconds and time.perf_counter() - self._last_time >= self.every_seconds))
+
+    def sample(self):
+        """
+        :return: The validation batches of the next evaluation
+        """
+        count = min(self.sample_batches or len(self.valid_batches), len(self.valid_batches))
+        batches = [self.valid_batches[(self._next_batch + i) % len(self.valid_batches)] for i in range(count)]
+        self._next_batch = (self._next_batch + count) % max(len(self.valid_batches), 1)
+        return batches
+
+    def evaluate(self, sess, model, step):
+        """
+        Run the inference path on a sample of the validation batches
+        :return: Validation accuracy over the sample's real target words
+        """
+        matches = 0.0
+        tokens = 0
+        for batch in self.sample():
+            batch_accuracy, batch_tokens = evaluate_batch(sess, model, batch)
+            matches += batch_accuracy * batch_tokens
+            tokens += batch_tokens
+
+        self._last_step = step
+        self._last_time = time.perf_counter()
+        return matches / tokens if tokens else 0.0
+
+
+def evaluate_batch(sess, model, batch):
+    """
+    Run the inference path on a padded batch
+    :param batch: (padded sources, padded targets, source lengths, target lengths) from get_batches
+    :return: Tuple (accuracy, number of real target words) from masked_accuracy
+    """
+    source_batch, target_batch, source_lengths, target_lengths = batch
+    predictions = sess.run(
+        model.inference_logits,
+        {model.input_data: source_batch,
+         model.source_sequence_length: source_lengths,
+         model.target_sequence_length: target_lengths,
+         model.keep_prob: 1.0})
+    return masked_accuracy(target_batch, predictions, target_lengths)
+
 
+TrainGraph = collections.namedtuple('TrainGraph', ['graph', 'input_data', 'targets', 'lr', 'keep_prob',
+                                                   'target_sequence_length', 'source_sequence_length',
+                                                   'inference_logits', 'cost', 'train_op', 'global_step'])
 
-                if batch_i % display_step == 0 and batch_i > 0:
 
+def sampled_sequence_loss(outputs, targets, masks, output_layer, num_sampled, vocab_size):
+    """
+    Sampled softmax counterpart of tf.contrib.seq2seq.sequence_loss, scoring each real target word against
+    num_sampled sampled words instead of the whole vocabulary
+    :param outputs: Unprojected decoder outputs of shape (batch, time, rnn size)
+    :param targets: Target ids of shape (batch, time)
+    :param masks: Float mask of the real target words, of shape (batch, time)
+    :param output_layer: Built Dense layer whose kernel and bias the inference path projects with
+    :param num_sampled: Number of words sampled per target word
+    :param vocab_size: Target vocabulary size
+    :return: Mean loss over the real target words
+    """
+    # padding is dropped before the loss rather than masked after it
+    real_positions = tf.where(tf.reshape(masks, [-1]) > 0)[:, 0]
+    inputs = tf.gather(tf.reshape(outputs, [-1, tf.shape(outputs)[2]]), real_positions)
+    labels = tf.gather(tf.reshape(tf.to_int64(targets), [-1, 1]), real_positions)
+
+    losses = tf.nn.sampled_softmax_loss(weights=tf.transpose(output_layer.kernel),
+                                        biases=output_layer.bias,
+                                        labels=labels,
+                                        inputs=inputs,
+                                        num_sampled=num_sampled,
+                                        num_classes=vocab_size)
+    return tf.reduce_mean(losses)
+
+
+def average_gradients(tower_gradients):
+    """
+    Average the gradients of each variable over the towers
+    :param tower_gradients: List of compute_gradients results, one per tower, in the same variable order
+    :return: List of (gradient, variable) pairs
+    """
+    averaged = []
+    for grads_and_vars in zip(*tower_gradients):
+        variable = grads_and_vars[0][1]
+        grads = [grad for grad, _ in grads_and_vars if grad is not None]
+        if not grads:
+            averaged.append((None, variable))
+        elif len(grads) == 1:
+            averaged.append((grads[0], variable))
+        elif isinstance(grads[0], tf.IndexedSlices):
+            # embedding gradients stay sparse, repeated rows add up when they are applied
+            averaged.append((tf.IndexedSlices(tf.concat([grad.values for grad in grads], 0) / len(grads),
+                                              tf.concat([grad.indices for grad in grads], 0),
+                                              grads[0].dense_shape), variable))
+        else:
+            averaged.append((tf.add_n(grads) / len(grads), variable))
+    return averaged
+
+
+def build_train_graph(params, source_vocab_size, target_vocab_size, target_vocab_to_int):
+    """
+    Build the graph that trains the model, with the inference path named for translate.
+    With params.num_towers above 1, each batch is split across that many model replicas that share
+    their variables and the replicas' gradients are averaged before a single optimizer update.
+    :param params: Hyperparameters from default_params
+    :param source_vocab_size: Source vocabulary size
+    :param target_vocab_size: Target vocabulary size
+    :param target_vocab_to_int: Dictionary to go from the target words to an id
+    :return: TrainGraph of the graph and the tensors train_model feeds and runs
+    """
+    num_towers = params.num_towers
+    # a sample as large as the vocabulary saves nothing over the full softmax
+    sampled_softmax = 0 < params.num_sampled < target_vocab_size
+    if params.batch_size % num_towers:
+        raise ValueError('batch_size {} does not split evenly across {} towers'.format(params.batch_size, num_towers))
+    tower_batch_size = params.batch_size // num_towers
+
+    def build_model(model_input, model_targets, model_batch_size, model_source_length, model_target_length,
+                    model_max_target_length, beam_width):
+        return seq2seq_model(model_input,
+                             model_targets,
+                             keep_prob,
+                             model_batch_size,
+                             model_source_length,
+                             model_target_length,
+                             model_max_target_length,
+                             source_vocab_size,
+                             target_vocab_size,
+                             params.encoding_embedding_size,
+                             params.decoding_embedding_size,
+                             params.rnn_size,
+                             params.num_layers,
+                             target_vocab_to_int,
+                             beam_width,
+                             output_layer,
+                             not sampled_softmax,
+                             params.cell_backend)
+
+    train_graph = tf.Graph()
+    with train_graph.as_default():
+        input_data, targets, lr, keep_prob, target_sequence_length, max_target_sequence_length, source_sequence_length = model_inputs()
+
+        # reverse each source sentence within its own length so the padding stays at the end
+        reversed_input = tf.reverse_sequence(input_data, source_sequence_length, seq_axis=1, batch_axis=0,
+                                             name='reversed_input')
+
+        # shared by every tower, the sampled loss needs its kernel and bias
+        output_layer = tf.layers.Dense(target_vocab_size,
+                                       kernel_initializer=tf.truncated_normal_initializer(mean=0.0, stddev=0.1))
+        # built up front under the name the training decoder gives it, with the sampled loss its first call is in
+        # the inference decoder, whose scope only reuses variables
+        with tf.variable_scope('decoder'), tf.variable_scope('decoder'):
+            output_layer.build(tf.TensorShape([None, params.rnn_size]))
+
+        if num_towers == 1:
+            train_logits, inference_logits = build_model(reversed_input, targets, params.batch_size,
+                                                         source_sequence_length, target_sequence_length,
+                                                         max_target_sequence_length, params.beam_width)
+            towers = [(train_logits, targets, target_sequence_length, max_target_sequence_length)]
+        else:
+            towers = []
+            for tower_i, (tower_input, tower_targets, tower_source_length, tower_target_length) in enumerate(zip(
+                    tf.split(reversed_input, num_towers), tf.split(targets, num_towers),
+                    tf.split(source_sequence_length, num_towers), tf.split(target_sequence_length, num_towers))):
+                with tf.variable_scope(tf.get_variable_scope(), reuse=tower_i > 0), \
+                        tf.name_scope('tower_{}'.format(tower_i)):
+                    # each tower only runs to its own longest sentences
+                    tower_max_target_length = tf.reduce_max(tower_target_length)
+                    tower_input = tower_input[:, :tf.reduce_max(tower_source_length)]
+                    tower_targets = tower_targets[:, :tower_max_target_length]
+
+                    train_logits, _ = build_model(tower_input, tower_targets, tower_batch_size, tower_source_length,
+                                                  tower_target_length, tower_max_target_length, 0)
+                    towers.append((train_logits, tower_targets, tower_target_length, tower_max_target_length))
+
+            # translate decodes whole batches, so the inference path takes the full batch with the towers' variables
+            with tf.variable_scope(tf.get_variable_scope(), reuse=True):
+                _, inference_logits = build_model(reversed_input, targets, params.batch_size, source_sequence_length,
+                                                  target_sequence_length, max_target_sequence_length,
+                                                  params.beam_width)
+
+        inference_logits = tf.identity(inference_logits.sample_id, name='predictions')
+
+        tower_losses = []
+        for train_logits, tower_targets, tower_target_length, tower_max_target_length in towers:
+            training_logits = tf.identity(train_logits.rnn_output,
+                                          name='decoder_outputs' if sampled_softmax else 'logits')
+            masks = tf.sequence_mask(tower_target_length, tower_max_target_length, dtype=tf.float32, name='masks')
+            tower_losses.append((training_logits, tower_targets, masks))
+
+        with tf.name_scope("optimization"):
+            # Optimizer
+            optimizer = tf.train.AdamOptimizer(lr)
 
-                    batch_train_logits = sess.run(
-                        inference_logits,
-                        {input_data: source_batch,
-                         source_sequence_length: sources_lengths,
-                         target_sequence_length: targets_lengths,
-                         keep_prob: 1.0})
+            tower_costs = []
+            tower_gradients = []
+            for training_logits, tower_targets, masks in tower_losses:
+                # Loss function
+                if sampled_softmax:
+                    tower_cost = sampled_sequence_loss(training_logits, tower_targets, masks, output_layer,
+                                                       params.num_sampled, target_vocab_size)
+                else:
+                    tower_cost = tf.contrib.seq2seq.sequence_loss(
+                        training_logits,
+                        tower_targets,
+                        masks)
+
+                tower_costs.append(tower_cost)
+                tower_gradients.append(optimizer.compute_gradients(tower_cost))
+            cost = tower_costs[0] if num_towers == 1 else tf.add_n(tower_costs) / num_towers
 
+            # Gradient Clipping
+            gradients = average_gradients(tower_gradients)
+            capped_gradients = [(tf.clip_by_value(grad, -1., 1.), var) for grad, var in gradients if grad is not None]
+            global_step = tf.train.get_or_create_global_step()
+            train_op = optimizer.apply_gradients(capped_gradients, global_step=global_step)
+
+    return TrainGraph(train_graph, input_data, targets, lr, keep_prob, target_sequence_length,
+                      source_sequence_length, inference_logits, cost, train_op, global_step)
 
-                    batch_valid_logits = sess.run(
-                        inference_logits,
-                        {input_data: valid_sources_batch,
-                         source_sequence_length: valid_sources_lengths,
-                         target_sequence_length: valid_targets_lengths,
-                         keep_prob: 1.0})
 
-                    train_acc = get_accuracy(target_batch, batch_train_logits)
+class AsyncCheckpointer(object):
+    """
+    Periodically checkpoint the training variables from a background thread.
+    Variables are copied in-graph to shadow variables, which are written out while training continues.
+    """
 
-                    valid_acc = get_accuracy(valid_targets_batch, batch_valid_logits)
+    def __init__(self, checkpoint_dir, every_steps=1000, every_seconds=600, max_to_keep=5):
+        """
+        Build the snapshot ops, call it in the training graph before the session is created
+        :param checkpoint_dir: Directory of the checkpoints, named model-<global step>
+        :param every_steps: Save after this many steps since the last save, None or 0 to not save by steps
+        :param every_seconds: Save after this many seconds since the last save, None or 0 to not save by time
+        :param max_to_keep: Number of most recent checkpoints kept on disk
+        """
+        self.checkpoint_dir = checkpoint_dir
+        self.every_steps = every_steps
+        self.every_seconds = every_seconds
+        self.saves = 0
+        self.blocked_seconds = 0.0
+
+        # global variables include the global step and the optimizer's slots, all needed to resume
+        variables = tf.global_variables()
+        with tf.name_scope('checkpoint_snapshot'):
+            self._shadows = [tf.Variable(tf.zeros(variable.get_shape(), dtype=variable.dtype.base_dtype),
+                                         trainable=False, collections=[], name=variable.op.name)
+                             for variable in variables]
+            self._shadow_init = tf.variables_initializer(self._shadows)
+            self._snapshot = tf.group(*[shadow.assign(variable) for shadow, variable in zip(self._shadows, variables)])
+        # the shadows are saved under their variable's name, so the usual Saver restores them
+        self._shadow_saver = tf.train.Saver({variable.op.name: shadow for variable, shadow in zip(variables, self._shadows)},
+                                            max_to_keep=max_to_keep)
+        self._saver = tf.train.Saver(variables)
+
+        self._thread = None
+        self._error = None
+        self._last_step = 0
+        self._last_time = time.perf_counter()
+
+    def restore(self, sess, resume=True):
+        """
+        Initialize the variables, restoring them from the latest checkpoint if there is one
+        :param resume: False to start from scratch even if there are checkpoints
+        :return: Global step of the restored checkpoint, 0 when starting from scratch
+        """
+        sess.run([tf.global_variables_initializer(), self._shadow_init])
+        step = 0
+        checkpoint_path = resume and tf.train.latest_checkpoint(self.checkpoint_dir)
+        if checkpoint_path:
+            self._saver.restore(sess, checkpoint_path)
+            step = int(sess.run(tf.train.get_global_step()))
+            print('Resumed from {} at step {}'.format(checkpoint_path, step))
+        self._last_step = step
+        self._last_time = time.perf_counter()
+        return step
+
+    def maybe_save(self, sess, step):
+        """
+        Save when every_steps or every_seconds have passed since the last save
+        :return: True if a save was started
+        """
+        if (self.every_steps and step - self._last_step >= self.every_steps) or \
+                (self.every_seconds and time.perf_counter() - self._last_time >= self.every_seconds):
+            self.save(sess, step)
+            return True
+        return False
+
+    def save(self, sess, step):
+        """
+        Snapshot the variables and write them out on a background thread
+        """
+        # the shadows can't be overwritten while the previous checkpoint is still being written
+        start = time.perf_counter()
+        self.wait()
+        sess.run(self._snapshot)
+        self.blocked_seconds += time.perf_counter() - start
+
+        if not os.path.exists(self.checkpoint_dir):
+            os.makedirs(self.checkpoint_dir)
+        self._thread = threading.Thread(target=self._write, args=(sess, step), name='checkpointer')
+        self._thread.start()
+        self._last_step = step
+        self._last_time = time.perf_counter()
+
+    def wait(self):
+        """
+        Wait for the checkpoint being written, raising any error writing it
+        """
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
+
+    def _write(self, sess, step):
+        try:
+            self._shadow_saver.save(sess, os.path.join(self.checkpoint_dir, 'model'), global_step=step,
+                                    write_meta_graph=False)
+            self.saves += 1
+        except Exception as error:
+            self._error = error
+
+
+def train_model(model, params, source_int_text, target_int_text, source_vocab_to_int, target_vocab_to_int):
+    """
+    Train the model and save it to params.save_path
+    :param model: TrainGraph from build_train_graph
+    :param params: Hyperparameters from default_params
+    :param source_int_text: Source sentence ids
+    :param target_int_text: Target sentence ids
+    :param source_vocab_to_int: Dictionary to go from the source words to an id
+    :param target_vocab_to_int: Dictionary to go from the target words to an id
+    """
+    batch_size = params.batch_size
 
-                    print('Epoch {:>3} Batch {:>4}/{} - Train Accuracy: {:>6.4f}, Validation Accuracy: {:>6.4f}, Loss: {:>6.4f}'
-                          .format(epoch_i, batch_i, len(source_int_text) // batch_size, train_acc, valid_acc, loss))
+    # Split data to training and validation sets
+    train_source, train_target, valid_source, valid_target = split_validation(source_int_text, target_int_text, params)
+    # a separate evaluation process scores the checkpoints instead
+    scheduler = EvalScheduler(valid_source, valid_target, batch_size, source_vocab_to_int['<PAD>'],
+                              target_vocab_to_int['<PAD>'], 0 if params.eval_process else params.display_step,
+                              0 if params.eval_process else params.eval_secs, params.eval_batches)
+
+    steps_per_epoch = max(len(train_source) // batch_size, 1)
+    with model.graph.as_default():
+        checkpointer = AsyncCheckpointer(params.checkpoint_dir, params.checkpoint_steps, params.checkpoint_secs,
+                                         params.keep_checkpoints)
+
+    metrics = training_metrics.MetricsLogger(params.metrics_path, params.tensorboard_dir)
+    tracer = training_metrics.TimelineTracer(params.trace_dir, params.trace_steps)
+
+    with tf.Session(graph=model.graph) as sess:
+        step = checkpointer.restore(sess, params.resume)
+
+        # batches are deterministic per epoch, so the global step says where training stopped
+        for epoch_i in range(step // steps_per_epoch, params.epochs):
+            start_batch = step - epoch_i * steps_per_epoch
+            counter = PaddingCounter()
+            if params.num_buckets:
+                batches = get_bucketed_batches(train_source, train_target, batch_size,
+                                               source_vocab_to_int['<PAD>'],
+                                               target_vocab_to_int['<PAD>'],
+                                               num_buckets=params.num_buckets, seed=epoch_i, counter=counter,
+                                               start_batch=start_batch)
+            else:
+                batches = get_batches(train_source, train_target, batch_size,
+                                      source_vocab_to_int['<PAD>'],
+                                      target_vocab_to_int['<PAD>'], counter=counter, start_batch=start_batch)
+            if params.prefetch_depth:
+                # pad the next batches on a background thread while sess.run trains on this one
+                batches = Prefetcher(batches, params.prefetch_depth)
+            epoch_start = time.perf_counter()
+
+            for batch_i, (input_wait, (source_batch, target_batch, sources_lengths, targets_lengths)) in \
+                    enumerate(timed_batches(batches), start_batch):
+
+                step_start = time.perf_counter()
+                _, loss = sess.run(
+                    [model.train_op, model.cost],
+                    {model.input_data: source_batch,
+                     model.targets: target_batch,
+                     model.lr: params.learning_rate,
+                     model.target_sequence_length: targets_lengths,
+                     model.source_sequence_length: sources_lengths,
+                     model.keep_prob: params.keep_probability},
+                    **tracer.run_args(step + 1))
+                step_seconds = time.perf_counter() - step_start
+                # each train_op run increments the global step by one
+                step += 1
+                tracer.write(step)
+                checkpointer.maybe_save(sess, step)
+
+                real_tokens = int(np.sum(sources_lengths) + np.sum(targets_lengths))
+                padded_tokens = source_batch.size + target_batch.size
+                step_metrics = {'epoch': epoch_i, 'batch': batch_i, 'step_seconds': step_seconds,
+                                'input_wait_seconds': input_wait, 'real_tokens': real_tokens,
+                                'padded_tokens': padded_tokens,
+                                'real_tokens_per_sec': real_tokens / (step_seconds + input_wait),
+                                'padded_tokens_per_sec': padded_tokens / (step_seconds + input_wait),
+                                'loss': float(loss)}
+
+                if scheduler.due(step):
+                    valid_acc = scheduler.evaluate(sess, model, step)
+                    step_metrics['valid_accuracy'] = valid_acc
+
+                    if params.eval_train:
+                        train_acc = evaluate_batch(sess, model, (source_batch, target_batch, sources_lengths,
+                                                                 targets_lengths))[0]
+                        step_metrics['train_accuracy'] = train_acc
+                        print('Epoch {:>3} Batch {:>4}/{} - Train Accuracy: {:>6.4f}, Validation Accuracy: {:>6.4f}, Loss: {:>6.4f}'
+                              .format(epoch_i, batch_i, steps_per_epoch, train_acc, valid_acc, loss))
+                    else:
+                        print('Epoch {:>3} Batch {:>4}/{} - Validation Accuracy: {:>6.4f}, Loss: {:>6.4f}'
+                              .format(epoch_i, batch_i, steps_per_epoch, valid_acc, loss))
+
+                metrics.log(step, **step_metrics)
+
+            print('Epoch {:>3} - Tokens Processed: {}, Padding Ratio: {:>6.4f}'
+                  .format(epoch_i, counter.padded_tokens, counter.padding_ratio))
+            if params.prefetch_depth:
+                epoch_seconds = time.perf_counter() - epoch_start
+                print('Epoch {:>3} - Input Wait: {:>6.2f}s of {:>6.2f}s ({:>5.1%})'
+                      .format(epoch_i, batches.wait_seconds, epoch_seconds, batches.wait_seconds / epoch_seconds))
+
+        metrics.close()
+        checkpointer.save(sess, step)
+        checkpointer.wait()
+        print('Checkpoints Saved: {}, Training Blocked on Checkpoints: {:>6.2f}s'
+              .format(checkpointer.saves, checkpointer.blocked_seconds))
 
         # Save Model
         saver = tf.train.Saver()
-        saver.save(sess, save_path)
+        saver.save(sess, params.save_path)
         print('Model Trained and Saved')
 
-        helper.save_params(save_path)
-        helper.preprocess_and_save_data(source_path, target_path, text_to_ids)
+        helper.save_params(params.save_path)
+
+
+def evaluate_checkpoints(params, poll_seconds=5):
+    """
+    Score each new checkpoint in params.checkpoint_dir on the validation batches, for running beside training.
+    Stops once the checkpoint of the last training step is scored or no new checkpoint came for params.eval_timeout.
+    :param params: Hyperparameters from default_params, the same as training's
+    :param poll_seconds: Seconds between looks for a new checkpoint
+    """
+    (source_int_text, target_int_text), (source_vocab_to_int, target_vocab_to_int), _ = helper.load_preprocess_binary()
+    train_source, _, valid_source, valid_target = split_validation(source_int_text, target_int_text, params)
+    scheduler = EvalScheduler(valid_source, valid_target, params.batch_size, source_vocab_to_int['<PAD>'],
+                              target_vocab_to_int['<PAD>'])
+    last_step = params.epochs * max(len(train_source) // params.batch_size, 1)
+
+    model = build_train_graph(params, len(source_vocab_to_int), len(target_vocab_to_int), target_vocab_to_int)
+    with model.graph.as_default():
+        saver = tf.train.Saver()
+    metrics = training_metrics.MetricsLogger(params.eval_metrics_path)
+
+    checkpoint_path = None
+    idle_start = time.perf_counter()
+    with tf.Session(graph=model.graph) as sess:
+        while time.perf_counter() - idle_start < params.eval_timeout:
+            latest_path = tf.train.latest_checkpoint(params.checkpoint_dir)
+            if not latest_path or latest_path == checkpoint_path:
+                time.sleep(poll_seconds)
+                continue
+
+            try:
+                saver.restore(sess, latest_path)
+            except tf.errors.NotFoundError:
+                # removed by the retention policy while restoring, a newer one is on the way
+                continue
+            checkpoint_path = latest_path
+            idle_start = time.perf_counter()
+
+            step = int(sess.run(model.global_step))
+            valid_acc = scheduler.evaluate(sess, model, step)
+            metrics.log(step, valid_accuracy=valid_acc)
+            print('Step {:>6} - Validation Accuracy: {:>6.4f}'.format(step, valid_acc))
+            if step >= last_step:
+                break
+
+    metrics.close()
 
 
 def sentence_to_seq(sentence, vocab_to_int):
@@ -436,42 +1256,381 @@ def sentence_to_seq(sentence, vocab_to_int):
     return sentence_id
 
 
-def translate(translate_sentence='he saw a old yellow truck .'):
+class SentenceEncoder(object):
+    """
+    Convert sentences to word ids like sentence_to_seq, a whole batch at a time
+    """
 
-    _, (source_vocab_to_int, target_vocab_to_int), (source_int_to_vocab, target_int_to_vocab) = helper.load_preprocess()
-    load_path = helper.load_params()
+    def __init__(self, vocab_to_int):
+        """
+        :param vocab_to_int: Dictionary to go from the words to an id
+        """
+        self.vocab_to_int = vocab_to_int
+        self.unk = vocab_to_int['<UNK>']
+        self.pad = vocab_to_int['<PAD>']
+
+    def encode(self, sentence):
+        """
+        :param sentence: String
+        :return: List of word ids
+        """
+        return list(map(self.vocab_to_int.get, sentence.lower().split(), itertools.repeat(self.unk)))
+
+    def encode_batch(self, sentences):
+        """
+        Encode sentences straight into a padded array
+        :param sentences: List of strings
+        :return: Tuple (int32 array of shape (batch, longest sentence), int32 array of the sentence lengths)
+        """
+        words = []
+        lengths = np.zeros(len(sentences), dtype=np.int64)
+        for sentence_i, sentence in enumerate(sentences):
+            sentence_words = sentence.lower().split()
+            lengths[sentence_i] = len(sentence_words)
+            words.extend(sentence_words)
+
+        # one lookup pass over every word of the batch, unknown words become <UNK>
+        tokens = np.fromiter(map(self.vocab_to_int.get, words, itertools.repeat(self.unk)), dtype=np.int32,
+                             count=len(words))
+        return pad_flat(tokens, lengths, self.pad)
+
+
+class SentenceDecoder(object):
+    """
+    Convert predicted word ids back to sentences, cutting each one at <EOS> or <PAD>
+    """
 
-    translate_sentence = sentence_to_seq(translate_sentence, source_vocab_to_int)
+    def __init__(self, int_to_vocab):
+        """
+        :param int_to_vocab: Dictionary to go from the ids to a word
+        """
+        vocab_to_int = {word: word_id for word_id, word in int_to_vocab.items()}
+        self.end_ids = np.array([vocab_to_int['<EOS>'], vocab_to_int['<PAD>']])
+        # ids index straight into an array of the words
+        self.words = np.empty(max(int_to_vocab) + 1, dtype=object)
+        for word_id, word in int_to_vocab.items():
+            self.words[word_id] = word
+
+    def lengths(self, predictions):
+        """
+        :param predictions: Array of predicted ids of shape (batch, time)
+        :return: Length of each sentence before its first <EOS> or <PAD>
+        """
+        predictions = np.asarray(predictions)
+        ended = np.isin(predictions, self.end_ids)
+        return np.where(ended.any(axis=1), ended.argmax(axis=1), predictions.shape[1])
+
+    def cut_batch(self, predictions):
+        """
+        :param predictions: Array of predicted ids of shape (batch, time)
+        :return: List of word id lists, each cut at its first <EOS> or <PAD>
+        """
+        predictions = np.asarray(predictions)
+        return [row[:length].tolist() for row, length in zip(predictions, self.lengths(predictions))]
+
+    def decode(self, sentence_ids):
+        """
+        :param sentence_ids: Word ids, not cut
+        :return: String
+        """
+        return ' '.join(self.words[np.asarray(sentence_ids, dtype=np.int64)])
+
+    def decode_batch(self, predictions):
+        """
+        :param predictions: Array of predicted ids of shape (batch, time)
+        :return: List of strings, each cut at its first <EOS> or <PAD>
+        """
+        predictions = np.asarray(predictions)
+        words = self.words[predictions]
+        return [' '.join(row[:length]) for row, length in zip(words, self.lengths(predictions))]
+
+
+class Translator(object):
+    """
+    Restore a saved model once and keep its session open for repeated translation
+    """
 
-    loaded_graph = tf.Graph()
-    with tf.Session(graph=loaded_graph) as sess:
-        # Load saved model
-        loader = tf.train.import_meta_graph(load_path + '.meta')
-        loader.restore(sess, load_path)
+    def __init__(self, load_path=None, batch_size=256, mode='greedy', length_penalty=0.0,
+                 max_length_ratio=2.0, max_length_offset=0, cache=None):
+        """
+        :param load_path: Checkpoint path or frozen .pb graph from export_inference_graph,
+                          defaults to the path saved with helper.save_params
+        :param batch_size: Batch size the inference graph was built with
+        :param mode: 'greedy' or 'beam', beam needs a model built with a beam_width
+        :param length_penalty: Length penalty weight for beam search
+        :param max_length_ratio: Each translation is cut at max_length_ratio * source length + max_length_offset words
+        :param max_length_offset: See max_length_ratio
+        :param cache: Optional translation_cache.TranslationCache to look translations up in before decoding
+        """
+        if mode not in ('greedy', 'beam'):
+            raise ValueError("mode should be 'greedy' or 'beam', got {}".format(mode))
+
+        (self.source_vocab_to_int, self.target_vocab_to_int), \
+            (self.source_int_to_vocab, self.target_int_to_vocab) = helper.load_vocab()
+        self.load_path = load_path or helper.load_params()
+        self.batch_size = batch_size
+        self.encoder = SentenceEncoder(self.source_vocab_to_int)
+        self.decoder = SentenceDecoder(self.target_int_to_vocab)
+
+        register_cell_ops()
+        self.graph = tf.Graph()
+        self.sess = tf.Session(graph=self.graph)
+        with self.graph.as_default():
+            if self.load_path.endswith('.pb'):
+                graph_def = tf.GraphDef()
+                with open(self.load_path, 'rb') as in_file:
+                    graph_def.ParseFromString(in_file.read())
+                tf.import_graph_def(graph_def, name='')
+                loader = None
+            else:
+                loader = tf.train.import_meta_graph(self.load_path + '.meta')
+
+            # checked before the weights are restored, models are built with the greedy decoder only by default
+            output_name = 'beam_predictions' if mode == 'beam' else 'predictions'
+            if mode == 'beam' and output_name not in {op.name for op in self.graph.get_operations()}:
+                self.sess.close()
+                raise ValueError('{} was built without a beam search decoder, retrain it with --beam-width N '
+                                 '(e.g. --beam-width 4) to translate with --mode beam'.format(self.load_path))
+            if loader:
+                loader.restore(self.sess, self.load_path)
+
+        self.input_data = self.graph.get_tensor_by_name('input:0')
+        self.logits = self.graph.get_tensor_by_name(output_name + ':0')
+        self.mode = mode
+        self.length_penalty = length_penalty
+        self.max_length_ratio = max_length_ratio
+        self.max_length_offset = max_length_offset
+        self.target_sequence_length = self.graph.get_tensor_by_name('target_sequence_length:0')
+        self.source_sequence_length = self.graph.get_tensor_by_name('source_sequence_length:0')
+        self.keep_prob = self.graph.get_tensor_by_name('keep_prob:0')
+
+        # older checkpoints reverse the whole padded input and need the padded width as source length
+        self.real_source_lengths = any(op.type == 'ReverseSequence' for op in self.graph.get_operations())
+
+        self.cache = cache
+        if cache is not None:
+            # the decoding settings change the translations as much as the weights do. Entries of other models or
+            # settings never match this key, so they are left for the servers that share the cache file
+            self.cache_key = '{}:{}:{}:{}:{}'.format(translation_cache.checkpoint_identity(self.load_path), mode,
+                                                     length_penalty, max_length_ratio, max_length_offset)
+
+    def encode(self, sentence):
+        """
+        :param sentence: English string
+        :return: List of source word ids
+        """
+        return self.encoder.encode(sentence)
+
+    def decode(self, sentence_ids):
+        """
+        :param sentence_ids: List of target word ids
+        :return: French string
+        """
+        return self.decoder.decode(sentence_ids)
+
+    def max_target_length(self, source_length):
+        """
+        :param source_length: Number of words in the source sentence
+        :return: Most words the sentence's translation may have
+        """
+        return max(int(m.ceil(self.max_length_ratio * source_length + self.max_length_offset)), 1)
+
+    def translate_batch(self, sentences):
+        """
+        Translate up to batch_size sentences with a single session run, only decoding the ones not in the cache
+        :param sentences: List of source word id lists
+        :return: List of target word id lists, cut at <EOS>
+        """
+        if self.cache is None:
+            return self._run_batch(sentences)
+
+        translations = [self.cache.get(self.cache_key, sentence) for sentence in sentences]
+        misses = collections.OrderedDict()
+        for i, translation in enumerate(translations):
+            if translation is None:
+                misses.setdefault(tuple(sentences[i]), []).append(i)
+
+        if misses:
+            for sentence, translation in zip(misses, self._run_batch([list(sentence) for sentence in misses])):
+                self.cache.put(self.cache_key, sentence, translation)
+                for i in misses[sentence]:
+                    translations[i] = list(translation)
+        return translations
+
+    def _run_batch(self, sentences):
+        if len(sentences) > self.batch_size:
+            raise ValueError('Got {} sentences for a batch of {}'.format(len(sentences), self.batch_size))
+
+        # the graph decodes exactly batch_size rows, so unused rows get a one word filler
+        source_pad = self.source_vocab_to_int['<PAD>']
+        filler_rows = self.batch_size - len(sentences)
+        rows = list(sentences) + [[source_pad]] * filler_rows
+        pad_rows, source_lengths = pad_batch(rows, source_pad)
+
+        if not self.real_source_lengths:
+            source_lengths = [pad_rows.shape[1]] * self.batch_size
+        target_lengths = [self.max_target_length(len(sentence)) for sentence in sentences] + [1] * filler_rows
+
+        feed_dict = {self.input_data: pad_rows,
+                     self.target_sequence_length: target_lengths,
+                     self.source_sequence_length: source_lengths,
+                     self.keep_prob: 1.0}
+        if self.mode == 'beam':
+            feed_dict[self.graph.get_tensor_by_name('length_penalty_weight:0')] = self.length_penalty
+        translate_logits = self.sess.run(self.logits, feed_dict)
+
+        # sentences that finished early are padded after their <EOS>
+        return self.decoder.cut_batch(translate_logits[:len(sentences)])
+
+    def close(self):
+        self.sess.close()
+
+
+def open_translator(load_path=None, batch_size=256, mode='greedy', length_penalty=0.0,
+                    max_length_ratio=2.0, max_length_offset=0, cache=None):
+    """
+    Open a Translator, or a numpy_inference.NumpyTranslator for float32 or int8 .npz weights which decodes greedily
+    without TensorFlow and without a cache
+    :return: Translator or NumpyTranslator, see Translator for the arguments
+    """
+    if load_path and load_path.endswith('.npz'):
+        import numpy_inference
+        if mode != 'greedy':
+            raise ValueError('{} can only decode greedily'.format(load_path))
+        if cache is not None:
+            raise ValueError('{} is decoded without a translation cache'.format(load_path))
+        return numpy_inference.NumpyTranslator(load_path, batch_size, max_length_ratio, max_length_offset)
+    return Translator(load_path, batch_size, mode, length_penalty, max_length_ratio, max_length_offset, cache)
+
+
+def _translate_window(translator, window):
+    # batch sentences of similar length together, so a batch's sentences finish decoding at about the same step
+    order = sorted(range(len(window)), key=lambda i: len(window[i]))
+    translations = [None] * len(window)
+    for start_i in range(0, len(order), translator.batch_size):
+        batch_order = order[start_i:start_i + translator.batch_size]
+        for i, sentence_ids in zip(batch_order, translator.translate_batch([window[i] for i in batch_order])):
+            translations[i] = translator.decode(sentence_ids)
+    return translations
+
+
+def translate_iter(sentences, translator=None, load_path=None, batch_size=256, sort_window=8):
+    """
+    Lazily translate sentences, filling every row of each inference batch with a different sentence
+    :param sentences: Iterable of English strings, e.g. the lines of a file
+    :param translator: Translator to reuse, a new one is restored from load_path otherwise
+    :param load_path: Checkpoint path, defaults to the path saved with helper.save_params
+    :param batch_size: Batch size the inference graph was built with
+    :param sort_window: Number of batches read ahead and regrouped by sentence length
+    :return: Generator of French strings in input order
+    """
+    own_translator = translator is None
+    if own_translator:
+        translator = open_translator(load_path, batch_size)
+
+    try:
+        window = []
+        for sentence in sentences:
+            window.append(translator.encode(sentence))
+            if len(window) == translator.batch_size * sort_window:
+                for translation in _translate_window(translator, window):
+                    yield translation
+                window = []
+
+        if window:
+            for translation in _translate_window(translator, window):
+                yield translation
+    finally:
+        if own_translator:
+            translator.close()
+
+
+def translate_many(sentences, translator=None, load_path=None, batch_size=256, sort_window=8):
+    """
+    Translate a list of sentences in full batches
+    :param sentences: List of English strings
+    :param translator: Translator to reuse, a new one is restored from load_path otherwise
+    :param load_path: Checkpoint path, defaults to the path saved with helper.save_params
+    :param batch_size: Batch size the inference graph was built with
+    :param sort_window: Number of batches read ahead and regrouped by sentence length
+    :return: List of French strings in input order
+    """
+    return list(translate_iter(sentences, translator, load_path, batch_size, sort_window))
+
+
+def translate_file(source_file, target_file, translator=None, load_path=None, batch_size=256, sort_window=8):
+    """
+    Translate a file line by line without reading it into memory
+    :param source_file: Path of the English file, one sentence per line
+    :param target_file: Path to write the French translations to, one per line
+    :param translator: Translator to reuse, a new one is restored from load_path otherwise
+    :param load_path: Checkpoint path, defaults to the path saved with helper.save_params
+    :param batch_size: Batch size the inference graph was built with
+    :param sort_window: Number of batches read ahead and regrouped by sentence length
+    :return: Number of translated lines
+    """
+    line_count = 0
+    with open(source_file, 'r', encoding='utf-8') as in_file, open(target_file, 'w', encoding='utf-8') as out_file:
+        lines = (line.rstrip('\n') for line in in_file)
+        for translation in translate_iter(lines, translator, load_path, batch_size, sort_window):
+            out_file.write(translation + '\n')
+            line_count += 1
+
+    return line_count
 
-        input_data = loaded_graph.get_tensor_by_name('input:0')
-        logits = loaded_graph.get_tensor_by_name('predictions:0')
-        target_sequence_length = loaded_graph.get_tensor_by_name('target_sequence_length:0')
-        source_sequence_length = loaded_graph.get_tensor_by_name('source_sequence_length:0')
-        keep_prob = loaded_graph.get_tensor_by_name('keep_prob:0')
 
-        translate_logits = sess.run(logits, {input_data: [translate_sentence]*batch_size,
-                                             target_sequence_length: [len(translate_sentence)*2]*batch_size,
-                                             source_sequence_length: [len(translate_sentence)]*batch_size,
-                                             keep_prob: 1.0})[0]
+def translate(translate_sentence='he saw a old yellow truck .', load_path=None, batch_size=256,
+              mode='greedy', length_penalty=0.0, cache=None):
+
+    translator = open_translator(load_path, batch_size, mode, length_penalty, cache=cache)
+    try:
+        translate_sentence = translator.encode(translate_sentence)
+        translate_logits = translator.translate_batch([translate_sentence])[0]
+    finally:
+        translator.close()
 
     print('Input')
     print('  Word Ids:      {}'.format([i for i in translate_sentence]))
-    print('  English Words: {}'.format([source_int_to_vocab[i] for i in translate_sentence]))
+    print('  English Words: {}'.format([translator.source_int_to_vocab[i] for i in translate_sentence]))
 
     print('\nTranslation Attempt :)')
     print('  Word Ids:      {}'.format([i for i in translate_logits]))
-    print('  French Words: {}'.format(" ".join([target_int_to_vocab[i] for i in translate_logits])))
+    print('  French Words: {}'.format(translator.decode(translate_logits)))
+
+
+def export_inference_graph(export_path, load_path=None):
+    """
+    Write a frozen graph with only the inference path, its variables folded to constants
+    :param export_path: Path of the .pb file to write
+    :param load_path: Checkpoint path, defaults to the path saved with helper.save_params
+    :return: Names of the exported output tensors
+    """
+    load_path = load_path or helper.load_params()
+
+    register_cell_ops()
+    loaded_graph = tf.Graph()
+    with tf.Session(graph=loaded_graph) as sess:
+        loader = tf.train.import_meta_graph(load_path + '.meta', clear_devices=True)
+        loader.restore(sess, load_path)
+
+        # keeping only what the predictions depend on drops the optimizer, its slots and the training decoder
+        node_names = set(node.name for node in loaded_graph.as_graph_def().node)
+        output_names = [name for name in ('predictions', 'beam_predictions') if name in node_names]
+        frozen_graph_def = tf.graph_util.convert_variables_to_constants(sess, loaded_graph.as_graph_def(),
+                                                                        output_names)
+
+    with open(export_path, 'wb') as out_file:
+        out_file.write(frozen_graph_def.SerializeToString())
+
+    return output_names
 
 
 def run_tests():
 
+    import evaluation
+    import numpy_inference
     import problem_unittests as t
+    import translation_server
 
     t.test_decoding_layer(decoding_layer)
     t.test_decoding_layer_infer(decoding_layer_infer)
@@ -480,82 +1639,227 @@ def run_tests():
     t.test_model_inputs(model_inputs)
     t.test_process_encoding_input(process_decoder_input)
     t.test_sentence_to_seq(sentence_to_seq)
+    t.test_sentence_encoder(SentenceEncoder, SentenceDecoder)
     t.test_seq2seq_model(seq2seq_model)
+    t.test_cell_backends(seq2seq_model)
+    t.test_numpy_inference(build_train_graph, default_params, numpy_inference.export_weights,
+                           numpy_inference.NumpySeq2Seq)
+    t.test_numpy_compaction(numpy_inference.NumpySeq2Seq)
+    t.test_quantize_array(numpy_inference.quantize_array)
     t.test_text_to_ids(text_to_ids)
+    t.test_create_lookup_tables(helper.create_lookup_tables)
+    t.test_micro_batcher(translation_server.MicroBatcher)
+    t.test_get_batches(get_batches)
+    t.test_get_bucketed_batches(get_bucketed_batches)
+    t.test_masked_accuracy(masked_accuracy)
+    t.test_corpus_bleu(evaluation.corpus_bleu)
+    t.test_translation_cache(translation_cache.TranslationCache)
+    t.test_prefetcher(Prefetcher)
+    t.test_async_checkpointer(AsyncCheckpointer)
+    t.test_towers(build_train_graph, default_params)
+    t.test_sampled_softmax(build_train_graph, default_params)
+    t.test_average_gradients(average_gradients)
+    t.test_metrics_logger(training_metrics.MetricsLogger, training_metrics.load_metrics)
+
+
+def _str_to_bool(value):
+    return value.lower() in ('1', 'true', 'yes', 'on')
+
+
+def _int_list(value):
+    return [int(item) for item in value.split(',') if item.strip()]
+
+
+# Hyperparameters and options of the script, each one can be set on the command line as --name
+PARAMS = [
+    ('epochs', 5, int, 'Number of Epochs'),
+    ('batch_size', 256, int, 'Batch Size'),
+    ('rnn_size', 256, int, 'RNN Size'),
+    ('num_layers', 2, int, 'Number of Layers'),
+    ('encoding_embedding_size', 128, int, 'Encoder Embedding Size'),
+    ('decoding_embedding_size', 128, int, 'Decoder Embedding Size'),
+    ('learning_rate', 0.001, float, 'Learning Rate'),
+    ('keep_probability', 0.9, float, 'Dropout Keep Probability'),
+    ('display_step', 25, int, 'Steps between evaluations on the validation set, 0 to only evaluate by time'),
+    ('eval_secs', 0, int, 'Seconds between evaluations on the validation set, 0 to only evaluate by steps'),
+    ('valid_batches', 1, int, 'Batches of sentences held out for validation'),
+    ('eval_batches', 0, int, 'Validation batches scored per evaluation, taken in turn, 0 for all of them'),
+    ('eval_train', True, _str_to_bool, 'Also score the current training batch at each evaluation'),
+    ('eval_process', False, _str_to_bool,
+     'Score the latest checkpoint in a separate process instead of evaluating during training'),
+    ('eval_timeout', 600, int, 'Seconds the evaluation process waits for a new checkpoint before it stops'),
+    ('eval_metrics_path', None, str, 'File the evaluation process writes its validation accuracy to'),
+    ('cell_backend', 'lstm', str,
+     "LSTM kernels, 'lstm' per step ops, 'block' LSTMBlockCell or 'fused' LSTMBlockFusedCell in the encoder, "
+     'checkpoints load with any of them'),
+    ('beam_width', 0, int,
+     'Beam Width of an additional beam search decoder for translate --mode beam, 0 builds the greedy decoder only'),
+    ('num_sampled', 0, int, 'Words sampled per target word for a sampled softmax training loss, 0 for the full softmax'),
+    ('num_towers', 1, int, 'Model replicas each batch is split across, their gradients are averaged'),
+    ('num_buckets', 10, int, 'Number of Length Buckets, 0 batches the sentences in file order'),
+    ('prefetch_depth', 2, int, 'Batches padded ahead on a background thread, 0 pads each batch between steps'),
+    ('streaming_preprocess', True, _str_to_bool,
+     'Preprocess line by line with bounded memory instead of holding the whole corpus in memory'),
+    ('preprocess_workers', 1, int, 'Number of processes to preprocess with, more than 1 uses parallel_preprocess'),
+    ('max_vocab_size', None, int, 'Vocabulary Size including the special codes, None keeps every word'),
+    ('min_word_count', 1, int, 'Words seen fewer times than this map to <UNK>'),
+    ('source_path', source_path, str, 'Source text, one sentence per line'),
+    ('target_path', target_path, str, 'Target text, one sentence per line'),
+    ('save_path', save_path, str, 'Checkpoint path to save the trained model to'),
+    ('checkpoint_dir', 'checkpoints/train', str, 'Directory of the periodic checkpoints training resumes from'),
+    ('checkpoint_steps', 1000, int, 'Steps between periodic checkpoints, 0 to only save by time'),
+    ('checkpoint_secs', 600, int, 'Seconds between periodic checkpoints, 0 to only save by steps'),
+    ('keep_checkpoints', 5, int, 'Number of most recent periodic checkpoints kept'),
+    ('resume', True, _str_to_bool, 'Resume from the latest checkpoint in checkpoint_dir'),
+    ('metrics_path', None, str, 'File to write per step training metrics to, CSV if it ends with .csv else JSON lines'),
+    ('tensorboard_dir', None, str, 'Directory to write the per step metrics to as TensorBoard summaries'),
+    ('trace_steps', [], _int_list, 'Comma separated global steps to capture a TensorFlow timeline trace of'),
+    ('trace_dir', 'traces', str, 'Directory of the timeline-<step>.json traces, open them at chrome://tracing'),
+]
+
+
+def default_params(**overrides):
+    """
+    Get the script's hyperparameters and options
+    :param overrides: Values to use instead of the defaults in PARAMS
+    :return: argparse.Namespace with one attribute per entry of PARAMS
+    """
+    params = argparse.Namespace(**{name: default for name, default, _, _ in PARAMS})
+    for name, value in overrides.items():
+        if not hasattr(params, name):
+            raise ValueError('Unknown parameter {}'.format(name))
+        setattr(params, name, value)
+    return params
 
 
-if __name__ == '__main__':
-
-    # Number of Epochs
-    epochs = 5
-    # Batch Size
-    batch_size = 256
-    # RNN Size
-    rnn_size = 256
-    # Number of Layers
-    num_layers = 2
-    # Embedding Size
-    encoding_embedding_size = 128
-    decoding_embedding_size = 128
-    # Learning Rate
-    learning_rate = 0.001
-    # Dropout Keep Probability
-    keep_probability = 0.9
-    display_step = 25
-
-    # preprocess and save data for later use
-    helper.preprocess_and_save_data(source_path, target_path, text_to_ids)
-    (source_int_text, target_int_text), (source_vocab_to_int, target_vocab_to_int), _ = helper.load_preprocess()
-
-    # building the model
-    (source_int_text, target_int_text), (source_vocab_to_int, target_vocab_to_int), _ = helper.load_preprocess()
-    max_target_sentence_length = max([len(sentence) for sentence in source_int_text])
-
-    train_graph = tf.Graph()
-    with train_graph.as_default():
-        input_data, targets, lr, keep_prob, target_sequence_length, max_target_sequence_length, source_sequence_length = model_inputs()
-
-        #sequence_length = tf.placeholder_with_default(max_target_sentence_length, None, name='sequence_length')
-        input_shape = tf.shape(input_data)
-
-        train_logits, inference_logits = seq2seq_model(tf.reverse(input_data, [-1]),
-                                                       targets,
-                                                       keep_prob,
-                                                       batch_size,
-                                                       source_sequence_length,
-                                                       target_sequence_length,
-                                                       max_target_sequence_length,
-                                                       len(source_vocab_to_int),
-                                                       len(target_vocab_to_int),
-                                                       encoding_embedding_size,
-                                                       decoding_embedding_size,
-                                                       rnn_size,
-                                                       num_layers,
-                                                       target_vocab_to_int)
-
-
-        training_logits = tf.identity(train_logits.rnn_output, name='logits')
-        inference_logits = tf.identity(inference_logits.sample_id, name='predictions')
+def add_param_arguments(parser):
+    for name, default, value_type, help_text in PARAMS:
+        parser.add_argument('--' + name.replace('_', '-'), dest=name, type=value_type, default=default,
+                            help='{} (default: {})'.format(help_text, default))
 
-        masks = tf.sequence_mask(target_sequence_length, max_target_sequence_length, dtype=tf.float32, name='masks')
 
-        with tf.name_scope("optimization"):
-            # Loss function
-            cost = tf.contrib.seq2seq.sequence_loss(
-                training_logits,
-                targets,
-                masks)
+def param_argv(params):
+    """
+    :return: Command line arguments that recreate params
+    """
+    argv = []
+    for name, _, _, _ in PARAMS:
+        value = getattr(params, name)
+        if value is None:
+            continue
+        if isinstance(value, list):
+            value = ','.join(str(item) for item in value)
+        argv += ['--' + name.replace('_', '-'), str(value)]
+    return argv
+
+
+def preprocess(params):
+    """
+    Preprocess the corpus at params.source_path and params.target_path to the binary format
+    """
+    if params.preprocess_workers > 1:
+        import parallel_preprocess
+        parallel_preprocess.preprocess_and_save_data_parallel(params.source_path, params.target_path,
+                                                              workers=params.preprocess_workers,
+                                                              max_size=params.max_vocab_size,
+                                                              min_count=params.min_word_count)
+    elif params.streaming_preprocess:
+        helper.preprocess_and_save_data_streaming(params.source_path, params.target_path,
+                                                  max_size=params.max_vocab_size, min_count=params.min_word_count)
+    else:
+        helper.preprocess_and_save_data(params.source_path, params.target_path, text_to_ids, binary=True,
+                                        max_size=params.max_vocab_size, min_count=params.min_word_count)
 
-            # Optimizer
-            optimizer = tf.train.AdamOptimizer(lr)
 
-            # Gradient Clipping
-            gradients = optimizer.compute_gradients(cost)
-            capped_gradients = [(tf.clip_by_value(grad, -1., 1.), var) for grad, var in gradients if grad is not None]
-            train_op = optimizer.apply_gradients(capped_gradients)
+def train(params):
+    """
+    Build the model and train it on the preprocessed corpus
+    """
+    (source_int_text, target_int_text), (source_vocab_to_int, target_vocab_to_int), _ = helper.load_preprocess_binary()
+
+    evaluator = None
+    if params.eval_process:
+        # a fresh interpreter rather than a fork of one that has already started TensorFlow
+        evaluator = subprocess.Popen([sys.executable, os.path.abspath(__file__), 'evaluate-checkpoints'] +
+                                     param_argv(params))
+
+    try:
+        model = build_train_graph(params, len(source_vocab_to_int), len(target_vocab_to_int), target_vocab_to_int)
+        train_model(model, params, source_int_text, target_int_text, source_vocab_to_int, target_vocab_to_int)
+    except BaseException:
+        # the final checkpoint the evaluator waits for never comes, stop it instead of waiting out eval_timeout
+        if evaluator:
+            evaluator.terminate()
+            evaluator.wait()
+        raise
+
+    # let it score the final checkpoint
+    if evaluator:
+        evaluator.wait()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Translate English to French with a sequence to sequence model')
+    subparsers = parser.add_subparsers(dest='command')
+
+    preprocess_parser = subparsers.add_parser('preprocess', help='Preprocess the corpus to the binary format')
+    add_param_arguments(preprocess_parser)
+
+    train_parser = subparsers.add_parser('train', help='Train on the preprocessed corpus')
+    add_param_arguments(train_parser)
+
+    evaluate_checkpoints_parser = subparsers.add_parser('evaluate-checkpoints',
+                                                        help='Score checkpoints as training writes them')
+    add_param_arguments(evaluate_checkpoints_parser)
+
+    translate_parser = subparsers.add_parser('translate', help='Translate sentences or a file')
+    translate_parser.add_argument('sentences', nargs='*', help='English sentences to translate')
+    translate_parser.add_argument('--file', default=None, help='English file to translate line by line')
+    translate_parser.add_argument('--out', default=None, help='File to write the translations of --file to')
+    translate_parser.add_argument('--load-path', default=None,
+                                  help='Checkpoint, frozen .pb graph or NumPy .npz weights, defaults to the one in '
+                                       'params.p')
+    translate_parser.add_argument('--batch-size', type=int, default=256, help='Batch size the model was built with')
+    translate_parser.add_argument('--mode', choices=['greedy', 'beam'], default='greedy', help='Decoding mode')
+    translate_parser.add_argument('--length-penalty', type=float, default=0.0,
+                                  help='Length penalty weight for beam search')
+    translate_parser.add_argument('--max-length-ratio', type=float, default=2.0,
+                                  help='Translations are cut at this ratio times the source length plus '
+                                       '--max-length-offset')
+    translate_parser.add_argument('--max-length-offset', type=int, default=0)
+    translate_parser.add_argument('--cache-path', default=None,
+                                  help='SQLite file keeping translations between runs, keyed on the model and its decode '
+                                       'settings')
+
+    args = parser.parse_args(argv)
+
+    if args.command == 'preprocess':
+        preprocess(args)
+    elif args.command == 'train':
+        train(args)
+    elif args.command == 'evaluate-checkpoints':
+        evaluate_checkpoints(args)
+    elif args.command == 'translate':
+        cache = translation_cache.TranslationCache(path=args.cache_path) if args.cache_path else None
+        translator = open_translator(args.load_path, args.batch_size, args.mode, args.length_penalty,
+                                     args.max_length_ratio, args.max_length_offset, cache)
+        try:
+            if args.file:
+                line_count = translate_file(args.file, args.out or args.file + '.translated', translator)
+                print('Translated {} lines'.format(line_count))
+            for sentence, translation in zip(args.sentences, translate_many(args.sentences, translator)):
+                print('{}\n  {}'.format(sentence, translation))
+        finally:
+            translator.close()
+            if cache:
+                cache.close()
+    else:
+        # preprocess, train and translate the example sentence like the notebook
+        params = default_params()
+        preprocess(params)
+        train(params)
+        translate(batch_size=params.batch_size)
 
-    # train the built model
-    train_model()
 
-    # translate English to French by passing English phrase to translate
-    translate()
+if __name__ == '__main__':
+    main()
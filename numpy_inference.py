@@ -0,0 +1,467 @@
+import argparse
+import math
+import os
+import re
+import time
+
+import numpy as np
+
+import helper
+
+# variables of build_train_graph, the optimizer's slots and the global step are left out of the export
+ENCODER_EMBEDDINGS = 'EmbedSequence/embeddings'
+DECODER_EMBEDDINGS = 'dec_embeddings'
+ENCODER_CELL = re.compile(r'^rnn/multi_rnn_cell/cell_(\d+)/lstm_cell/(kernel|bias)$')
+DECODER_CELL = re.compile(r'^decoder/(?:.*/)?multi_rnn_cell/cell_(\d+)/lstm_cell/(kernel|bias)$')
+OUTPUT_LAYER = re.compile(r'^decoder/(?:.*/)?dense(?:_\d+)?/(kernel|bias)$')
+
+
+def export_weights(export_path, load_path=None):
+    """
+    Dump the embedding, LSTM and output layer weights of a checkpoint to a single .npz file
+    :param export_path: Path of the .npz file to write
+    :param load_path: Checkpoint path, defaults to the path saved with helper.save_params
+    :return: Dictionary of the exported arrays
+    """
+    import tensorflow as tf
+
+    load_path = load_path or helper.load_params()
+    reader = tf.train.NewCheckpointReader(load_path)
+    names = [name for name in reader.get_variable_to_shape_map() if 'Adam' not in name]
+
+    weights = {'encoder_embeddings': reader.get_tensor(ENCODER_EMBEDDINGS),
+               'decoder_embeddings': reader.get_tensor(DECODER_EMBEDDINGS)}
+    for prefix, pattern in (('encoder', ENCODER_CELL), ('decoder', DECODER_CELL)):
+        for name in names:
+            match = pattern.match(name)
+            if match:
+                weights['{}_{}_{}'.format(prefix, match.group(2), match.group(1))] = reader.get_tensor(name)
+    for name in names:
+        match = OUTPUT_LAYER.match(name)
+        if match:
+            weights['output_' + match.group(1)] = reader.get_tensor(name)
+
+    if 'output_kernel' not in weights or 'encoder_kernel_0' not in weights or 'decoder_kernel_0' not in weights:
+        raise ValueError('{} is not a checkpoint of build_train_graph, found {}'.format(load_path, sorted(names)))
+
+    # older checkpoints reverse the whole padded input instead of each sentence within its length
+    meta_graph_def = tf.MetaGraphDef()
+    with open(load_path + '.meta', 'rb') as in_file:
+        meta_graph_def.ParseFromString(in_file.read())
+    weights['reverse_within_lengths'] = np.array(any(node.op == 'ReverseSequence'
+                                                     for node in meta_graph_def.graph_def.node))
+
+    np.savez(export_path, **weights)
+    return weights
+
+
+def quantize_array(array, axis):
+    """
+    Quantize to int8 with one float32 scale per channel
+    :param array: float32 array
+    :param axis: Axis each scale is taken over, 0 for one scale per column and 1 for one per row
+    :return: Tuple (int8 values, float32 scales that broadcast against them)
+    """
+    scales = np.abs(array).max(axis=axis, keepdims=True) / 127.0
+    scales[scales == 0] = 1.0
+    values = np.clip(np.round(array / scales), -127, 127).astype(np.int8)
+    return values, scales.astype(np.float32)
+
+
+def quantize_weights(export_path, load_path):
+    """
+    Write an int8 copy of the weights from export_weights, with per column scales for the kernels and
+    per word scales for the embeddings, the biases stay float32. NumpySeq2Seq dequantizes it once when loading,
+    so it only shrinks the file
+    :param export_path: Path of the .npz file to write
+    :param load_path: .npz file written by export_weights
+    :return: Dictionary of the exported arrays
+    """
+    quantized = {'quantized': np.array(True)}
+    with np.load(load_path) as weights:
+        for name in weights.files:
+            if name.endswith('_kernel') or '_kernel_' in name:
+                quantized[name], quantized[name + '_scales'] = quantize_array(weights[name], axis=0)
+            elif name.endswith('_embeddings'):
+                quantized[name], quantized[name + '_scales'] = quantize_array(weights[name], axis=1)
+            else:
+                quantized[name] = weights[name]
+
+    np.savez(export_path, **quantized)
+    return quantized
+
+
+def _load_matrix(weights, name):
+    # int8 weights are dequantized once here, NumPy has no int8 matrix multiply and would convert them to float32 on
+    # every product otherwise
+    if name + '_scales' not in weights:
+        return weights[name]
+    return weights[name] * weights[name + '_scales']
+
+
+def _sigmoid(x):
+    # written with tanh so large negative inputs don't overflow exp
+    return 0.5 * np.tanh(0.5 * x) + 0.5
+
+
+def lstm_step(input_gates, state, kernel, forget_bias=1.0):
+    """
+    One step of tf.contrib.rnn.LSTMCell for a whole batch
+    :param input_gates: The inputs already multiplied with the input rows of the kernel, plus the bias
+    :param state: Tuple (c, h) of the previous step
+    :param kernel: Rows of the kernel multiplying h
+    :param forget_bias: Added to the forget gate like LSTMCell does
+    :return: New state tuple (c, h)
+    """
+    c, h = state
+    gates = input_gates + np.dot(h, kernel)
+    i, j, f, o = np.split(gates, 4, axis=1)
+    c = _sigmoid(f + forget_bias) * c + _sigmoid(i) * np.tanh(j)
+    return c, _sigmoid(o) * np.tanh(c)
+
+
+class NumpySeq2Seq(object):
+    """
+    The inference path of build_train_graph in NumPy, vectorized over the batch, each decoder step only runs the
+    sentences still decoding
+    """
+
+    def __init__(self, load_path):
+        """
+        :param load_path: .npz file written by export_weights or quantize_weights, int8 weights are held as float32
+        """
+        self.go = helper.CODES['<GO>']
+        self.eos = helper.CODES['<EOS>']
+        with np.load(load_path) as weights:
+            self.reverse_within_lengths = bool(weights['reverse_within_lengths'])
+            self.encoder_layers = self._load_layers(weights, 'encoder')
+            self.decoder_layers = self._load_layers(weights, 'decoder')
+            self.output_kernel = _load_matrix(weights, 'output_kernel')
+            self.output_bias = weights['output_bias']
+
+    def _load_layers(self, weights, prefix):
+        embeddings = _load_matrix(weights, prefix + '_embeddings')
+        layers = []
+        layer_i = 0
+        while '{}_kernel_{}'.format(prefix, layer_i) in weights.files:
+            kernel = _load_matrix(weights, '{}_kernel_{}'.format(prefix, layer_i))
+            bias = weights['{}_bias_{}'.format(prefix, layer_i)]
+            input_size = kernel.shape[0] - kernel.shape[1] // 4
+            input_kernel, kernel = kernel[:input_size], kernel[input_size:]
+
+            input_table = None
+            if layer_i == 0:
+                # the first layer's inputs are embeddings, so their product with the kernel is looked up per word
+                input_table = np.dot(embeddings, input_kernel) + bias
+            layers.append((input_table, input_kernel, bias, kernel))
+            layer_i += 1
+        return layers
+
+    def weight_bytes(self):
+        """
+        :return: Bytes of the weights held in memory
+        """
+        matrices = [self.output_kernel, self.output_bias]
+        for input_table, input_kernel, bias, kernel in self.encoder_layers + self.decoder_layers:
+            matrices += [matrix for matrix in (input_table, input_kernel, bias, kernel) if matrix is not None]
+        return sum(matrix.nbytes for matrix in matrices)
+
+    def encode_batch(self, source_batch, source_lengths):
+        """
+        Run the encoder like encoding_layer's dynamic_rnn, rows stop updating past their own length
+        :param source_batch: int array of padded source ids of shape (batch, time), not reversed
+        :param source_lengths: Length of each sentence
+        :return: Tuple of one (c, h) state per layer
+        """
+        source_batch = np.asarray(source_batch)
+        source_lengths = np.asarray(source_lengths)
+        batch_size, max_length = source_batch.shape
+        positions = np.arange(max_length)
+        if self.reverse_within_lengths:
+            reverse_positions = source_lengths[:, None] - 1 - positions
+            source_batch = np.where(reverse_positions >= 0,
+                                    source_batch[np.arange(batch_size)[:, None], np.maximum(reverse_positions, 0)],
+                                    source_batch)
+        else:
+            source_batch = source_batch[:, ::-1]
+            source_lengths = np.full(batch_size, max_length)
+        running = positions[:, None] < source_lengths[None, :]
+
+        layer_inputs = None
+        states = []
+        for input_table, input_kernel, bias, kernel in self.encoder_layers:
+            rnn_size = bias.shape[0] // 4
+            # every step's input product in one matrix multiply
+            if input_table is not None:
+                input_gates = input_table[source_batch]
+            else:
+                input_gates = np.dot(layer_inputs, input_kernel) + bias
+            state = (np.zeros((batch_size, rnn_size), dtype=bias.dtype),
+                     np.zeros((batch_size, rnn_size), dtype=bias.dtype))
+            outputs = np.zeros((batch_size, max_length, rnn_size), dtype=bias.dtype)
+            for step in range(max_length):
+                c, h = lstm_step(input_gates[:, step], state, kernel)
+                step_running = running[step][:, None]
+                state = (np.where(step_running, c, state[0]), np.where(step_running, h, state[1]))
+                outputs[:, step] = np.where(step_running, h, 0.0)
+            layer_inputs = outputs
+            states.append(state)
+        return tuple(states)
+
+    def predict(self, source_batch, source_lengths, target_lengths):
+        """
+        Greedy decoding like decoding_layer_infer, the NumPy counterpart of running 'predictions:0'
+        :param source_batch: int array of padded source ids of shape (batch, time)
+        :param source_lengths: Length of each source sentence
+        :param target_lengths: Most words of each translation
+        :return: int32 array of predicted ids of shape (batch, decoded steps), <PAD> after each sentence finished
+        """
+        states = self.encode_batch(source_batch, source_lengths)
+        target_lengths = np.asarray(target_lengths)
+        batch_size = len(target_lengths)
+        max_length = int(target_lengths.max()) if batch_size else 0
+        predictions = np.full((batch_size, max_length), helper.CODES['<PAD>'], dtype=np.int32)
+
+        # rows of the sentences still decoding, finished ones are dropped from the states instead of masked
+        active = np.flatnonzero(target_lengths > 0)
+        states = [(c[active], h[active]) for c, h in states]
+        sample_ids = np.full(len(active), self.go)
+        step = 0
+        while len(active) and step < max_length:
+            layer_inputs = None
+            for layer_i, (input_table, input_kernel, bias, kernel) in enumerate(self.decoder_layers):
+                if input_table is not None:
+                    input_gates = input_table[sample_ids]
+                else:
+                    input_gates = np.dot(layer_inputs, input_kernel) + bias
+                states[layer_i] = lstm_step(input_gates, states[layer_i], kernel)
+                layer_inputs = states[layer_i][1]
+
+            logits = np.dot(layer_inputs, self.output_kernel) + self.output_bias
+            sample_ids = np.argmax(logits, axis=1).astype(np.int32)
+            predictions[active, step] = sample_ids
+            step += 1
+
+            running = (sample_ids != self.eos) & (step < target_lengths[active])
+            if not running.all():
+                active = active[running]
+                sample_ids = sample_ids[running]
+                states = [(c[running], h[running]) for c, h in states]
+
+        return predictions[:, :step]
+
+
+class NumpyTranslator(object):
+    """
+    Translator counterpart that decodes with NumpySeq2Seq, without importing TensorFlow
+    """
+
+    def __init__(self, load_path, batch_size=256, max_length_ratio=2.0, max_length_offset=0):
+        """
+        :param load_path: .npz file written by export_weights or quantize_weights
+        :param batch_size: Most sentences translate_batch is given at once, the NumPy model takes any batch size
+        :param max_length_ratio: Each translation is cut at max_length_ratio * source length + max_length_offset words
+        :param max_length_offset: See max_length_ratio
+        """
+        import language_translation
+
+        (self.source_vocab_to_int, self.target_vocab_to_int), \
+            (self.source_int_to_vocab, self.target_int_to_vocab) = helper.load_vocab()
+        self.load_path = load_path
+        self.batch_size = batch_size
+        self.max_length_ratio = max_length_ratio
+        self.max_length_offset = max_length_offset
+        self.cache = None
+        self.encoder = language_translation.SentenceEncoder(self.source_vocab_to_int)
+        self.decoder = language_translation.SentenceDecoder(self.target_int_to_vocab)
+        self.model = NumpySeq2Seq(load_path)
+
+    def encode(self, sentence):
+        """
+        :param sentence: English string
+        :return: List of source word ids
+        """
+        return self.encoder.encode(sentence)
+
+    def decode(self, sentence_ids):
+        """
+        :param sentence_ids: List of target word ids
+        :return: French string
+        """
+        return self.decoder.decode(sentence_ids)
+
+    def max_target_length(self, source_length):
+        """
+        :param source_length: Number of words in the source sentence
+        :return: Most words the sentence's translation may have
+        """
+        return max(int(math.ceil(self.max_length_ratio * source_length + self.max_length_offset)), 1)
+
+    def translate_batch(self, sentences):
+        """
+        Translate a batch of sentences
+        :param sentences: List of source word id lists
+        :return: List of target word id lists, cut at <EOS>
+        """
+        if not sentences:
+            return []
+        import language_translation
+
+        source_batch, source_lengths = language_translation.pad_batch(sentences, self.source_vocab_to_int['<PAD>'])
+        target_lengths = [self.max_target_length(len(sentence)) for sentence in sentences]
+        return self.decoder.cut_batch(self.model.predict(source_batch, source_lengths, target_lengths))
+
+    def close(self):
+        pass
+
+
+def parity(npz_path, load_path=None, batch_size=256, sentences=1024, valid_batches=1):
+    """
+    Decode held-out sentences with the TensorFlow graph's 'predictions:0' and with NumpyTranslator
+    :return: Dictionary of the fraction of identical translations and each engine's decoding time
+    """
+    import language_translation
+
+    (source_int_text, target_int_text), _, _ = helper.load_preprocess_binary()
+    params = language_translation.default_params(batch_size=batch_size, valid_batches=valid_batches)
+    _, _, valid_source, _ = language_translation.split_validation(source_int_text, target_int_text, params)
+    sources = [valid_source[i] for i in range(min(sentences, len(valid_source)))]
+
+    results = {'sentences': len(sources)}
+    for engine, translator in (('tensorflow', lambda: language_translation.Translator(load_path, batch_size)),
+                               ('numpy', lambda: NumpyTranslator(npz_path, batch_size))):
+        start = time.perf_counter()
+        translator = translator()
+        load_seconds = time.perf_counter() - start
+        try:
+            start = time.perf_counter()
+            results[engine] = [translation for start_i in range(0, len(sources), batch_size)
+                               for translation in translator.translate_batch(sources[start_i:start_i + batch_size])]
+            results[engine + '_seconds'] = time.perf_counter() - start
+            results[engine + '_load_seconds'] = load_seconds
+        finally:
+            translator.close()
+
+    results['agreement'] = np.mean([tf_ids == np_ids for tf_ids, np_ids in zip(results.pop('tensorflow'),
+                                                                               results.pop('numpy'))])
+    return results
+
+
+def quantization_report(float_path, quantized_path, batch_size=256, sentences=1024, valid_batches=1):
+    """
+    Translate held-out sentences with the float32 and the int8 weights and compare them
+    :param float_path: .npz file written by export_weights
+    :param quantized_path: .npz file written by quantize_weights
+    :return: Dictionary of agreement, BLEU against the references, batch latencies and sizes of each model
+    """
+    import evaluation
+    import language_translation
+
+    (source_int_text, target_int_text), _, _ = helper.load_preprocess_binary()
+    params = language_translation.default_params(batch_size=batch_size, valid_batches=valid_batches)
+    _, _, valid_source, valid_target = language_translation.split_validation(source_int_text, target_int_text,
+                                                                              params)
+    sample = range(min(sentences, len(valid_source)))
+    sources = [valid_source[i] for i in sample]
+    eos = helper.CODES['<EOS>']
+    references = [[word_id for word_id in valid_target[i] if word_id != eos] for i in sample]
+
+    results = {'sentences': len(sources)}
+    translations = {}
+    for name, path in (('float', float_path), ('int8', quantized_path)):
+        translator = NumpyTranslator(path, batch_size)
+        translations[name] = []
+        latencies = []
+        for start_i in range(0, len(sources), batch_size):
+            start = time.perf_counter()
+            translations[name] += translator.translate_batch(sources[start_i:start_i + batch_size])
+            latencies.append(time.perf_counter() - start)
+
+        latencies = np.array(latencies) * 1000
+        results[name] = {'file_bytes': os.path.getsize(path),
+                         'weight_bytes': translator.model.weight_bytes(),
+                         'bleu': evaluation.corpus_bleu(references, translations[name]),
+                         'batch_ms_mean': float(np.mean(latencies)),
+                         'batch_ms_p90': float(np.percentile(latencies, 90))}
+
+    results['identical'] = float(np.mean([float_ids == int8_ids for float_ids, int8_ids in
+                                          zip(translations['float'], translations['int8'])]))
+    results['token_agreement'] = evaluation.token_accuracy(translations['float'], translations['int8'])
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Translate with NumPy from weights exported out of a checkpoint')
+    subparsers = parser.add_subparsers(dest='command')
+
+    export_parser = subparsers.add_parser('export', help='Write the checkpoint weights to a .npz file')
+    export_parser.add_argument('export_path', help='Path of the .npz file to write')
+    export_parser.add_argument('--load-path', default=None, help='Checkpoint path, defaults to the one in params.p')
+
+    translate_parser = subparsers.add_parser('translate', help='Translate sentences without TensorFlow')
+    translate_parser.add_argument('npz_path', help='File written by export')
+    translate_parser.add_argument('sentences', nargs='+', help='English sentences to translate')
+
+    quantize_parser = subparsers.add_parser('quantize', help='Write int8 weights with per channel scales')
+    quantize_parser.add_argument('npz_path', help='File written by export')
+    quantize_parser.add_argument('export_path', help='Path of the int8 .npz file to write')
+
+    report_parser = subparsers.add_parser('quantization-report',
+                                          help='Compare the int8 with the float32 translations of held-out data')
+    report_parser.add_argument('npz_path', help='File written by export')
+    report_parser.add_argument('quantized_path', help='File written by quantize')
+    report_parser.add_argument('--batch-size', type=int, default=256)
+    report_parser.add_argument('--sentences', type=int, default=1024)
+    report_parser.add_argument('--valid-batches', type=int, default=1,
+                               help='Batches of sentences held out for validation, as given to training')
+
+    parity_parser = subparsers.add_parser('parity', help='Compare with the TensorFlow predictions on held-out data')
+    parity_parser.add_argument('npz_path', help='File written by export')
+    parity_parser.add_argument('--load-path', default=None, help='Checkpoint path, defaults to the one in params.p')
+    parity_parser.add_argument('--batch-size', type=int, default=256, help='Batch size the model was built with')
+    parity_parser.add_argument('--sentences', type=int, default=1024)
+    parity_parser.add_argument('--valid-batches', type=int, default=1,
+                               help='Batches of sentences held out for validation, as given to training')
+    args = parser.parse_args()
+
+    if args.command == 'export':
+        weights = export_weights(args.export_path, args.load_path)
+        print('Exported {} arrays, {} bytes, to {}'.format(len(weights), sum(array.nbytes for array in
+                                                                             weights.values()), args.export_path))
+    elif args.command == 'translate':
+        translator = NumpyTranslator(args.npz_path)
+        translations = translator.translate_batch([translator.encode(sentence) for sentence in args.sentences])
+        for sentence, translation in zip(args.sentences, translations):
+            print('{}\n  {}'.format(sentence, translator.decode(translation)))
+    elif args.command == 'quantize':
+        quantize_weights(args.export_path, args.npz_path)
+        print('Quantized {} ({} bytes) to {} ({} bytes)'.format(
+            args.npz_path, os.path.getsize(args.npz_path), args.export_path, os.path.getsize(args.export_path)))
+    elif args.command == 'quantization-report':
+        results = quantization_report(args.npz_path, args.quantized_path, args.batch_size, args.sentences,
+                                      args.valid_batches)
+        print('{} held-out sentences, {:.2%} identical translations, {:.2%} of the words agree'.format(
+            results['sentences'], results['identical'], results['token_agreement']))
+        print('int8 weights make the file smaller only, they are held and multiplied as float32 once loaded')
+        print('  {:<6} {:>12} {:>14} {:>8} {:>14} {:>13}'.format('model', 'file bytes', 'weight bytes', 'BLEU',
+                                                                 'mean batch ms', 'p90 batch ms'))
+        for name in ('float', 'int8'):
+            result = results[name]
+            print('  {:<6} {:>12} {:>14} {:>8.2f} {:>14.1f} {:>13.1f}'.format(
+                name, result['file_bytes'], result['weight_bytes'], result['bleu'] * 100, result['batch_ms_mean'],
+                result['batch_ms_p90']))
+    elif args.command == 'parity':
+        results = parity(args.npz_path, args.load_path, args.batch_size, args.sentences, args.valid_batches)
+        print('{} held-out sentences, {:.2%} identical translations'.format(results['sentences'],
+                                                                          results['agreement']))
+        for engine in ('tensorflow', 'numpy'):
+            print('  {:<10} load {:>7.2f} s  decode {:>7.2f} s'.format(
+                engine, results[engine + '_load_seconds'], results[engine + '_seconds']))
+        if results['agreement'] < 1.0:
+            raise SystemExit('The NumPy translations differ from the TensorFlow ones')
+    else:
+        parser.print_help()
+
+
+if __name__ == '__main__':
+    main()
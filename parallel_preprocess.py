@@ -0,0 +1,195 @@
+import argparse
+import collections
+import multiprocessing
+import os
+
+import numpy as np
+
+import helper
+
+
+def line_start_offsets(path, chunk_size=1 << 24):
+    """
+    Find where every line of a file starts without decoding it
+    :param path: Path of the text file
+    :param chunk_size: Number of bytes read at a time
+    :return: int64 array of line start byte offsets, ending with the file size
+    """
+    starts = [np.zeros(1, dtype=np.int64)]
+    position = 0
+    with open(path, 'rb') as in_file:
+        while True:
+            chunk = in_file.read(chunk_size)
+            if not chunk:
+                break
+            newlines = np.flatnonzero(np.frombuffer(chunk, dtype=np.uint8) == ord('\n'))
+            starts.append(newlines.astype(np.int64) + position + 1)
+            position += len(chunk)
+
+    starts = np.concatenate(starts)
+    if starts[-1] != position:
+        # the last line has no trailing newline
+        starts = np.append(starts, position)
+    return starts
+
+
+def make_shards(source_path, target_path, shard_lines=None, workers=1):
+    """
+    Split both files into matching ranges of whole lines
+    :param shard_lines: Number of lines per shard, defaults to four shards per worker
+    :return: Tuple (list of (source path, start, end, target path, start, end) byte ranges, number of lines)
+    """
+    source_starts = line_start_offsets(source_path)
+    target_starts = line_start_offsets(target_path)
+    if len(source_starts) != len(target_starts):
+        raise ValueError('{} and {} have a different number of lines'.format(source_path, target_path))
+
+    line_count = len(source_starts) - 1
+    if not shard_lines:
+        shard_lines = max(-(-line_count // (workers * 4)), 1)
+
+    shards = []
+    for start_i in range(0, line_count, shard_lines):
+        end_i = min(start_i + shard_lines, line_count)
+        shards.append((source_path, int(source_starts[start_i]), int(source_starts[end_i]),
+                       target_path, int(target_starts[start_i]), int(target_starts[end_i])))
+    return shards, line_count
+
+
+def _read_lines(path, start, end):
+    with open(path, 'rb') as in_file:
+        in_file.seek(start)
+        text = in_file.read(end - start).decode('utf-8').lower()
+    if text.endswith('\n'):
+        text = text[:-1]
+    return text.split('\n')
+
+
+def count_shard(shard):
+    """
+    Count the words of one shard
+    :return: Tuple (source word Counter, target word Counter)
+    """
+    source_path, source_start, source_end, target_path, target_start, target_end = shard
+    source_counts = collections.Counter()
+    target_counts = collections.Counter()
+    for line in _read_lines(source_path, source_start, source_end):
+        source_counts.update(line.split())
+    for line in _read_lines(target_path, target_start, target_end):
+        target_counts.update(line.split())
+    return source_counts, target_counts
+
+
+_shard_vocab = {}
+
+
+def _set_shard_vocab(source_vocab_to_int, target_vocab_to_int):
+    # sent once per worker process instead of with every shard
+    _shard_vocab['source'] = source_vocab_to_int
+    _shard_vocab['target'] = target_vocab_to_int
+
+
+def _encode_lines(lines, vocab_to_int, end_id=None):
+    unk = vocab_to_int['<UNK>']
+    ids = []
+    lengths = np.zeros(len(lines), dtype=np.int64)
+    for line_i, line in enumerate(lines):
+        sentence_ids = [vocab_to_int.get(word, unk) for word in line.split()]
+        if end_id is not None:
+            sentence_ids.append(end_id)
+        ids.extend(sentence_ids)
+        lengths[line_i] = len(sentence_ids)
+    return np.array(ids, dtype=np.int32), lengths
+
+
+def encode_shard(shard):
+    """
+    Convert one shard to ids with the vocabularies set by _set_shard_vocab
+    :return: Tuple (source ids, source lengths, target ids, target lengths)
+    """
+    source_path, source_start, source_end, target_path, target_start, target_end = shard
+    source_vocab_to_int = _shard_vocab['source']
+    target_vocab_to_int = _shard_vocab['target']
+
+    source_ids, source_lengths = _encode_lines(_read_lines(source_path, source_start, source_end),
+                                               source_vocab_to_int)
+    target_ids, target_lengths = _encode_lines(_read_lines(target_path, target_start, target_end),
+                                               target_vocab_to_int, target_vocab_to_int['<EOS>'])
+    return source_ids, source_lengths, target_ids, target_lengths
+
+
+def preprocess_and_save_data_parallel(source_path, target_path, path=helper.PREPROCESS_DIR,
+                                      workers=None, shard_lines=None, max_size=None, min_count=1):
+    """
+    Preprocess Text Data over a pool of processes.  Save to the binary format read by helper.load_preprocess_binary.
+    Each worker counts and then encodes its own shards of lines, read straight from the files.
+    :param source_path: Path of the source text
+    :param target_path: Path of the target text
+    :param path: Directory to save to
+    :param workers: Number of processes, defaults to the number of CPUs
+    :param shard_lines: Number of lines per shard, defaults to four shards per worker
+    :param max_size: Largest vocabulary size including the special codes, None keeps every word
+    :param min_count: Words seen fewer times are left out and map to <UNK>
+    """
+    workers = workers or os.cpu_count() or 1
+    shards, line_count = make_shards(source_path, target_path, shard_lines, workers)
+
+    pool = multiprocessing.Pool(workers) if workers > 1 else None
+    try:
+        # count the shards in parallel and merge, the sorted vocabulary doesn't depend on merge order
+        source_counts = collections.Counter()
+        target_counts = collections.Counter()
+        for shard_source_counts, shard_target_counts in (pool.imap_unordered(count_shard, shards) if pool
+                                                         else map(count_shard, shards)):
+            source_counts.update(shard_source_counts)
+            target_counts.update(shard_target_counts)
+
+        source_vocab_to_int, _ = helper.create_lookup_tables_from_counts(source_counts, max_size, min_count)
+        target_vocab_to_int, _ = helper.create_lookup_tables_from_counts(target_counts, max_size, min_count)
+
+        if pool:
+            pool.close()
+            pool.join()
+            pool = multiprocessing.Pool(workers, _set_shard_vocab, (source_vocab_to_int, target_vocab_to_int))
+        else:
+            _set_shard_vocab(source_vocab_to_int, target_vocab_to_int)
+
+        if not os.path.exists(path):
+            os.makedirs(path)
+
+        # encode the shards in parallel, writing them in order as they come back
+        source_writer = helper.IdArrayWriter(path, 'source', line_count, sum(source_counts.values()), line_count)
+        target_writer = helper.IdArrayWriter(path, 'target', line_count,
+                                              sum(target_counts.values()) + line_count, line_count)
+        for source_ids, source_lengths, target_ids, target_lengths in (pool.imap(encode_shard, shards) if pool
+                                                                       else map(encode_shard, shards)):
+            source_writer.append_chunk(source_ids, source_lengths)
+            target_writer.append_chunk(target_ids, target_lengths)
+        source_writer.close()
+        target_writer.close()
+    finally:
+        if pool:
+            pool.terminate()
+
+    helper.save_vocab(source_vocab_to_int, target_vocab_to_int, path)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Preprocess a parallel corpus over several processes')
+    parser.add_argument('source_path')
+    parser.add_argument('target_path')
+    parser.add_argument('--out', default=helper.PREPROCESS_DIR, help='Directory to save the binary corpus to')
+    parser.add_argument('--workers', type=int, default=None, help='Number of processes, defaults to the CPU count')
+    parser.add_argument('--shard-lines', type=int, default=None,
+                        help='Number of lines per shard, defaults to four shards per worker')
+    parser.add_argument('--max-vocab-size', type=int, default=None,
+                        help='Largest vocabulary size per side including the special codes')
+    parser.add_argument('--min-count', type=int, default=1, help='Words seen fewer times map to <UNK>')
+    args = parser.parse_args()
+
+    preprocess_and_save_data_parallel(args.source_path, args.target_path, args.out, args.workers, args.shard_lines,
+                                      args.max_vocab_size, args.min_count)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,10 +1,19 @@
 import numpy as np
-import tensorflow as tf
-from tensorflow.python.layers.core import Dense
 import itertools
 import collections
+import os
+import tempfile
 import helper
 
+# TensorFlow is only imported once a test needs it
+tf = helper.LazyModule('tensorflow')
+
+
+def _small_model_params(default_params, **overrides):
+    # the smallest model the build_train_graph tests train and export
+    return default_params(batch_size=4, rnn_size=16, num_layers=2, encoding_embedding_size=8,
+                          decoding_embedding_size=8, beam_width=0, **overrides)
+
 
 def _print_success_message():
     print('Tests Passed')
@@ -260,6 +269,148 @@ def test_seq2seq_model(seq2seq_model):
     _print_success_message()
 
 
+def test_cell_backends(seq2seq_model):
+    batch_size = 4
+    vocab_size = 30
+    embedding_size = 8
+    sequence_length = 6
+    rnn_size = 16
+    num_layers = 2
+    target_vocab_to_int = {'<EOS>': 1, '<GO>': 3}
+    random_state = np.random.RandomState(0)
+    feed_values = (random_state.randint(4, vocab_size, size=(batch_size, sequence_length)),
+                   random_state.randint(4, vocab_size, size=(batch_size, sequence_length)),
+                   [sequence_length, 4, 3, 1],
+                   [sequence_length] * batch_size)
+
+    def run_backend(cell_backend, restore, checkpoint_path):
+        with tf.Graph().as_default():
+            input_data = tf.placeholder(tf.int32, [batch_size, sequence_length])
+            target_data = tf.placeholder(tf.int32, [batch_size, sequence_length])
+            keep_prob = tf.placeholder(tf.float32)
+            source_sequence_length = tf.placeholder(tf.int32, (None,))
+            target_sequence_length = tf.placeholder(tf.int32, (None,))
+            _, infer_output = seq2seq_model(input_data, target_data, keep_prob, batch_size,
+                                            source_sequence_length, target_sequence_length,
+                                            tf.reduce_max(target_sequence_length), vocab_size, vocab_size,
+                                            embedding_size, embedding_size, rnn_size, num_layers,
+                                            target_vocab_to_int, cell_backend=cell_backend)
+            variables = sorted((var.op.name, var.get_shape().as_list()) for var in tf.global_variables())
+            saver = tf.train.Saver()
+            with tf.Session() as sess:
+                if restore:
+                    saver.restore(sess, checkpoint_path)
+                else:
+                    sess.run(tf.global_variables_initializer())
+                    saver.save(sess, checkpoint_path)
+                feed_dict = dict(zip([input_data, target_data, source_sequence_length, target_sequence_length],
+                                     feed_values))
+                feed_dict[keep_prob] = 1.0
+                logits = sess.run(infer_output.rnn_output, feed_dict)
+        return variables, logits
+
+    with tempfile.TemporaryDirectory() as checkpoint_dir:
+        checkpoint_path = os.path.join(checkpoint_dir, 'model')
+        lstm_variables, lstm_logits = run_backend('lstm', False, checkpoint_path)
+        for cell_backend in ('block', 'fused'):
+            variables, logits = run_backend(cell_backend, True, checkpoint_path)
+            assert variables == lstm_variables,\
+                'The {} backend has other variables than LSTMCell: {}'.format(cell_backend, variables)
+            assert np.allclose(logits, lstm_logits, atol=1e-4),\
+                'The {} backend computes other logits from the same checkpoint'.format(cell_backend)
+
+    _print_success_message()
+
+
+def test_numpy_inference(build_train_graph, default_params, export_weights, NumpySeq2Seq):
+    params = _small_model_params(default_params)
+    vocab_size = 30
+    random_state = np.random.RandomState(0)
+    source_batch = random_state.randint(4, vocab_size, size=(params.batch_size, 7))
+    source_lengths = [7, 5, 2, 1]
+    target_lengths = [9, 3, 6, 1]
+
+    with tempfile.TemporaryDirectory() as checkpoint_dir:
+        checkpoint_path = os.path.join(checkpoint_dir, 'model')
+        model = build_train_graph(params, vocab_size, vocab_size, dict(helper.CODES))
+        with tf.Session(graph=model.graph) as sess:
+            sess.run(tf.global_variables_initializer())
+            predictions = sess.run(model.graph.get_tensor_by_name('predictions:0'),
+                                   {model.input_data: source_batch, model.source_sequence_length: source_lengths,
+                                    model.target_sequence_length: target_lengths, model.keep_prob: 1.0})
+            with model.graph.as_default():
+                tf.train.Saver().save(sess, checkpoint_path)
+
+        export_weights(checkpoint_path + '.npz', checkpoint_path)
+        numpy_predictions = NumpySeq2Seq(checkpoint_path + '.npz').predict(source_batch, source_lengths,
+                                                                           target_lengths)
+
+    assert numpy_predictions.shape == predictions.shape,\
+        'Found shape {} instead of the graph\'s {}'.format(numpy_predictions.shape, predictions.shape)
+    assert np.array_equal(numpy_predictions, predictions),\
+        'The NumPy predictions {} differ from the graph\'s {}'.format(numpy_predictions.tolist(), predictions.tolist())
+
+    _print_success_message()
+
+
+def test_numpy_compaction(NumpySeq2Seq):
+    vocab_size = 20
+    rnn_size = 8
+    random_state = np.random.RandomState(0)
+    weights = {'reverse_within_lengths': np.array(True),
+               'output_kernel': random_state.uniform(-1.0, 1.0, (rnn_size, vocab_size)).astype(np.float32),
+               'output_bias': np.zeros(vocab_size, dtype=np.float32)}
+    for prefix in ('encoder', 'decoder'):
+        weights[prefix + '_embeddings'] = random_state.uniform(-1.0, 1.0, (vocab_size, 4)).astype(np.float32)
+        for layer_i, input_size in enumerate((4, rnn_size)):
+            weights['{}_kernel_{}'.format(prefix, layer_i)] = random_state.uniform(
+                -1.0, 1.0, (input_size + rnn_size, 4 * rnn_size)).astype(np.float32)
+            weights['{}_bias_{}'.format(prefix, layer_i)] = np.zeros(4 * rnn_size, dtype=np.float32)
+    source_batch = random_state.randint(4, vocab_size, size=(6, 5))
+    source_lengths = [5, 3, 1, 4, 2, 5]
+    target_lengths = [12, 1, 2, 0, 3, 1]
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'model.npz')
+        np.savez(path, **weights)
+        model = NumpySeq2Seq(path)
+        predictions = model.predict(source_batch, source_lengths, target_lengths)
+        sentence_predictions = [model.predict(source_batch[[i]], source_lengths[i:i + 1], target_lengths[i:i + 1])[0]
+                                for i in range(len(target_lengths))]
+
+    assert predictions.shape[1] <= max(target_lengths),\
+        'Decoded {} steps for a longest budget of {}'.format(predictions.shape[1], max(target_lengths))
+    for i, sentence_ids in enumerate(sentence_predictions):
+        expected = np.full(predictions.shape[1], helper.CODES['<PAD>'])
+        expected[:len(sentence_ids)] = sentence_ids
+        assert np.array_equal(predictions[i], expected),\
+            'Sentence {} decoded in the batch as {} instead of {}'.format(i, predictions[i].tolist(),
+                                                                        expected.tolist())
+
+    _print_success_message()
+
+
+def test_quantize_array(quantize_array):
+    random_state = np.random.RandomState(0)
+    matrix = random_state.randn(64, 32).astype(np.float32) * np.linspace(0.01, 10.0, 32).astype(np.float32)
+    matrix[:, 0] = 0.0
+
+    values, scales = quantize_array(matrix, axis=0)
+
+    assert values.dtype == np.int8 and scales.dtype == np.float32,\
+        'Found values of type {} and scales of type {}'.format(values.dtype, scales.dtype)
+    assert scales.shape == (1, 32),\
+        'Expected one scale per column, found shape {}'.format(scales.shape)
+    assert np.all(np.abs(values * scales - matrix) <= scales / 2 + 1e-6),\
+        'Values are further than half a step from the weights they quantize'
+    assert np.all(values[:, 0] == 0) and np.all(np.isfinite(scales)),\
+        'An all zero column should quantize to zeros'
+    assert quantize_array(matrix, axis=1)[1].shape == (64, 1),\
+        'Expected one scale per row with axis=1'
+
+    _print_success_message()
+
+
 def test_sentence_to_seq(sentence_to_seq):
     sentence = 'this is a test sentence'
     vocab_to_int = {'<PAD>': 0, '<EOS>': 1, '<UNK>': 2, 'this': 3, 'is': 6, 'a': 5, 'sentence': 4}
@@ -278,6 +429,36 @@ def test_sentence_to_seq(sentence_to_seq):
     _print_success_message()
 
 
+def test_sentence_encoder(SentenceEncoder, SentenceDecoder):
+    vocab_to_int = {'<PAD>': 0, '<EOS>': 1, '<UNK>': 2, '<GO>': 3, 'he': 4, 'saw': 5, 'a': 6, 'truck': 7, '.': 8}
+    int_to_vocab = {word_id: word for word, word_id in vocab_to_int.items()}
+
+    encoder = SentenceEncoder(vocab_to_int)
+    assert encoder.encode('He saw a yellow truck .') == [4, 5, 6, 2, 7, 8],\
+        'Sentence encoded incorrectly: {}'.format(encoder.encode('He saw a yellow truck .'))
+
+    padded, lengths = encoder.encode_batch(['he saw a truck .', 'A truck', ''])
+    assert padded.dtype == np.int32,\
+        'Batch should be int32.  Found {}'.format(padded.dtype)
+    assert padded.tolist() == [[4, 5, 6, 7, 8], [6, 7, 0, 0, 0], [0, 0, 0, 0, 0]],\
+        'Batch encoded incorrectly: {}'.format(padded.tolist())
+    assert list(lengths) == [5, 2, 0],\
+        'Expected lengths [5, 2, 0], found {}'.format(list(lengths))
+
+    decoder = SentenceDecoder(int_to_vocab)
+    predictions = np.array([[4, 5, 7, 1, 6],
+                            [6, 7, 0, 0, 0],
+                            [4, 5, 6, 7, 8]])
+    assert decoder.cut_batch(predictions) == [[4, 5, 7], [6, 7], [4, 5, 6, 7, 8]],\
+        'Predictions not cut at <EOS> or <PAD>: {}'.format(decoder.cut_batch(predictions))
+    assert decoder.decode_batch(predictions) == ['he saw truck', 'a truck', 'he saw a truck .'],\
+        'Predictions decoded incorrectly: {}'.format(decoder.decode_batch(predictions))
+    assert decoder.decode([4, 5]) == 'he saw',\
+        'Ids decoded incorrectly: {}'.format(decoder.decode([4, 5]))
+
+    _print_success_message()
+
+
 def test_process_encoding_input(process_encoding_input):
     batch_size = 2
     seq_length = 3
@@ -324,9 +505,9 @@ def test_decoding_layer_train(decoding_layer_train):
                     dec_cell = tf.contrib.rnn.DropoutWrapper(lstm,
                                                              input_keep_prob=keep_prob)
 
-            output_layer = Dense(vocab_size,
-                                 kernel_initializer=tf.truncated_normal_initializer(mean=0.0, stddev=0.1),
-                                 name='output_layer')
+            output_layer = tf.layers.Dense(vocab_size,
+                                           kernel_initializer=tf.truncated_normal_initializer(mean=0.0, stddev=0.1),
+                                           name='output_layer')
             # output_fn = lambda x: tf.contrib.layers.fully_connected(x, vocab_size, None, scope=decoding_scope)
 
 
@@ -379,9 +560,9 @@ def test_decoding_layer_infer(decoding_layer_infer):
                     dec_cell = tf.contrib.rnn.DropoutWrapper(lstm,
                                                              input_keep_prob=keep_prob)
 
-            output_layer = Dense(vocab_size,
-                                 kernel_initializer=tf.truncated_normal_initializer(mean=0.0, stddev=0.1),
-                                 name='output_layer')
+            output_layer = tf.layers.Dense(vocab_size,
+                                           kernel_initializer=tf.truncated_normal_initializer(mean=0.0, stddev=0.1),
+                                           name='output_layer')
             # output_fn = lambda x: tf.contrib.layers.fully_connected(x, vocab_size, None, scope=decoding_scope)
 
 
@@ -411,3 +592,390 @@ def test_decoding_layer_infer(decoding_layer_infer):
                  'Wrong shape returned.  Found {}'.format(infer_logits_output.sample_id.get_shape())
 
     _print_success_message()
+
+
+def test_micro_batcher(MicroBatcher):
+    batch_sizes = []
+
+    def run_batch(items):
+        batch_sizes.append(len(items))
+        return [item * 2 for item in items]
+
+    batcher = MicroBatcher(run_batch, batch_size=4, max_wait=0.05)
+    futures = [batcher.submit(i) for i in range(10)]
+    results = [future.result(timeout=5) for future in futures]
+    batcher.close()
+
+    assert results == [i * 2 for i in range(10)],\
+        'Results returned out of order: {}'.format(results)
+    assert sum(batch_sizes) == 10,\
+        'Expected 10 items to be run, found {}'.format(sum(batch_sizes))
+    assert max(batch_sizes) <= 4,\
+        'Batch larger than batch_size: {}'.format(batch_sizes)
+    assert len(batch_sizes) < 10,\
+        'Items were not gathered into batches: {}'.format(batch_sizes)
+
+    _print_success_message()
+
+
+def test_get_batches(get_batches):
+    batch_size = 4
+    test_sources = [[5, 6, 7], [8], [9, 10], [11, 12, 13, 14], [15, 16], [17]]
+    test_targets = [[20, 1], [21, 22, 1], [1], [23, 1], [24, 25, 26, 1], [1]]
+
+    batches = list(get_batches(test_sources, test_targets, batch_size, 0, 3))
+
+    assert len(batches) == 1,\
+        'Expected 1 full batch, found {}'.format(len(batches))
+    sources_batch, targets_batch, source_lengths, target_lengths = batches[0]
+
+    assert sources_batch.dtype == np.int32 and targets_batch.dtype == np.int32,\
+        'Batches should be int32.  Found {} and {}'.format(sources_batch.dtype, targets_batch.dtype)
+    assert sources_batch.tolist() == [[5, 6, 7, 0], [8, 0, 0, 0], [9, 10, 0, 0], [11, 12, 13, 14]],\
+        'Sources padded incorrectly: {}'.format(sources_batch.tolist())
+    assert targets_batch.tolist() == [[20, 1, 3], [21, 22, 1], [1, 3, 3], [23, 1, 3]],\
+        'Targets padded incorrectly: {}'.format(targets_batch.tolist())
+    assert list(source_lengths) == [3, 1, 2, 4] and list(target_lengths) == [2, 3, 1, 2],\
+        'Expected the real sentence lengths, found {} and {}'.format(list(source_lengths), list(target_lengths))
+
+    _print_success_message()
+
+
+def test_get_bucketed_batches(get_bucketed_batches):
+    batch_size = 8
+    random_state = np.random.RandomState(0)
+    test_sources = [list(random_state.randint(4, 50, size=length)) for length in random_state.randint(1, 30, size=100)]
+    test_targets = [source + [1] for source in test_sources]
+
+    batches = list(get_bucketed_batches(test_sources, test_targets, batch_size, 0, 0, num_buckets=5, seed=1))
+
+    assert len(batches) == len(test_sources) // batch_size,\
+        'Expected {} batches, found {}'.format(len(test_sources) // batch_size, len(batches))
+
+    seen = []
+    padded_tokens = 0
+    for sources_batch, targets_batch, source_lengths, target_lengths in batches:
+        assert sources_batch.shape[0] == batch_size and targets_batch.shape[0] == batch_size,\
+            'Batch has the wrong size.  Found {} and {}'.format(sources_batch.shape, targets_batch.shape)
+        assert sources_batch.shape[1] == max(source_lengths) and targets_batch.shape[1] == max(target_lengths),\
+            'Batch is padded past its longest sentence'
+        for source, target, source_length, target_length in zip(sources_batch, targets_batch,
+                                                                source_lengths, target_lengths):
+            assert list(target[:target_length]) == list(source[:source_length]) + [1],\
+                'Source and target sentences got separated'
+            seen.append(tuple(source[:source_length]))
+        padded_tokens += sources_batch.size
+
+    assert len(seen) == len(set(seen)),\
+        'A sentence was batched more than once'
+
+    in_order_tokens = sum(batch_size * max(len(source) for source in test_sources[start_i:start_i + batch_size])
+                          for start_i in range(0, len(batches) * batch_size, batch_size))
+    assert padded_tokens < in_order_tokens,\
+        'Bucketing did not reduce padding: {} tokens against {} in file order'.format(padded_tokens, in_order_tokens)
+
+    _print_success_message()
+
+
+def test_masked_accuracy(masked_accuracy):
+    target = np.array([[4, 5, 1, 0],
+                       [6, 1, 0, 0]])
+    predictions = np.array([[4, 7, 1, 9, 9],
+                            [6, 1, 0, 0, 0]])
+
+    accuracy, tokens = masked_accuracy(target, predictions, [3, 2])
+    assert tokens == 5,\
+        'Expected 5 real target words, found {}'.format(tokens)
+    assert np.isclose(accuracy, 4 / 5),\
+        'Padding should not count towards accuracy.  Expected 0.8, found {}'.format(accuracy)
+
+    accuracy, tokens = masked_accuracy(target, predictions[:, :1], [3, 2])
+    assert np.isclose(accuracy, 2 / 5),\
+        'Missing predictions should count as wrong.  Expected 0.4, found {}'.format(accuracy)
+
+    _print_success_message()
+
+
+def test_corpus_bleu(corpus_bleu):
+    references = [[4, 5, 6, 7, 8, 9], [10, 11, 12, 13, 14]]
+
+    assert np.isclose(corpus_bleu(references, references), 1.0),\
+        'Identical translations should score 1.0'
+    assert corpus_bleu(references, [[9, 8, 7, 6, 5, 4], [14, 13, 12, 11, 10]]) == 0.0,\
+        'Translations without a matching 4-gram should score 0.0'
+
+    # 5 of 5 unigrams, 4 of 4 bigrams, 3 of 3 trigrams and 2 of 2 4-grams, one word short of 6
+    short = corpus_bleu([references[0]], [[4, 5, 6, 7, 8]])
+    assert np.isclose(short, np.exp(1 - 6 / 5)),\
+        'Expected only the brevity penalty {}, found {}'.format(np.exp(1 - 6 / 5), short)
+
+    random_state = np.random.RandomState(0)
+    many_references = [list(random_state.randint(4, 20, size=length)) for length in random_state.randint(4, 15, 200)]
+    many_hypotheses = [[word if random_state.rand() < 0.8 else 3 for word in reference]
+                       for reference in many_references]
+    serial = corpus_bleu(many_references, many_hypotheses)
+    parallel = corpus_bleu(many_references, many_hypotheses, workers=2, chunk_size=50)
+    assert np.isclose(serial, parallel),\
+        'Scoring in several processes changed BLEU from {} to {}'.format(serial, parallel)
+
+    _print_success_message()
+
+
+def test_prefetcher(Prefetcher):
+    batches = list(Prefetcher(iter(range(20)), depth=3))
+    assert batches == list(range(20)),\
+        'Batches returned out of order or lost: {}'.format(batches)
+
+    def failing_batches():
+        yield 0
+        raise ValueError('bad batch')
+
+    prefetcher = Prefetcher(failing_batches(), depth=2)
+    assert next(prefetcher) == 0,\
+        'First batch was not returned'
+    try:
+        next(prefetcher)
+    except ValueError:
+        pass
+    else:
+        raise AssertionError('Error in the batch generator was not raised to the trainer')
+
+    # stopping early must not leave the worker blocked on a full queue
+    prefetcher = Prefetcher(iter(range(1000)), depth=1)
+    next(prefetcher)
+    prefetcher.close()
+    assert prefetcher.wait_seconds >= 0 and prefetcher.batches == 1,\
+        'Expected 1 batch, found {}'.format(prefetcher.batches)
+
+    _print_success_message()
+
+
+def test_async_checkpointer(AsyncCheckpointer):
+    def build_graph(checkpoint_dir):
+        weights = tf.Variable([1.0, 2.0], name='weights')
+        global_step = tf.train.get_or_create_global_step()
+        train_op = tf.group(weights.assign_add([1.0, 1.0]), global_step.assign_add(1))
+        checkpointer = AsyncCheckpointer(checkpoint_dir, every_steps=2, every_seconds=0, max_to_keep=2)
+        return weights, global_step, train_op, checkpointer
+
+    with tempfile.TemporaryDirectory() as checkpoint_dir:
+        with tf.Graph().as_default():
+            weights, global_step, train_op, checkpointer = build_graph(checkpoint_dir)
+            with tf.Session() as sess:
+                assert checkpointer.restore(sess) == 0,\
+                    'Restored from an empty checkpoint directory'
+                saved = []
+                for _ in range(6):
+                    sess.run(train_op)
+                    saved.append(checkpointer.maybe_save(sess, int(sess.run(global_step))))
+                checkpointer.wait()
+
+        assert saved == [False, True, False, True, False, True],\
+            'Expected a checkpoint every 2 steps, found {}'.format(saved)
+        checkpoint_paths = tf.train.get_checkpoint_state(checkpoint_dir).all_model_checkpoint_paths
+        assert len(checkpoint_paths) == 2,\
+            'Expected the 2 most recent checkpoints to be kept, found {}'.format(list(checkpoint_paths))
+
+        with tf.Graph().as_default():
+            weights, global_step, train_op, checkpointer = build_graph(checkpoint_dir)
+            with tf.Session() as sess:
+                step = checkpointer.restore(sess)
+                assert step == 6,\
+                    'Expected to resume at step 6, found {}'.format(step)
+                assert list(sess.run(weights)) == [7.0, 8.0],\
+                    'Restored the wrong weights: {}'.format(sess.run(weights))
+
+    _print_success_message()
+
+
+def test_average_gradients(average_gradients):
+    with tf.Graph().as_default():
+        weights = tf.Variable([[1.0, 2.0], [3.0, 4.0]])
+        embeddings = tf.Variable([[0.0], [0.0], [0.0]])
+        unused = tf.Variable(0.0)
+        tower_gradients = [
+            [(tf.constant([[1.0, 1.0], [1.0, 1.0]]), weights),
+             (tf.IndexedSlices(tf.constant([[2.0]]), tf.constant([0]), tf.constant([3, 1])), embeddings),
+             (None, unused)],
+            [(tf.constant([[3.0, 3.0], [3.0, 3.0]]), weights),
+             (tf.IndexedSlices(tf.constant([[4.0]]), tf.constant([2]), tf.constant([3, 1])), embeddings),
+             (None, unused)]]
+
+        averaged = average_gradients(tower_gradients)
+
+        assert [var for _, var in averaged] == [weights, embeddings, unused],\
+            'Gradients are not paired with their variables'
+        assert averaged[2][0] is None,\
+            'A variable without gradients should keep a None gradient'
+        assert isinstance(averaged[1][0], tf.IndexedSlices),\
+            'Embedding gradients should stay sparse'
+
+        with tf.Session() as sess:
+            weights_grad, embeddings_grad = sess.run([averaged[0][0], tf.convert_to_tensor(averaged[1][0])])
+
+    assert np.allclose(weights_grad, 2.0),\
+        'Expected the mean of the towers, found {}'.format(weights_grad)
+    assert np.allclose(embeddings_grad, [[1.0], [0.0], [2.0]]),\
+        'Sparse gradients averaged incorrectly: {}'.format(embeddings_grad)
+
+    _print_success_message()
+
+
+def test_metrics_logger(MetricsLogger, load_metrics):
+    with tempfile.TemporaryDirectory() as directory:
+        for file_name in ('metrics.jsonl', 'metrics.csv'):
+            path = os.path.join(directory, file_name)
+            logger = MetricsLogger(path, flush_every=1)
+            logger.log(1, epoch=0, batch=0, step_seconds=0.5, loss=2.25)
+            logger.log(2, epoch=0, batch=1, step_seconds=0.25, loss=1.5, train_accuracy=0.75)
+            logger.close()
+
+            records = load_metrics(path)
+            assert [record['step'] for record in records] == [1, 2],\
+                '{}: expected steps 1 and 2, found {}'.format(file_name, records)
+            assert records[0]['loss'] == 2.25 and records[1]['step_seconds'] == 0.25,\
+                '{}: values were not kept: {}'.format(file_name, records)
+            assert 'train_accuracy' not in records[0] and records[1]['train_accuracy'] == 0.75,\
+                '{}: metrics missing from a step should stay missing: {}'.format(file_name, records)
+
+    _print_success_message()
+
+
+def test_translation_cache(TranslationCache):
+    with tempfile.TemporaryDirectory() as directory:
+        cache = TranslationCache(max_entries=2)
+        cache.put('model', [4, 5], [6, 1])
+        cache.put('model', [7], [8])
+        assert cache.get('model', [4, 5]) == [6, 1],\
+            'Cached translation not returned'
+        cache.put('model', [9], [10])
+        assert cache.get('model', [7]) is None,\
+            'The least recently used translation should be evicted'
+        assert cache.get('model', [4, 5]) == [6, 1] and cache.get('model', [9]) == [10],\
+            'Recently used translations were evicted'
+        assert cache.get('other model', [4, 5]) is None,\
+            'Translations of another checkpoint should not be returned'
+        stats = cache.stats()
+        assert (stats['hits'], stats['misses'], stats['evictions']) == (3, 2, 1),\
+            'Expected 3 hits, 2 misses and 1 eviction, found {}'.format(stats)
+
+        small_cache = TranslationCache(max_bytes=1000)
+        for i in range(100):
+            small_cache.put('model', [i] * 10, [i] * 10)
+        assert 0 < len(small_cache) < 100 and small_cache.stats()['bytes'] <= 1000,\
+            'Memory bound not kept: {}'.format(small_cache.stats())
+
+        path = os.path.join(directory, 'cache.db')
+        disk_cache = TranslationCache(path=path)
+        disk_cache.put('model', [4, 5], [6, 1])
+        disk_cache.close()
+        disk_cache = TranslationCache(path=path)
+        assert disk_cache.get('model', [4, 5]) == [6, 1] and disk_cache.stats()['disk_hits'] == 1,\
+            'Translation not read back from disk'
+        disk_cache.invalidate('new model')
+        assert disk_cache.get('model', [4, 5]) is None,\
+            'Translations of an old checkpoint should be invalidated'
+        disk_cache.close()
+
+    _print_success_message()
+
+
+def _run_train_step(model, params, vocab_size, steps=1):
+    random_state = np.random.RandomState(0)
+    source_lengths = random_state.randint(1, 8, size=params.batch_size)
+    target_lengths = random_state.randint(1, 8, size=params.batch_size)
+    feed_dict = {model.input_data: random_state.randint(4, vocab_size, size=(params.batch_size, 7)),
+                 model.targets: random_state.randint(4, vocab_size, size=(params.batch_size, 7)),
+                 model.source_sequence_length: source_lengths, model.target_sequence_length: target_lengths,
+                 model.lr: params.learning_rate, model.keep_prob: params.keep_probability}
+    with tf.Session(graph=model.graph) as sess:
+        sess.run(tf.global_variables_initializer())
+        for _ in range(steps):
+            loss, _ = sess.run([model.cost, model.train_op], feed_dict)
+        global_step = sess.run(model.global_step)
+    return loss, global_step
+
+
+def test_towers(build_train_graph, default_params):
+    vocab_size = 30
+    variables = {}
+    for num_towers in (1, 2):
+        params = _small_model_params(default_params, num_towers=num_towers)
+        model = build_train_graph(params, vocab_size, vocab_size, dict(helper.CODES))
+        with model.graph.as_default():
+            variables[num_towers] = sorted((var.op.name, var.get_shape().as_list())
+                                           for var in tf.trainable_variables())
+        loss, global_step = _run_train_step(model, params, vocab_size)
+
+        assert np.isfinite(loss),\
+            'The loss with {} towers is {}'.format(num_towers, loss)
+        assert global_step == 1,\
+            'Expected one optimizer step with {} towers, found {}'.format(num_towers, global_step)
+
+    assert variables[2] == variables[1],\
+        'The towers should share a single set of variables, found {}'.format(
+            sorted(set(variables[2]) ^ set(variables[1])))
+
+    _print_success_message()
+
+
+def test_sampled_softmax(build_train_graph, default_params):
+    vocab_size = 30
+    params = _small_model_params(default_params, num_sampled=5)
+
+    model = build_train_graph(params, vocab_size, vocab_size, dict(helper.CODES))
+    loss, global_step = _run_train_step(model, params, vocab_size)
+
+    assert np.isfinite(loss),\
+        'The sampled softmax loss is {}'.format(loss)
+    assert global_step == 1,\
+        'Expected one optimizer step, found {}'.format(global_step)
+
+    with model.graph.as_default():
+        kernels = [var.op.name for var in tf.trainable_variables() if var.op.name.endswith('dense/kernel')]
+        assert kernels == ['decoder/decoder/dense/kernel'],\
+            'Expected a single output layer shared by training and inference, found {}'.format(kernels)
+
+        # a bias favouring the last word only wins if predictions:0 projects onto the whole vocabulary
+        output_bias = [var for var in tf.trainable_variables() if var.op.name == 'decoder/decoder/dense/bias'][0]
+        favour_last_word = output_bias.assign(np.eye(vocab_size, dtype=np.float32)[-1] * 1000)
+        with tf.Session() as sess:
+            sess.run(tf.global_variables_initializer())
+            sess.run(favour_last_word)
+            predictions = sess.run(model.graph.get_tensor_by_name('predictions:0'),
+                                   {model.input_data: np.full((params.batch_size, 3), 4),
+                                    model.source_sequence_length: [3] * params.batch_size,
+                                    model.target_sequence_length: [3] * params.batch_size,
+                                    model.keep_prob: 1.0})
+
+    assert np.all(predictions[:, 0] == vocab_size - 1),\
+        'predictions:0 should project onto the full vocabulary of {} words, found {}'.format(vocab_size, predictions)
+
+    _print_success_message()
+
+
+def test_create_lookup_tables(create_lookup_tables):
+    test_text = 'the cat saw the dog . the dog saw a cat . a bird'
+
+    vocab_to_int, int_to_vocab = create_lookup_tables(test_text)
+    assert vocab_to_int == create_lookup_tables(test_text)[0],\
+        'Lookup tables changed between calls'
+    for code, code_id in helper.CODES.items():
+        assert vocab_to_int[code] == code_id,\
+            'Special code {} should have id {}.  Found {}'.format(code, code_id, vocab_to_int[code])
+    assert vocab_to_int['the'] == len(helper.CODES),\
+        'The most frequent word should get the first id after the special codes'
+    assert all(int_to_vocab[word_id] == word for word, word_id in vocab_to_int.items()),\
+        'int_to_vocab is not the inverse of vocab_to_int'
+
+    vocab_to_int, _ = create_lookup_tables(test_text, min_count=2)
+    assert 'bird' not in vocab_to_int and 'dog' in vocab_to_int,\
+        'min_count should only drop words seen fewer times.  Found {}'.format(sorted(vocab_to_int))
+
+    vocab_to_int, _ = create_lookup_tables(test_text, max_size=len(helper.CODES) + 2)
+    assert len(vocab_to_int) == len(helper.CODES) + 2,\
+        'Vocabulary should be capped at max_size.  Found {} words'.format(len(vocab_to_int))
+    assert 'the' in vocab_to_int and 'bird' not in vocab_to_int,\
+        'max_size should keep the most frequent words'
+
+    _print_success_message()
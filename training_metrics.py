@@ -0,0 +1,141 @@
+import csv
+import json
+import os
+
+import helper
+
+# TensorFlow is only imported once TensorBoard summaries or a trace are written
+tf = helper.LazyModule('tensorflow')
+
+# columns of the CSV format, the JSON lines format writes the same keys
+FIELDS = ['step', 'epoch', 'batch', 'step_seconds', 'input_wait_seconds', 'real_tokens', 'padded_tokens',
+          'real_tokens_per_sec', 'padded_tokens_per_sec', 'loss', 'train_accuracy', 'valid_accuracy']
+
+
+class MetricsLogger(object):
+    """
+    Write one record of training metrics per step to a JSON lines or CSV file and to TensorBoard
+    """
+
+    def __init__(self, path=None, tensorboard_dir=None, flush_every=100):
+        """
+        :param path: File to write to, CSV if it ends with .csv and JSON lines otherwise, None to not write a file
+        :param tensorboard_dir: Directory to write TensorBoard summaries to, None to not write summaries
+        :param flush_every: Number of records between flushes of the file
+        """
+        self.path = path
+        self.flush_every = flush_every
+        self.records = 0
+        self._file = None
+        self._csv = None
+        self._summary_writer = None
+
+        if path:
+            directory = os.path.dirname(path)
+            if directory and not os.path.exists(directory):
+                os.makedirs(directory)
+            self._file = open(path, 'a', encoding='utf-8', newline='')
+            if path.endswith('.csv'):
+                self._csv = csv.DictWriter(self._file, FIELDS, extrasaction='ignore')
+                if self._file.tell() == 0:
+                    self._csv.writeheader()
+        if tensorboard_dir:
+            self._summary_writer = tf.summary.FileWriter(tensorboard_dir)
+
+    def log(self, step, **metrics):
+        """
+        Record the metrics of a step, metrics that weren't measured this step can be left out
+        :param step: Global step
+        :param metrics: Values keyed by the names in FIELDS
+        """
+        record = {'step': step}
+        record.update(metrics)
+
+        if self._csv:
+            self._csv.writerow(record)
+        elif self._file:
+            self._file.write(json.dumps(record) + '\n')
+
+        if self._summary_writer:
+            values = [tf.Summary.Value(tag=name, simple_value=value) for name, value in sorted(metrics.items())
+                      if isinstance(value, (int, float)) and name not in ('epoch', 'batch')]
+            self._summary_writer.add_summary(tf.Summary(value=values), step)
+
+        self.records += 1
+        if self._file and self.records % self.flush_every == 0:
+            self._file.flush()
+
+    def close(self):
+        if self._file:
+            self._file.close()
+            self._file = None
+        if self._summary_writer:
+            self._summary_writer.close()
+            self._summary_writer = None
+
+
+class TimelineTracer(object):
+    """
+    Capture a Chrome trace of chosen training steps, open it at chrome://tracing
+    """
+
+    def __init__(self, trace_dir, steps):
+        """
+        :param trace_dir: Directory to write timeline-<step>.json files to
+        :param steps: Global steps to trace
+        """
+        self.trace_dir = trace_dir
+        self.steps = set(steps or [])
+        self._run_metadata = None
+
+    def run_args(self, step):
+        """
+        :param step: Global step about to run
+        :return: Keyword arguments to pass to sess.run, tracing the run if step was chosen
+        """
+        if step not in self.steps:
+            self._run_metadata = None
+            return {}
+        self._run_metadata = tf.RunMetadata()
+        return {'options': tf.RunOptions(trace_level=tf.RunOptions.FULL_TRACE),
+                'run_metadata': self._run_metadata}
+
+    def write(self, step):
+        """
+        Write the trace of the run started with run_args(step)
+        :return: Path of the trace, None if the step wasn't traced
+        """
+        if self._run_metadata is None:
+            return None
+        from tensorflow.python.client import timeline
+
+        if not os.path.exists(self.trace_dir):
+            os.makedirs(self.trace_dir)
+        path = os.path.join(self.trace_dir, 'timeline-{}.json'.format(step))
+        with open(path, 'w') as out_file:
+            out_file.write(timeline.Timeline(self._run_metadata.step_stats).generate_chrome_trace_format())
+        self._run_metadata = None
+        return path
+
+
+def _number(value):
+    try:
+        return int(value)
+    except ValueError:
+        return float(value)
+
+
+def load_metrics(path):
+    """
+    Read the records written by MetricsLogger
+    :param path: JSON lines or CSV file
+    :return: List of dictionaries, CSV values converted back to numbers
+    """
+    with open(path, 'r', encoding='utf-8', newline='') as in_file:
+        if not path.endswith('.csv'):
+            return [json.loads(line) for line in in_file if line.strip()]
+
+        records = []
+        for row in csv.DictReader(in_file):
+            records.append({name: _number(value) for name, value in row.items() if value != ''})
+        return records
@@ -0,0 +1,142 @@
+import collections
+import glob
+import hashlib
+import os
+import sqlite3
+import threading
+
+import numpy as np
+
+
+def checkpoint_identity(load_path):
+    """
+    Identify a checkpoint by its files' names, sizes and modification times, so retraining to the same path
+    gives a new identity
+    :param load_path: Checkpoint path or frozen .pb graph
+    :return: Hex digest
+    """
+    paths = [load_path] if load_path.endswith('.pb') else sorted(glob.glob(load_path + '.*'))
+    digest = hashlib.sha1(os.path.abspath(load_path).encode('utf-8'))
+    for path in paths:
+        stat = os.stat(path)
+        digest.update('{}:{}:{}'.format(os.path.basename(path), stat.st_size, stat.st_mtime).encode('utf-8'))
+    return digest.hexdigest()
+
+
+def _entry_size(sentence_ids, translation_ids):
+    # rough bytes of a cached entry, tuples of small ints plus the dictionary and linked list overhead
+    return 200 + 8 * (len(sentence_ids) + len(translation_ids))
+
+
+class TranslationCache(object):
+    """
+    Thread safe LRU cache from source word ids to translated word ids, with an optional SQLite tier on disk
+    """
+
+    def __init__(self, max_entries=100000, max_bytes=64 * 1024 * 1024, path=None):
+        """
+        :param max_entries: Most translations kept in memory
+        :param max_bytes: Approximate memory the kept translations may take
+        :param path: SQLite file persisting translations across processes, None to only cache in memory
+        """
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.path = path
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.bytes = 0
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self._db = None
+
+        if path:
+            self._db = sqlite3.connect(path, check_same_thread=False)
+            self._db.execute('CREATE TABLE IF NOT EXISTS translations '
+                             '(checkpoint TEXT, source BLOB, translation BLOB, PRIMARY KEY (checkpoint, source))')
+            self._db.commit()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, checkpoint, sentence_ids):
+        """
+        :param checkpoint: Identity of the model, see checkpoint_identity
+        :param sentence_ids: Source word ids
+        :return: List of translated word ids, None on a miss
+        """
+        key = (checkpoint, tuple(sentence_ids))
+        with self._lock:
+            translation_ids = self._entries.get(key)
+            if translation_ids is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return list(translation_ids)
+
+            if self._db:
+                row = self._db.execute('SELECT translation FROM translations WHERE checkpoint = ? AND source = ?',
+                                       (checkpoint, _to_blob(key[1]))).fetchone()
+                if row is not None:
+                    translation_ids = tuple(np.frombuffer(row[0], dtype=np.int32).tolist())
+                    self._insert(key, translation_ids)
+                    self.disk_hits += 1
+                    return list(translation_ids)
+
+            self.misses += 1
+            return None
+
+    def put(self, checkpoint, sentence_ids, translation_ids):
+        """
+        Keep a translation, evicting the least recently used ones past max_entries or max_bytes
+        """
+        key = (checkpoint, tuple(sentence_ids))
+        translation_ids = tuple(translation_ids)
+        with self._lock:
+            self._insert(key, translation_ids)
+            if self._db:
+                self._db.execute('INSERT OR REPLACE INTO translations VALUES (?, ?, ?)',
+                                 (checkpoint, _to_blob(key[1]), _to_blob(translation_ids)))
+                self._db.commit()
+
+    def invalidate(self, keep_checkpoint=None):
+        """
+        Drop the translations of every checkpoint but keep_checkpoint
+        :param keep_checkpoint: Identity of the current checkpoint, None to drop everything
+        """
+        with self._lock:
+            for key in [key for key in self._entries if key[0] != keep_checkpoint]:
+                self.bytes -= _entry_size(key[1], self._entries.pop(key))
+            if self._db:
+                self._db.execute('DELETE FROM translations WHERE checkpoint IS NOT ?', (keep_checkpoint,))
+                self._db.commit()
+
+    def stats(self):
+        """
+        :return: Dictionary of the hit, miss and eviction counters and the memory tier's size
+        """
+        with self._lock:
+            lookups = self.hits + self.disk_hits + self.misses
+            return {'hits': self.hits, 'disk_hits': self.disk_hits, 'misses': self.misses,
+                    'hit_rate': (self.hits + self.disk_hits) / lookups if lookups else 0.0,
+                    'evictions': self.evictions, 'entries': len(self._entries), 'bytes': self.bytes}
+
+    def close(self):
+        if self._db:
+            self._db.close()
+            self._db = None
+
+    def _insert(self, key, translation_ids):
+        if key in self._entries:
+            self.bytes -= _entry_size(key[1], self._entries.pop(key))
+        self._entries[key] = translation_ids
+        self.bytes += _entry_size(key[1], translation_ids)
+
+        while self._entries and (len(self._entries) > self.max_entries or self.bytes > self.max_bytes):
+            old_key, old_translation_ids = self._entries.popitem(last=False)
+            self.bytes -= _entry_size(old_key[1], old_translation_ids)
+            self.evictions += 1
+
+
+def _to_blob(word_ids):
+    return np.array(word_ids, dtype=np.int32).tobytes()
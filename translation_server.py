@@ -0,0 +1,316 @@
+import argparse
+import collections
+import json
+import queue
+import threading
+import time
+import urllib.request
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+import numpy as np
+
+
+class ServerStats(object):
+    """
+    Thread safe per-request latency and batch occupancy statistics
+    """
+
+    def __init__(self, window=10000):
+        """
+        :param window: Number of most recent requests and batches kept for percentiles
+        """
+        self._lock = threading.Lock()
+        self._latencies = collections.deque(maxlen=window)
+        self._occupancies = collections.deque(maxlen=window)
+        self._run_times = collections.deque(maxlen=window)
+        self.requests = 0
+        self.batches = 0
+
+    def record_batch(self, size, batch_size, run_time):
+        with self._lock:
+            self.batches += 1
+            self._occupancies.append(size / batch_size)
+            self._run_times.append(run_time)
+
+    def record_request(self, latency):
+        with self._lock:
+            self.requests += 1
+            self._latencies.append(latency)
+
+    def summary(self):
+        """
+        Summarize the recorded statistics
+        :return: Dictionary of request counts, latency percentiles in ms and batch occupancy
+        """
+        with self._lock:
+            latencies = np.array(self._latencies) * 1000
+            occupancies = np.array(self._occupancies)
+            run_times = np.array(self._run_times) * 1000
+            summary = {'requests': self.requests, 'batches': self.batches}
+
+        if len(latencies):
+            summary['latency_ms'] = {'mean': float(np.mean(latencies)),
+                                     'p50': float(np.percentile(latencies, 50)),
+                                     'p90': float(np.percentile(latencies, 90)),
+                                     'p99': float(np.percentile(latencies, 99)),
+                                     'max': float(np.max(latencies))}
+        if len(occupancies):
+            summary['batch_occupancy'] = {'mean': float(np.mean(occupancies)),
+                                          'min': float(np.min(occupancies))}
+            summary['batch_run_ms'] = {'mean': float(np.mean(run_times)),
+                                       'p99': float(np.percentile(run_times, 99))}
+        return summary
+
+
+class MicroBatcher(object):
+    """
+    Gather items submitted from many threads into batches for a single worker thread
+    """
+
+    def __init__(self, run_batch, batch_size, max_wait=0.01, stats=None):
+        """
+        :param run_batch: Function taking a list of at most batch_size items and returning a list of results
+        :param batch_size: Maximum number of items per batch
+        :param max_wait: Seconds to wait for a batch to fill once its first item arrived
+        :param stats: Optional ServerStats to record batches and request latencies in
+        """
+        self.run_batch = run_batch
+        self.batch_size = batch_size
+        self.max_wait = max_wait
+        self.stats = stats
+        self._queue = queue.Queue()
+        self._closed = False
+        self._worker = threading.Thread(target=self._work, name='micro-batcher')
+        self._worker.daemon = True
+        self._worker.start()
+
+    def submit(self, item):
+        """
+        Queue an item for the next batch
+        :param item: Item to pass to run_batch
+        :return: Future resolving to the item's result
+        """
+        if self._closed:
+            raise RuntimeError('MicroBatcher is closed')
+        future = Future()
+        self._queue.put((item, future, time.perf_counter()))
+        return future
+
+    def close(self):
+        """
+        Finish the queued items and stop the worker thread
+        """
+        self._closed = True
+        self._queue.put(None)
+        self._worker.join()
+
+    def _next_batch(self):
+        first = self._queue.get()
+        if first is None:
+            return None
+
+        batch = [first]
+        deadline = time.perf_counter() + self.max_wait
+        while len(batch) < self.batch_size:
+            timeout = deadline - time.perf_counter()
+            if timeout <= 0:
+                break
+            try:
+                entry = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                break
+            if entry is None:
+                # keep the stop marker for after this batch
+                self._queue.put(None)
+                break
+            batch.append(entry)
+
+        return batch
+
+    def _work(self):
+        while True:
+            batch = self._next_batch()
+            if batch is None:
+                return
+
+            start = time.perf_counter()
+            try:
+                results = self.run_batch([item for item, _, _ in batch])
+            except Exception as error:
+                for _, future, _ in batch:
+                    future.set_exception(error)
+                continue
+            end = time.perf_counter()
+
+            for (_, future, submitted), result in zip(batch, results):
+                future.set_result(result)
+                if self.stats:
+                    self.stats.record_request(end - submitted)
+            if self.stats:
+                self.stats.record_batch(len(batch), self.batch_size, end - start)
+
+
+class TranslationRequestHandler(BaseHTTPRequestHandler):
+    """
+    POST /translate with {"sentences": [...]} and GET /stats
+    """
+
+    def do_GET(self):
+        if self.path == '/stats':
+            summary = self.server.stats.summary()
+            if self.server.translator.cache is not None:
+                summary['cache'] = self.server.translator.cache.stats()
+            self._send_json(200, summary)
+        elif self.path == '/health':
+            self._send_json(200, {'status': 'ok'})
+        else:
+            self._send_json(404, {'error': 'Unknown path {}'.format(self.path)})
+
+    def do_POST(self):
+        if self.path != '/translate':
+            self._send_json(404, {'error': 'Unknown path {}'.format(self.path)})
+            return
+
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            request = json.loads(self.rfile.read(length).decode('utf-8'))
+            sentences = request['sentences']
+        except (ValueError, KeyError, TypeError):
+            self._send_json(400, {'error': 'Expected a JSON body with a "sentences" list'})
+            return
+
+        try:
+            translations = self.server.translate(sentences)
+        except Exception as error:
+            self._send_json(500, {'error': str(error)})
+            return
+        self._send_json(200, {'translations': translations})
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, status, body):
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+class TranslationServer(ThreadingMixIn, HTTPServer):
+    """
+    HTTP server that shares one warm Translator between all connections through a MicroBatcher
+    """
+
+    daemon_threads = True
+
+    def __init__(self, address, translator, max_wait=0.01):
+        """
+        :param address: (host, port) to listen on
+        :param translator: language_translation.Translator with the restored model
+        :param max_wait: Seconds a request may wait for its batch to fill
+        """
+        HTTPServer.__init__(self, address, TranslationRequestHandler)
+        self.translator = translator
+        self.stats = ServerStats()
+        self.batcher = MicroBatcher(translator.translate_batch, translator.batch_size, max_wait, self.stats)
+
+    def translate(self, sentences):
+        """
+        Translate sentences, each one taking a row in a shared batch
+        :param sentences: List of English strings
+        :return: List of French strings
+        """
+        futures = [self.batcher.submit(self.translator.encode(sentence)) for sentence in sentences]
+        return [self.translator.decode(future.result()) for future in futures]
+
+    def server_close(self):
+        HTTPServer.server_close(self)
+        self.batcher.close()
+        self.translator.close()
+        if self.translator.cache is not None:
+            self.translator.cache.close()
+
+
+class TranslationClient(object):
+    """
+    Python client for a running TranslationServer
+    """
+
+    def __init__(self, host='127.0.0.1', port=8000, timeout=60):
+        self.url = 'http://{}:{}'.format(host, port)
+        self.timeout = timeout
+
+    def translate(self, sentences):
+        """
+        Translate one sentence or a list of sentences
+        :param sentences: String or list of strings
+        :return: Translated string or list of translated strings
+        """
+        single = isinstance(sentences, str)
+        body = json.dumps({'sentences': [sentences] if single else list(sentences)}).encode('utf-8')
+        request = urllib.request.Request(self.url + '/translate', data=body,
+                                         headers={'Content-Type': 'application/json'})
+        translations = self._open(request)['translations']
+        return translations[0] if single else translations
+
+    def stats(self):
+        """
+        :return: Latency and batch occupancy statistics of the server
+        """
+        return self._open(urllib.request.Request(self.url + '/stats'))
+
+    def _open(self, request):
+        with urllib.request.urlopen(request, timeout=self.timeout) as response:
+            return json.loads(response.read().decode('utf-8'))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Serve translations from a checkpoint restored once')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--load-path', default=None, help='Checkpoint path, defaults to the one in params.p')
+    parser.add_argument('--batch-size', type=int, default=256, help='Batch size the model was built with')
+    parser.add_argument('--mode', choices=['greedy', 'beam'], default='greedy', help='Decoding mode')
+    parser.add_argument('--length-penalty', type=float, default=0.0, help='Length penalty weight for beam search')
+    parser.add_argument('--max-length-ratio', type=float, default=2.0,
+                        help='Translations are cut at this ratio times the source length plus --max-length-offset')
+    parser.add_argument('--max-length-offset', type=int, default=0)
+    parser.add_argument('--max-wait-ms', type=float, default=10.0,
+                        help='How long a request may wait for its batch to fill')
+    parser.add_argument('--cache-size', type=int, default=100000,
+                        help='Translations kept in memory for repeated sentences, 0 to not cache')
+    parser.add_argument('--cache-mb', type=float, default=64, help='Memory the cached translations may take')
+    parser.add_argument('--cache-path', default=None, help='SQLite file keeping translations between restarts')
+    args = parser.parse_args()
+
+    import language_translation
+    import translation_cache
+
+    # NumPy weights are decoded without a cache, so none is built for them by default
+    numpy_weights = bool(args.load_path and args.load_path.endswith('.npz'))
+    if numpy_weights and args.cache_path:
+        parser.error('--cache-path needs a checkpoint, {} is decoded without a cache'.format(args.load_path))
+
+    cache = None
+    if args.cache_size and not numpy_weights:
+        cache = translation_cache.TranslationCache(args.cache_size, int(args.cache_mb * 1024 * 1024),
+                                                   args.cache_path)
+    translator = language_translation.open_translator(args.load_path, args.batch_size, args.mode, args.length_penalty,
+                                                      args.max_length_ratio, args.max_length_offset, cache)
+    server = TranslationServer((args.host, args.port), translator, args.max_wait_ms / 1000)
+    print('Serving translations on http://{}:{}'.format(args.host, args.port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        print(json.dumps(server.stats.summary(), indent=2))
+        server.server_close()
+
+
+if __name__ == '__main__':
+    main()